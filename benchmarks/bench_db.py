@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding: utf8
+""" State db backends benchmark.
+
+Run: `python benchmarks/bench_db.py [writes] [state_size]`; prints the time
+per write.
+
+ * 'write-heavy': `writes` single-key writes (like `last_uid` per message).
+ * 'large-state': the same amount of single-entry updates of a nested map
+   that has `state_size` entries (like a Message-ID map).
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from pyimapsmtpt.simpledb import SimpleDB, SimpleDBJournal, SQLiteDB
+
+
+def _mk_json(dirname):
+    return SimpleDB(os.path.join(dirname, 'db.json'))
+
+
+def _mk_journal(dirname):
+    return SimpleDBJournal(os.path.join(dirname, 'db.json'), fsync='never')
+
+
+def _mk_sqlite(dirname):
+    return SQLiteDB(os.path.join(dirname, 'db.sqlite'))
+
+
+backends = (('json', _mk_json), ('journal', _mk_journal), ('sqlite', _mk_sqlite))
+
+
+def bench_write_heavy(db, writes):
+    for idx in range(writes):
+        db['last_uid'] = idx
+
+
+def bench_large_state(db, writes, state_size):
+    sub = db.subdict('message_ids')
+    if isinstance(sub, dict):
+        ## SimpleDB / Subdict: the whole state is rewritten on each change
+        sub._nosave = True
+        sub.update(('<%d@example.com>' % (idx,), idx) for idx in range(state_size))
+        sub._nosave = False
+    else:
+        with db.batch():
+            sub.update(('<%d@example.com>' % (idx,), idx) for idx in range(state_size))
+    start = time.time()
+    for idx in range(writes):
+        sub['<%d@example.com>' % (idx,)] = -idx
+    return time.time() - start
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    writes = int(args[0]) if args else 1000
+    state_size = int(args[1]) if len(args) > 1 else 10000
+
+    print "%-10s %14s %14s" % ('backend', 'write-heavy', 'large-state')
+    for name, func in backends:
+        dirname = tempfile.mkdtemp()
+        try:
+            db = func(dirname)
+            start = time.time()
+            bench_write_heavy(db, writes)
+            write_heavy = time.time() - start
+            large_state = bench_large_state(db, writes, state_size)
+        finally:
+            shutil.rmtree(dirname)
+        print "%-10s %12.1fus %12.1fus" % (
+            name, write_heavy / writes * 1e6, large_state / writes * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf8
+""" html2text conversion cost per message.
+
+Run: `python benchmarks/bench_html2text.py [messages]`; prints the time
+per message.
+
+ * 'construct': a new configured `HTML2Text` for each message (the older
+   `get_html2text` behaviour).
+ * 'cached': the cached converter from `get_html2text` (got once, as
+   `MailJabberLayer` does).
+
+The 'setup' column is the cost of getting a ready parser alone, the
+others are the whole conversion of a short notification-like and of a
+newsletter-like HTML body.
+"""
+
+import sys
+import time
+
+import html2text
+
+import pyimapsmtpt.config_defaults as config_defaults
+from pyimapsmtpt.common import get_html2text
+from pyimapsmtpt.confloader import Config
+
+
+_short = u'<p>Hi, <a href="http://example.com/x">someone</a> replied to you.</p>'
+
+_newsletter = u''.join(
+    [u'<html><body><h1>Weekly news</h1>'] +
+    [u'<h2>Story %d</h2><p>Some <b>text</b> for the story, with '
+     u'<a href="http://example.com/%d">a link</a> and an '
+     u'<img src="http://example.com/%d.png" alt="image">.</p>'
+     u'<ul><li>point one</li><li>point two</li></ul>' % (idx, idx, idx)
+     for idx in range(30)] +
+    [u'</body></html>'])
+
+
+def setup_construct(config):
+    obj = html2text.HTML2Text(bodywidth=config.html2text_bodywidth)
+    obj.links_each_paragraph = config.html2text_links_each_paragraph
+    for k, v in config.html2text_etcetera.items():
+        setattr(obj, k, v)
+    return obj
+
+
+def convert_construct(config, doc):
+    return setup_construct(config).handle(doc).strip()
+
+
+def setup_cached(converter):
+    return converter.new_parser()
+
+
+def convert_cached(converter, doc):
+    return converter(doc)
+
+
+def _timeit(func, ar, count):
+    func(*ar)  ## warm-up
+    start = time.time()
+    for _ in range(count):
+        func(*ar)
+    return (time.time() - start) / count
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    messages = int(args[0]) if args else 1000
+    config = Config([config_defaults])
+
+    converter = get_html2text(config)
+    variants = (
+        ('construct', config, setup_construct, convert_construct),
+        ('cached', converter, setup_cached, convert_cached))
+
+    print "%-10s %14s %14s %14s" % ('variant', 'setup', 'short', 'newsletter')
+    for name, arg, setup_func, func in variants:
+        results = [
+            _timeit(setup_func, (arg,), messages * 10),
+            _timeit(func, (arg, _short), messages),
+            _timeit(func, (arg, _newsletter), max(messages // 20, 1))]
+        print "%-10s %12.1fus %12.1fus %12.1fus" % tuple(
+            [name] + [value * 1e6 for value in results])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding: utf8
+""" HTML -> text engines over a corpus, against the plain `get_html2text`
+output.
+
+Run: `python benchmarks/bench_htmltext.py [corpus_dir]`; the corpus is
+the `*.html` files of `corpus_dir` (utf-8), or a few generated documents
+(a newsletter, deeply nested tables, a lot of inline CSS, many links).
+
+For each document and engine prints the time, the output size and the
+share of the reference output's words that are in the engine's output.
+The engines run with the default caps and time budget, so the
+'html2text' engine might fall back to tag-stripping.
+"""
+
+import os
+import re
+import sys
+import glob
+import time
+
+import pyimapsmtpt.config_defaults as config_defaults
+from pyimapsmtpt.common import get_html2text
+from pyimapsmtpt.confloader import Config
+from pyimapsmtpt.htmltext import HTMLToText, engines
+
+
+def _newsletter():
+    return u''.join(
+        [u'<html><body><h1>Weekly news</h1>'] +
+        [u'<h2>Story %d</h2><p>Some <b>text</b> for the story, with '
+         u'<a href="http://example.com/%d">a link</a>.</p>'
+         u'<ul><li>point one</li><li>point two</li></ul>' % (idx, idx)
+         for idx in range(50)] +
+        [u'</body></html>'])
+
+
+def _nested_tables(depth=200):
+    return u''.join(
+        [u'<table><tr><td style="padding: 0">level %d ' % (idx,) for idx in range(depth)] +
+        [u'</td></tr></table>' * depth])
+
+
+def _inline_css(size=1024 * 1024):
+    rule = u'.c%d { color: #123456; margin: 0 auto; font-family: Arial; }\n'
+    css = u''.join(rule % (idx,) for idx in range(size // len(rule)))
+    return u'<html><head><style>%s</style></head><body><p>The actual text.</p></body></html>' % (css,)
+
+
+def _many_links(count=3000):
+    return u'<p>%s</p>' % (u' '.join(
+        u'<a href="http://example.com/%d">link %d</a>' % (idx, idx)
+        for idx in range(count)),)
+
+
+def generated_corpus():
+    return [
+        ('newsletter', _newsletter()),
+        ('nested-tables', _nested_tables()),
+        ('inline-css', _inline_css()),
+        ('many-links', _many_links()),
+    ]
+
+
+def load_corpus(dirname):
+    res = []
+    for filename in sorted(glob.glob(os.path.join(dirname, '*.html'))):
+        with open(filename, 'rb') as fobj:
+            res.append((os.path.basename(filename), fobj.read().decode('utf-8', 'replace')))
+    return res
+
+
+_re_word = re.compile(r'\w+', re.UNICODE)
+
+
+def word_recall(reference, text):
+    reference_words = set(_re_word.findall(reference))
+    if not reference_words:
+        return 1.0
+    return len(reference_words & set(_re_word.findall(text))) / float(len(reference_words))
+
+
+def _timed(func, arg):
+    start = time.time()
+    res = func(arg)
+    return res, time.time() - start
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    corpus = load_corpus(args[0]) if args else generated_corpus()
+
+    config = Config([config_defaults])
+    reference_func = get_html2text(config)
+    converters = []
+    for name in sorted(engines):
+        class _Override(object):
+            html2text_engine = name
+        converter = HTMLToText(Config([config_defaults, _Override]))
+        if converter.engine_name == name:
+            converters.append((name, converter))
+
+    print "%-16s %-10s %10s %10s %8s" % ('document', 'engine', 'time', 'size', 'recall')
+    for doc_name, doc in corpus:
+        reference, reference_time = _timed(reference_func, doc)
+        print "%-16s %-10s %9.1fms %10d %8s" % (
+            doc_name, '(ref)', reference_time * 1e3, len(reference), '')
+        for name, converter in converters:
+            fallbacks = converter.stats['fallbacks']
+            res, res_time = _timed(converter, doc)
+            print "%-16s %-10s %9.1fms %10d %7.0f%%%s" % (
+                doc_name, name, res_time * 1e3, len(res),
+                word_recall(reference, res) * 100,
+                ' (fallback)' if converter.stats['fallbacks'] > fallbacks else '')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: utf8
+""" Per-message cost of the data passed between the layers.
+
+Run: `python benchmarks/bench_msgdata.py [messages]`; prints the time
+per message.
+
+ * 'dicts': the older way, ad-hoc dicts (JIDs as dicts too) with the
+   source object references in them, `deepcopy`-ed by the pre/post
+   processing.
+ * 'records': `MessageData` with interned `JID`s and the copy-on-write
+   `copy()`.
+
+'incoming' is an XMPP event turned into the message data and copied;
+'outgoing' is the message data for an email, copied.
+"""
+
+import sys
+import time
+from copy import deepcopy
+
+from xmpp.protocol import JID as XMPPJID
+
+from pyimapsmtpt.common import jid_to_data, MessageData
+
+
+class _Connection(object):
+    """ Something like an xmpppy connection: a largish object graph """
+
+    def __init__(self):
+        self.handlers = {
+            'message': [dict(func=repr, xmlns='jabber:client') for _ in range(20)],
+            'presence': [dict(func=repr, xmlns='jabber:client') for _ in range(20)],
+        }
+        self.roster = dict(
+            ('user%d@example.com' % (idx,), dict(name=u'User %d' % (idx,), groups=['x']))
+            for idx in range(200))
+
+
+class _Event(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.frm = XMPPJID('me@example.com/phone')
+        self.to = XMPPJID('someone%example.org@mail.example.com/abcdefghij')
+
+    def getType(self):
+        return 'chat'
+
+    def getFrom(self):
+        return self.frm
+
+    def getTo(self):
+        return self.to
+
+    def getBody(self):
+        return u'Hello there, this is a reply.'
+
+    def getSubject(self):
+        return None
+
+
+def _old_jid_to_data(jid):
+    return dict(node=jid.node, domain=jid.domain, resource=jid.resource)
+
+
+def incoming_dicts(event, connection):
+    event_data = dict(
+        _event=event,
+        _type=event.getType(),
+        frm=_old_jid_to_data(event.getFrom()),
+        to=_old_jid_to_data(event.getTo()),
+        body=event.getBody(),
+        subject=event.getSubject(),
+    )
+    msg_data = dict(event_data, _event=event, _connection=connection, _transport=None)
+    return deepcopy(msg_data)
+
+
+def incoming_records(event, connection):
+    msg_data = MessageData(
+        type=event.getType(),
+        frm=jid_to_data(event.getFrom()),
+        to=jid_to_data(event.getTo()),
+        body=event.getBody(),
+        subject=event.getSubject(),
+        refs=dict(_event=event))
+    msg_data.refs = dict(_event=event, _connection=connection, _transport=None)
+    return msg_data.copy()
+
+
+def outgoing_dicts():
+    jmsg_data = dict(
+        to='me@example.com', frm='someone%example.org@mail.example.com/abcdefghij',
+        subject=u'Hello', body=u'Subject: Hello\n\nThe email text. ' * 20)
+    return deepcopy(jmsg_data)
+
+
+def outgoing_records():
+    jmsg_data = MessageData(
+        to='me@example.com', frm='someone%example.org@mail.example.com/abcdefghij',
+        subject=u'Hello', body=u'Subject: Hello\n\nThe email text. ' * 20)
+    return jmsg_data.copy()
+
+
+def _timeit(func, ar, count):
+    func(*ar)  ## warm-up
+    start = time.time()
+    for _ in range(count):
+        func(*ar)
+    return (time.time() - start) / count
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    messages = int(args[0]) if args else 2000
+    connection = _Connection()
+    event = _Event(connection)
+
+    print "%-10s %14s %14s" % ('variant', 'incoming', 'outgoing')
+    for name, incoming, outgoing in (
+            ('dicts', incoming_dicts, outgoing_dicts),
+            ('records', incoming_records, outgoing_records)):
+        print "%-10s %12.1fus %12.1fus" % (
+            name,
+            _timeit(incoming, (event, connection), messages) * 1e6,
+            _timeit(outgoing, (), messages) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
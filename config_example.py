@@ -27,3 +27,12 @@ smtp_username = imap_username
 
 imap_password = "my_email_password"
 smtp_password = imap_password
+
+
+## Multiple accounts (see `imap_accounts` in config_defaults.py):
+# imap_accounts = [
+#     dict(name='work', imap_username='me@work.example',
+#          imap_password='...', smtp_username='me@work.example',
+#          smtp_password='...', email_address='me@work.example'),
+#     dict(name='home'),  # the top-level settings as they are
+# ]
@@ -0,0 +1,92 @@
+# coding: utf8
+""" Reconnect scheduling: exponential backoff with jitter per failure
+class, and a circuit breaker on top of it. """
+
+import time
+import random
+import logging
+
+
+_log = logging.getLogger(__name__)
+
+
+class Backoff(object):
+    """ Computes the delays before the reconnect attempts.
+
+    Each failure class has its own `(base_delay, max_delay)`; the delay
+    doubles with each consecutive failure of that class and is jittered
+    ('equal jitter': half fixed, half random) so that multiple clients do
+    not retry in lockstep.
+
+    After `circuit_threshold` consecutive failures (of any class) the
+    circuit is 'open': the delay is `circuit_timeout` (jittered too).
+    The attempt after that is 'half-open'; a success closes the circuit,
+    a failure opens it again.
+
+    Use: `delay = backoff.failure('abort')` (then wait that much), and
+    `backoff.success()` once the connection is known to work.
+    """
+
+    default_policies = {
+        'abort': (1, 60),  # connection errors
+        'auth': (60, 3600),  # login failures; retrying fast won't help
+        'error': (5, 600),  # anything else
+    }
+
+    def __init__(self, policies=None, circuit_threshold=10,
+                 circuit_timeout=1800, random_func=random.random):
+        self.policies = dict(self.default_policies, **(policies or {}))
+        self.circuit_threshold = circuit_threshold
+        self.circuit_timeout = circuit_timeout
+        self.random_func = random_func
+
+        self.state = 'closed'
+        self.consecutive = 0
+        self.consecutive_by_class = {}
+        self.last_failure_time = None
+        self.stats = dict(failures=0, successes=0, circuit_opens=0)
+
+    def _jitter(self, delay):
+        return delay / 2.0 + self.random_func() * delay / 2.0
+
+    def failure(self, failure_class='error'):
+        """ Register a failure; returns the delay to wait before the next
+        attempt """
+        if failure_class not in self.policies:
+            failure_class = 'error'
+        self.stats['failures'] += 1
+        key = 'failures_%s' % (failure_class,)
+        self.stats[key] = self.stats.get(key, 0) + 1
+        self.last_failure_time = time.time()
+
+        self.consecutive += 1
+        count = self.consecutive_by_class.get(failure_class, 0) + 1
+        self.consecutive_by_class = {failure_class: count}
+
+        if (self.state == 'half-open' or
+                (self.circuit_threshold and
+                 self.consecutive >= self.circuit_threshold)):
+            if self.state != 'open':
+                _log.warning("Circuit open after %d consecutive failures",
+                             self.consecutive)
+                self.stats['circuit_opens'] += 1
+            self.state = 'open'
+            return self._jitter(self.circuit_timeout)
+
+        base_delay, max_delay = self.policies[failure_class]
+        delay = min(max_delay, base_delay * 2 ** (count - 1))
+        return self._jitter(delay)
+
+    def attempt(self):
+        """ Register the start of a new attempt (after the delay) """
+        if self.state == 'open':
+            self.state = 'half-open'
+
+    def success(self):
+        """ Register a working connection (resets everything) """
+        if self.state != 'closed':
+            _log.info("Circuit closed")
+        self.state = 'closed'
+        self.consecutive = 0
+        self.consecutive_by_class = {}
+        self.stats['successes'] += 1
@@ -0,0 +1,143 @@
+# coding: utf8
+""" Burst coalescing for the email -> xmpp delivery.
+
+A mailing list or a CI system can send dozens of emails within a minute;
+each of them would be a separate XMPP message (and an offline-storage
+entry). The `Coalescer` is a stage in front of the XMPP sink: the
+messages are grouped by a key (the List-Id or the sender); while a group
+is quiet (at most `threshold` messages within the last `window`
+seconds), its messages go out right away. Past that, the group's further
+messages are held and sent as a single digest message at the end of the
+window (or once `max_items` of them are held).
+"""
+
+import time
+import logging
+from collections import deque
+
+import gevent
+
+from .common import MessageData
+
+
+_log = logging.getLogger(__name__)
+
+
+class _Group(object):
+
+    def __init__(self):
+        ## The times of the messages within the window
+        self.times = deque()
+        ## The held `(msg_data, kwa)`, None when not coalescing
+        self.held = None
+        self.timer = None
+        self.digest_frm = None
+
+
+class Coalescer(object):
+    """ `put(key, msg_data, **kwa)` calls `sink(msg_data, **kwa)` either
+    right away or (for a burst) later, with a digest message (sent from
+    the `digest_frm` of the group) """
+
+    separator = u'\n\n' + u'-' * 20 + u'\n\n'
+
+    def __init__(self, sink, window=60, threshold=5, max_items=50, max_groups=1000):
+        self.sink = sink
+        self.window = window
+        self.threshold = threshold
+        self.max_items = max_items
+        self.max_groups = max_groups
+        self.groups = {}
+        self.stats = dict(messages=0, immediate=0, coalesced=0, digests=0)
+
+    def put(self, key, msg_data, digest_frm=None, **kwa):
+        """ ...
+
+        :param digest_frm: the sender JID for the group's digest (e.g. the
+        mailing list's); the bare JID of the sender of the last message
+        by default.
+        """
+        self.stats['messages'] += 1
+        now = time.time()
+        group = self.groups.get(key)
+        if group is None:
+            if len(self.groups) >= self.max_groups:
+                self._expire(now)
+            group = self.groups[key] = _Group()
+        if digest_frm is not None:
+            group.digest_frm = digest_frm
+        times = group.times
+        while times and times[0] <= now - self.window:
+            times.popleft()
+        times.append(now)
+
+        if group.held is None and len(times) <= self.threshold:
+            self.stats['immediate'] += 1
+            return self.sink(msg_data, **kwa)
+
+        self.stats['coalesced'] += 1
+        if group.held is None:
+            _log.info("Coalescing the messages for %r (%d in %ss)",
+                      key, len(times), self.window)
+            group.held = []
+            group.timer = gevent.spawn_later(self.window, self._flush_timer, key)
+        group.held.append((msg_data, kwa))
+        if len(group.held) >= self.max_items:
+            self.flush(key)
+
+    def _expire(self, now):
+        """ Forget the groups that are quiet """
+        for key, group in self.groups.items():
+            if group.held is None and (
+                    not group.times or group.times[-1] <= now - self.window):
+                del self.groups[key]
+
+    def _flush_timer(self, key):
+        try:
+            self.flush(key, _from_timer=True)
+        except Exception as exc:
+            _log.exception("Digest sending error: %r", exc)
+
+    def flush(self, key, _from_timer=False):
+        """ Send the held messages of the group (if any) """
+        group = self.groups.get(key)
+        if group is None or not group.held:
+            return
+        held, group.held = group.held, None
+        if group.timer is not None and not _from_timer:
+            group.timer.kill(block=False)
+        group.timer = None
+        if len(held) == 1:
+            msg_data, kwa = held[0]
+        else:
+            msg_data = self.make_digest(
+                key, [item[0] for item in held], frm=group.digest_frm)
+            self.stats['digests'] += 1
+            ## The first one's routing arguments (e.g. `_layer`)
+            kwa = {name: value for name, value in held[0][1].items()
+                   if name != '_email_msg'}
+        return self.sink(msg_data, **kwa)
+
+    def flush_all(self):
+        for key in list(self.groups):
+            self.flush(key)
+
+    def make_digest(self, key, items, frm=None):
+        """ A single message for the `items` (MessageData) """
+        last = items[-1]
+        if frm is None:
+            ## Not a reply into any one of the threads
+            frm = unicode(last['frm']).split(u'/', 1)[0]
+        bodies = []
+        for item in items:
+            body = item['body'] or u''
+            subject = item.get('subject')
+            if subject:
+                body = u'Subject: %s\n\n%s' % (subject, body)
+            bodies.append(body)
+        if isinstance(key, str):
+            key = key.decode('utf-8', 'replace')
+        return MessageData(
+            to=last['to'], frm=frm,
+            subject=u'%d messages (%s)' % (len(items), key),
+            body=self.separator.join(bodies))
@@ -17,27 +17,77 @@ def to_bytes(val):
     return val
 
 
-def get_html2text(config):
-    try:
-        import html2text
-    except Exception, exc:
-        _log.warning("html2text import failure: %r", exc)
-        return lambda s: s  # dummy replacement
+class _Blank:
+    pass
+
+
+class HTML2TextConverter(object):
+    """ A configured `html2text.HTML2Text` converter, callable on the HTML
+    text.
+
+    HTML2Text keeps the parsing state in the instance, so each document
+    needs a fresh one; the configured instance is made once, and the
+    per-document ones are copies of its attributes (with new mutable
+    containers), which is cheaper than `__init__` and the config setattrs.
+    """
 
-    obj = html2text.HTML2Text(bodywidth=config.html2text_bodywidth)
-    obj.links_each_paragraph = config.html2text_links_each_paragraph
-    for k, v in config.html2text_etcetera.items():
-        setattr(obj, k, v)
+    def __init__(self, html2text_mod, config):
+        self.html2text_mod = html2text_mod
+        self.strip = config.html2text_strip
+        obj = html2text_mod.HTML2Text(bodywidth=config.html2text_bodywidth)
+        obj.links_each_paragraph = config.html2text_links_each_paragraph
+        for k, v in config.html2text_etcetera.items():
+            setattr(obj, k, v)
+        self.html2text = obj
+        self._mutable = [
+            k for k, v in obj.__dict__.items()
+            if isinstance(v, (list, dict, set))]
 
-    ## postprocess
-    def func(val, *ar, **kwa):
-        res = obj.handle(val, *ar, **kwa)
-        if config.html2text_strip:
+    def new_parser(self):
+        ## `copy.copy` without its generic-protocol overhead (HTML2Text
+        ## is an old-style class in py2).
+        obj = _Blank()
+        obj.__class__ = self.html2text.__class__
+        state = obj.__dict__
+        state.update(self.html2text.__dict__)
+        for k in self._mutable:
+            state[k] = type(state[k])(state[k])
+        obj.out = obj.outtextf
+        return obj
+
+    def __call__(self, val, *ar, **kwa):
+        res = self.new_parser().handle(val, *ar, **kwa)
+        if self.strip:
             res = res.strip()
         return res
 
-    func.html2text_mod = html2text
-    func.html2text = obj
+
+def _html2text_config_key(config):
+    return (
+        config.html2text_bodywidth, config.html2text_links_each_paragraph,
+        config.html2text_strip,
+        repr(sorted(config.html2text_etcetera.items())))
+
+
+_html2text_cache = {}
+
+
+def get_html2text(config):
+    """ The html2text converter function for the config (cached by the
+    relevant config values) """
+    key = _html2text_config_key(config)
+    func = _html2text_cache.get(key)
+    if func is not None:
+        return func
+
+    try:
+        import html2text
+    except Exception, exc:
+        _log.warning("html2text import failure: %r", exc)
+        func = lambda s: s  # dummy replacement
+    else:
+        func = HTML2TextConverter(html2text, config)
+    _html2text_cache[key] = func
     return func
 
 
@@ -70,11 +120,86 @@ def config_email_utf8():
 ## Library-independence for JIDs
 #######
 
+class JID(object):
+    """ A parsed JID: an immutable value object, also usable as a
+    `jid_data` dict (`jid['node']`).
+
+    Use `JID.get` (or `jid_to_data`) rather than the constructor: the
+    instances are interned, so that the same JID seen in every message
+    is one object rather than a new dict each time.
+    """
+    __slots__ = ('node', 'domain', 'resource', '_str')
+
+    _cache = {}
+    _cache_size = 10000
+
+    def __init__(self, node, domain, resource):
+        self.node = node
+        self.domain = domain
+        self.resource = resource
+        self._str = None
+
+    @classmethod
+    def get(cls, node, domain, resource):
+        key = (node or '', domain or '', resource or '')
+        res = cls._cache.get(key)
+        if res is None:
+            if len(cls._cache) >= cls._cache_size:
+                cls._cache.clear()
+            res = cls._cache[key] = cls(*key)
+        return res
+
+    def __getitem__(self, key):
+        if key not in self.__slots__ or key.startswith('_'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in ('node', 'domain', 'resource')
+
+    def keys(self):
+        return ['node', 'domain', 'resource']
+
+    def __eq__(self, other):
+        if isinstance(other, JID):
+            return (self.node, self.domain, self.resource) == (
+                other.node, other.domain, other.resource)
+        if isinstance(other, dict):
+            return (self.node, self.domain, self.resource) == (
+                other.get('node'), other.get('domain'), other.get('resource'))
+        return NotImplemented
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        return res if res is NotImplemented else not res
+
+    def __hash__(self):
+        return hash((self.node, self.domain, self.resource))
+
+    def __str__(self):
+        if self._str is None:
+            self._str = jid_data_to_string(self, resource=bool(self.resource))
+        return self._str
+
+    def __repr__(self):
+        return 'JID(%r)' % (str(self),)
+
+    def __reduce__(self):
+        return (_jid_get, (self.node, self.domain, self.resource))
+
+
+def _jid_get(node, domain, resource):
+    return JID.get(node, domain, resource)
+
+
 def jid_to_data(jid):
     """ ...
 
     :param jid: xmpp.protocol.JID instance or jid_data or string
     """
+    if isinstance(jid, JID):
+        return jid
+
     if isinstance(jid, dict):
         assert 'node' in jid
         assert 'domain' in jid
@@ -85,7 +210,7 @@ def jid_to_data(jid):
         return jid_string_to_data(jid)
 
     ## Probably an xmpp.protocol.JID or equivalent
-    return dict(node=jid.node, domain=jid.domain, resource=jid.resource)
+    return JID.get(jid.node, jid.domain, jid.resource)
 
 
 def jid_data_to_string(jid_data, resource=True):
@@ -116,5 +241,105 @@ def jid_string_to_data(jid_str, strict=True):
     if not m:
         raise ValueError("Malformed JID", jid_str)
     node, domain, resource = m.groups()
-    _pp = lambda v: v or ''
-    return dict(node=_pp(node), domain=_pp(domain), resource=_pp(resource))
+    return JID.get(node, domain, resource)
+
+
+#######
+## Messages passed between the layers
+#######
+
+class MessageData(object):
+    """ A message passed between the transport, the layer and the sinks.
+
+    `to` / `frm` are `JID`s (or strings), `headers` are the extra email
+    headers. `refs` holds the references to the source objects (the
+    xmpppy event, connection, transport), which are never copied.
+
+    `copy()` is shallow and copy-on-write: the body and the subject are
+    immutable strings anyway, and the headers dict is only copied on the
+    first `set_header` / `update_headers` of either copy.
+
+    Also usable as a dict (`msg_data['body']`), for compatibility.
+    """
+    __slots__ = ('to', 'frm', 'body', 'subject', 'type', 'headers', 'refs',
+                 '_headers_shared')
+
+    fields = ('to', 'frm', 'body', 'subject', 'type')
+
+    def __init__(self, to=None, frm=None, body=None, subject=None, type=None,
+                 headers=None, refs=None):
+        self.to = to
+        self.frm = frm
+        self.body = body
+        self.subject = subject
+        self.type = type
+        self.headers = headers
+        self.refs = refs
+        self._headers_shared = False
+
+    def copy(self, **kwa):
+        res = MessageData(
+            to=self.to, frm=self.frm, body=self.body, subject=self.subject,
+            type=self.type, headers=self.headers, refs=self.refs)
+        if self.headers is not None:
+            self._headers_shared = res._headers_shared = True
+        for key, value in kwa.items():
+            setattr(res, key, value)
+        return res
+
+    def _own_headers(self):
+        if self.headers is None:
+            self.headers = {}
+        elif self._headers_shared:
+            self.headers = dict(self.headers)
+        self._headers_shared = False
+        return self.headers
+
+    def set_header(self, name, value):
+        self._own_headers()[name] = value
+
+    def update_headers(self, headers):
+        if headers:
+            self._own_headers().update(headers)
+
+    ## The dict-like interface
+
+    def _check_key(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+
+    def __getitem__(self, key):
+        self._check_key(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        self._check_key(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        if key not in self.fields:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def keys(self):
+        return [key for key in self.fields if getattr(self, key) is not None]
+
+    def as_kwargs(self):
+        """ Keyword arguments for `xmpp.Message` (the JIDs as strings) """
+        res = {}
+        for key in ('to', 'frm', 'body', 'subject', 'typ'):
+            value = getattr(self, 'type' if key == 'typ' else key)
+            if value is None:
+                continue
+            if isinstance(value, (JID, dict)):
+                value = jid_data_to_string(value, resource=bool(value['resource']))
+            res[key] = value
+        return res
+
+    def __repr__(self):
+        return 'MessageData(%s)' % (', '.join(
+            '%s=%r' % (key, getattr(self, key)) for key in self.keys()),)
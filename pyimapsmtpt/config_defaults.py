@@ -19,6 +19,30 @@ use_env = True  ## Allow overriding some settings from os.environ
 #######
 
 db_filename = '.db.json'
+## 'json': the whole file is rewritten on each change.
+## 'sqlite': a SQLite database (WAL mode) with a row per item.
+## 'journal': the changes are appended to `<db_filename>.journal`, which is
+##   merged into the main file once it is `db_journal_compact_size` bytes.
+## None => 'sqlite' if the `db_filename` ends with '.sqlite' / '.sqlite3',
+##   'json' otherwise.
+db_backend = None
+## 'always', 'never' or the minimal interval between fsyncs, in seconds.
+db_journal_fsync = 'always'
+db_journal_compact_size = 1024 * 1024
+## For the 'json' backend: coalesce the writes, saving at most
+## `db_save_delay` seconds after a change, or right away once there are
+## `db_save_max_dirty` unsaved changes (the state is also saved on
+## shutdown). The IMAP progress is saved once per FETCH chunk, so a crash
+## can re-deliver at most `db_save_max_dirty * imap_fetch_chunk_count`
+## messages.
+## Zero / None => save on every change.
+db_save_delay = 0
+db_save_max_dirty = 5
+## The conversations index and the duplicates filter are kept in this
+## SQLite database (a row per item) rather than in the state db.
+## Empty => in the state db (not recommended with the 'json' and
+## 'journal' backends: every change rewrites / re-journals a lot).
+tracking_db_filename = '.db.tracking.sqlite'
 
 ## TODO?: in the transport mode, make those inputable-at-registration?
 
@@ -34,6 +58,78 @@ imap_client_id = 'pyit1'
 ## https://support.google.com/mail/answer/78761?hl=en
 imap_server = "imap.gmail.com:993"
 imap_ssl = True
+## IMAP sync is done in FETCH chunks of at most this many messages
+## and at most this many (RFC822.SIZE) bytes, each chunk being handled
+## (and its progress saved) before the next one is fetched.
+## Falsy value => no limit.
+imap_fetch_chunk_count = 20
+imap_fetch_chunk_size = 8 * 1024 * 1024
+## 'full': FETCH the whole RFC822 messages.
+## 'partial': FETCH the BODYSTRUCTURE first, and then only the headers and
+##   the text part that would be forwarded (see `preferred_format`);
+##   attachments are never downloaded this way.
+imap_fetch_mode = 'full'
+## Use CONDSTORE (RFC 4551) `FETCH ... (CHANGEDSINCE <modseq>)` instead of
+## `SEARCH UID <n>:*` to find the new messages (if the server supports it).
+imap_condstore = False
+## Parse the fetched messages of at least `imap_stream_min_size` bytes
+## while they are being read from the socket (`imap_stream_chunk_size`
+## bytes at a time) instead of reading them into a string first.
+## See 'Memory use' in the README.
+imap_stream_parse = False
+imap_stream_min_size = 256 * 1024
+imap_stream_chunk_size = 64 * 1024
+## How many of the last delivered messages to remember (Message-ID and
+## INTERNALDATE) for recovering from an UIDVALIDITY change.
+imap_delivered_index_size = 500
+## 'single': one long-lived connection that leaves IDLE only to sync
+##   (newer; see also `imap_idle_resync_delay`).
+## 'dual': a separate IDLE connection and a reconnect of the sync
+##   connection on every IDLE event.
+imap_idle_mode = 'dual'
+## What to do when a sync finds more than `imap_sync_msg_limit` new
+## messages (e.g. after an outage):
+## 'truncate': deliver only the latest ones, skip the older ones.
+## 'drain': deliver all of them, oldest first, in `imap_sync_msg_limit`
+##   batches, at most `imap_backlog_rate` messages per second (the
+##   progress is saved as it goes, so a restart resumes mid-backlog).
+## 'digest': deliver the latest ones, and a single per-sender digest
+##   message for the older ones.
+imap_backlog_mode = 'truncate'
+imap_sync_msg_limit = 50
+imap_backlog_rate = 1.0
+## GMail workaround for the 'single' mode: GMail sometimes reports EXISTS
+## in IDLE before the new message is visible to the SEARCH / FETCH on the
+## same connection. If a sync after an IDLE event finds nothing, wait this
+## many seconds, NOOP and sync once again (instead of reconnecting).
+## Only done for the servers with the GMail extensions (X-GM-EXT-1).
+## Zero / None => disabled.
+imap_idle_resync_delay = 1.5
+## Reconnect delays (see `pyimapsmtpt.backoff.Backoff`):
+## `{failure_class: (base_delay, max_delay)}` overrides, for the failure
+## classes 'abort' (connection errors), 'auth' (login failures) and
+## 'error' (anything else).
+imap_reconnect_backoff = {}
+## After this many consecutive failures, wait `..._circuit_timeout`
+## seconds before each further attempt.
+imap_reconnect_circuit_threshold = 10
+imap_reconnect_circuit_timeout = 30 * 60
+
+## Multiple accounts in one process: a list of dicts, each with an unique
+## 'name' and any of the settings to override for the account (usually
+## 'imap_username', 'imap_password', 'smtp_username', 'smtp_password',
+## 'email_address', 'main_jid').
+## All the accounts share the XMPP component connection and the state db
+## (each account has its own namespace in it).
+## The accounts may share the `main_jid`: the transport JIDs carry the
+## account name in the resource ('<name>:<conversation>'), so the replies
+## go out from the account that the email came to; a new message (to a
+## JID without such resource) goes out from the first account.
+## The names should not contain ':' or '/'. The account settings take
+## precedence over the `PIST_*` environment variables.
+## Empty => the single account from the top-level settings.
+imap_accounts = []
+
 smtp_server = "smtp.gmail.com:587"
 smtp_starttls = True
 ## TODO?: support the other smtp stuff
@@ -71,6 +167,37 @@ xmpp_use_route_wrap = False
 ## General library stuff
 #######
 
+# The email -> xmpp pipeline (see `pyimapsmtpt.pipeline`):
+# `{stage_name: (concurrency, queue_size)}` for the stages 'convert' (the
+# email -> xmpp message conversion) and 'send' (the XMPP write).
+# A full queue makes the previous stage (or the IMAP fetching) wait.
+# NOTE: with 'convert' concurrency above 1 the messages might be sent out
+# of order.
+# NOTE: the IMAP progress (`last_uid`) is saved once the messages are
+# queued, not sent: the messages still in the queues are lost (not
+# delivered again after a restart) if the process crashes, or if the
+# stages do not finish them within the stop timeout on a shutdown
+# (`PyIMAPSMTPtWorker.pipeline_stop_timeout`, 5s).
+# At most the sum of the queue sizes plus the stage concurrencies.
+# Empty => everything is done inline in the IMAP greenlet.
+email_pipeline = {}
+# e.g. email_pipeline = {'convert': (2, 20), 'send': (1, 100)}
+
+# Parse and convert the emails in this many worker processes (forked at
+# the start), so that a big email does not stall the IMAP / XMPP
+# connections. For the conversion to use several cores, also set the
+# email_pipeline 'convert' concurrency to at least this.
+# The main process only parses the headers. The messages parsed while
+# being fetched (`imap_stream_parse`) are converted in the main process.
+# Zero => everything is done in the main process.
+email_convert_processes = 0
+
+# Parse only the email headers up front, and a body part only when (and
+# if) it is needed (see `pyimapsmtpt.lazymsg`); `False` => use the
+# `email` module's full parse.
+email_lazy_parse = True
+
+
 # Preferred format for email->xmpp messages
 # 'plaintext' or 'html2text' or 'html'
 preferred_format = 'plaintext'
@@ -81,6 +208,57 @@ preferred_format = 'plaintext'
 prepend_headers = set(('subject', 'to'))  # also: '_always_to', 'from'
 
 
+# Email threads tracking: each thread gets a short token used as the XMPP
+# resource of the sender, so that the XMPP replies get the proper
+# In-Reply-To / References headers.
+# At most `conversation_index_size` threads are remembered (in the state
+# db), `conversation_cache_size` of them are also kept in memory;
+# `conversation_chain_length` is the References length limit.
+conversation_index_size = 10000
+conversation_cache_size = 1000
+conversation_chain_length = 10
+
+
+# Skip the emails that were already forwarded (by Message-ID and a body
+# hash), e.g. after a reconnect, a crash or an UIDVALIDITY change, or
+# for emails in several folders (labels).
+# The `email_dedup_recent_size` latest ones are remembered exactly, the
+# older ones in a Bloom filter of `2 ** email_dedup_bloom_size_log2` bits
+# (saved in the `tracking_db_filename` database); with the defaults, 100k
+# forwarded emails give about one-in-100k chance of a new email being
+# dropped as a duplicate.
+email_dedup = False
+email_dedup_recent_size = 1000
+email_dedup_bloom_size_log2 = 22
+email_dedup_bloom_hashes = 7
+
+
+# Coalesce the bursts (e.g. from a mailing list or a CI system): once more
+# than `email_coalesce_threshold` emails from the same list (by List-Id)
+# or sender come within `email_coalesce_window` seconds, the further ones
+# are held and sent as a single digest XMPP message at the end of the
+# window (or once there are `email_coalesce_max_items` of them). Below
+# the threshold the emails are sent right away.
+# NOTE: the held emails are lost if the process is killed.
+# Zero => disabled.
+email_coalesce_threshold = 0
+email_coalesce_window = 60
+email_coalesce_max_items = 50
+
+
+# Send at most this many bytes (UTF-8) of an email's text in one XMPP
+# message (keep it well below the XMPP server's `max_stanza_size`); the
+# rest is kept in memory (not across restarts), and replying `!more <token>` (the token is
+# given at the end of the message) gets the next part.
+# At most `email_continuation_cache_size` bytes (compressed) of the rests
+# are kept, the oldest ones are dropped first; each rest is cut to
+# `email_continuation_max_size` characters.
+# E.g. 48 * 1024; zero => no limit (everything is sent as it is).
+email_max_body_size = 0
+email_continuation_cache_size = 4 * 1024 * 1024
+email_continuation_max_size = 1024 * 1024
+
+
 # Even less straightforward, for optionally parsing out some email headers
 # from the received XMPP messages.
 # Set this to empty to disable this feature.
@@ -104,6 +282,21 @@ html2text_links_each_paragraph = 1  # h2t's own default is 0
 ## Whatever else thou want to set on it.
 ## see `html2text.config` source (the names generally need to be lowercased)
 html2text_etcetera = {}
+## The HTML -> text engine (see `pyimapsmtpt.htmltext`):
+## 'html2text', 'lxml' (requires lxml; much faster, simpler output) or
+## 'strip' (just drop the tags).
+html2text_engine = 'html2text'
+## The HTML beyond this many characters is dropped (after dropping the
+## style / script elements), and so is the text beyond this many.
+html2text_max_input_size = 1024 * 1024
+html2text_max_output_size = 128 * 1024
+## Seconds of CPU time (the time the other greenlets run meanwhile
+## does not count); a slower conversion is abandoned for the
+## tag-stripping one. Falsy value => no limit.
+html2text_time_budget = 2.0
+## The 'html2text' engine input is fed by this many characters between
+## the time checks (and the other greenlets' turns).
+html2text_chunk_size = 16 * 1024
 
 
 ## These two options, if not None, are used to override some values in the
@@ -12,11 +12,15 @@ config = None
 
 
 class Config(object):
+    """ The settings from the `modules` (the last one wins), the `PIST_*`
+    environment variables (if `use_env`) over them, and the
+    `override_modules` over everything """
 
     _use_env = False
 
-    def __init__(self, modules=None):
+    def __init__(self, modules=None, override_modules=None):
         self._modules = modules or []
+        self._override_modules = override_modules or []
 
     def __getattr__(self, val):
         sup = object.__getattribute__
@@ -25,6 +29,12 @@ class Config(object):
         except AttributeError as exc:
             exc_ = exc
 
+        for mod in reversed(self._override_modules):
+            try:
+                return getattr(mod, val)
+            except AttributeError:
+                pass
+
         if self._use_env:
             res = os.environ.get('PIST_%s' % (val,))
             if res:
@@ -39,6 +49,44 @@ class Config(object):
         raise exc_
 
 
+class _Overrides(object):
+    """ A module-like holder of the overridden config values """
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+def config_with_overrides(config, overrides):
+    """ Make a Config that takes the `overrides` dict values in preference
+    to the `config` values (including the environment ones) """
+    res = Config(
+        list(config._modules),
+        override_modules=list(config._override_modules) + [_Overrides(overrides)])
+    res._use_env = config._use_env
+    res.config_file = getattr(config, 'config_file', None)  # pylint: disable=attribute-defined-outside-init
+    return res
+
+
+def get_account_configs(config):
+    """ Returns `[(account_name, account_config), ...]` as per the
+    `imap_accounts` setting (or the single-account `[(None, config)]`) """
+    accounts = config.imap_accounts
+    if not accounts:
+        return [(None, config)]
+    res = []
+    for account in accounts:
+        if not account.get('name'):
+            raise Exception("Every `imap_accounts` item should have a 'name'")
+        if ':' in account['name'] or '/' in account['name']:
+            ## See `MailJabberLayer.make_resource`
+            raise Exception("The `imap_accounts` names should not contain ':' or '/'")
+        res.append((account['name'], config_with_overrides(config, account)))
+    names = [name for name, _ in res]
+    if len(set(names)) != len(names):
+        raise Exception("The `imap_accounts` names should be unique")
+    return res
+
+
 def get_config(cached=True):
     global config
     if cached and config is not None:
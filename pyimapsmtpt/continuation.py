@@ -0,0 +1,136 @@
+# coding: utf8
+""" Size-budgeted XMPP message bodies.
+
+A long email (e.g. a newsletter) would make a stanza of hundreds of KB,
+which some servers reject (`max_stanza_size`) and which stalls the
+mobile clients. Instead, only the first part of the body is sent; the
+rest is kept in a bounded `ContinuationCache` under a short token, and
+the user gets the next part by replying with the `!more <token>`
+command.
+"""
+
+import os
+import re
+import zlib
+import base64
+from collections import OrderedDict
+
+
+## Case-insensitive: some clients capitalise the first letter.
+_re_command = re.compile(r'^\s*!more(?:\s+([a-z0-9]+))?\s*$', re.I)
+
+
+def parse_command(body):
+    """ Returns the token (or '' for the latest one) if the `body` is a
+    `!more` command, None otherwise """
+    match = _re_command.match(body or u'')
+    if match is None:
+        return None
+    return (match.group(1) or '').lower()
+
+
+def split_body(body, max_size):
+    """ Split the (unicode) `body` into the head of at most `max_size`
+    bytes (UTF-8) and the rest; prefers to split at a line break, or at
+    least at a space, near the limit """
+    if len(body) * 4 <= max_size:  ## Fits whatever the characters are
+        return body, u''
+    data = body.encode('utf-8')
+    if len(data) <= max_size:
+        return body, u''
+    head = data[:max_size].decode('utf-8', 'ignore')
+    ## Only look back a little, not to make the parts too small.
+    min_pos = len(head) * 4 // 5
+    for sep in (u'\n', u' '):
+        pos = head.rfind(sep, min_pos)
+        if pos > 0:
+            head = head[:pos + 1]
+            break
+    return head, body[len(head):]
+
+
+class ContinuationCache(object):
+    """ `token -> the rest of a body`, kept compressed; at most
+    `max_size` (compressed) bytes in total, the least recently used ones
+    are dropped first; each rest is cut to `max_item_size` characters """
+
+    def __init__(self, max_size=4 * 1024 * 1024, max_item_size=1024 * 1024):
+        self.max_size = max_size
+        self.max_item_size = max_item_size
+        self.items = OrderedDict()
+        self.size = 0
+        self.stats = dict(added=0, fetched=0, misses=0, evicted=0, cut=0)
+
+    @staticmethod
+    def make_token():
+        return base64.b32encode(os.urandom(5)).lower()
+
+    def add(self, rest, token=None):
+        """ Store the `rest`; returns its token (a new one, unless given) """
+        if token is None:
+            token = self.make_token()
+        self.stats['added'] += 1
+        if len(rest) > self.max_item_size:
+            self.stats['cut'] += 1
+            rest = rest[:self.max_item_size] + u'\n[...]'
+        data = zlib.compress(rest.encode('utf-8'))
+        old = self.items.pop(token, None)
+        if old is not None:
+            self.size -= len(old)
+        self.items[token] = data
+        self.size += len(data)
+        while self.size > self.max_size and len(self.items) > 1:
+            _, old = self.items.popitem(last=False)
+            self.size -= len(old)
+            self.stats['evicted'] += 1
+        return token
+
+    def pop(self, token):
+        """ The rest stored for the token (or, for an empty token, the
+        latest one); returns `(token, rest)`, `rest` being None if there is
+        none """
+        if not token and self.items:
+            token = next(reversed(self.items))
+        data = self.items.pop(token, None)
+        if data is None:
+            self.stats['misses'] += 1
+            return token, None
+        self.size -= len(data)
+        self.stats['fetched'] += 1
+        return token, zlib.decompress(data).decode('utf-8')
+
+    def __len__(self):
+        return len(self.items)
+
+
+class BodyLimiter(object):
+    """ Cuts the bodies to `max_size` bytes, storing the rest in the
+    `cache` for the `!more` command """
+
+    more_marker = u'\n\n[... %d KB more; reply "!more %s" for the next part]'
+
+    def __init__(self, max_size, cache=None):
+        self.max_size = max_size
+        self.cache = cache if cache is not None else ContinuationCache()
+        self.stats = dict(limited=0)
+
+    def limit(self, body, token=None):
+        """ Returns the `body` (or its head with the continuation marker) """
+        ## Room for the marker itself
+        head, rest = split_body(body, max(self.max_size - 100, 100))
+        if not rest:
+            return body
+        self.stats['limited'] += 1
+        token = self.cache.add(rest, token=token)
+        return head + self.more_marker % (
+            (len(rest.encode('utf-8')) + 1023) // 1024, token)
+
+    def next_part(self, token):
+        """ The next part for the `!more` command (a message text either
+        way) """
+        token, rest = self.cache.pop(token)
+        if rest is None:
+            if token:
+                return u'ERROR: nothing more for %s (it might have expired)' % (token,)
+            return u'ERROR: nothing more'
+        return self.limit(rest, token=token)
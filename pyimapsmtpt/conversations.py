@@ -0,0 +1,141 @@
+# coding: utf8
+""" Email conversations (threads) tracking for the email <-> xmpp
+conversion: a short stable token (used as the XMPP resource) for each
+thread, mapped to the Message-IDs of the thread.
+"""
+
+import base64
+import hashlib
+import logging
+from collections import OrderedDict
+
+from .simpledb import db_batch
+
+
+_log = logging.getLogger(__name__)
+
+
+def _split_msgids(value):
+    """ '<a@b> <c@d>' -> ['<a@b>', '<c@d>'] """
+    if not value:
+        return []
+    return ['<%s>' % (part.strip().strip('<>'),)
+            for part in value.replace('\n', ' ').split('>')
+            if part.strip().strip('<')]
+
+
+def msg_thread_root(msg):
+    """ The Message-ID of the first message of the thread `msg` (an
+    email.Message or a dict of its headers) is in """
+    references = _split_msgids(msg.get('References'))
+    if references:
+        return references[0]
+    in_reply_to = _split_msgids(msg.get('In-Reply-To'))
+    if in_reply_to:
+        return in_reply_to[0]
+    return msg.get('Message-ID')
+
+
+def make_token(message_id, length=10):
+    """ A short, stable, resource-safe token for a Message-ID """
+    digest = hashlib.sha1(message_id.encode('utf-8') if isinstance(
+        message_id, unicode) else message_id).digest()
+    return base64.b32encode(digest)[:length].lower()
+
+
+class ConversationIndex(object):
+    """ `token -> [message_id, ...]` (the thread root first, then the
+    latest `chain_length - 1` messages).
+
+    Persisted in `db` (a dict-like; preferably a SQLiteDB table, where
+    each conversation is a row of its own) with at most `max_size`
+    conversations (the least recently used ones are dropped); the
+    `cache_size` most recently used ones are also kept in memory.
+
+    All the operations are O(1), except for an occasional O(max_size)
+    trimming of the persisted conversations (done in a single `batch()`).
+    """
+
+    def __init__(self, db=None, max_size=10000, cache_size=1000, chain_length=10):
+        if db is None:
+            db = {}
+        self.db = db
+        self.max_size = max_size
+        self.cache_size = cache_size
+        self.chain_length = chain_length
+        self.cache = OrderedDict()
+        ## The LRU order of the persisted conversations.
+        self._seq = max([0] + [item.get('seq', 0) for item in db.values()])
+        ## `len(db)`, without querying it each time
+        self._size = len(db)
+        self.stats = dict(hits=0, misses=0, evicted=0)
+
+    def _touch(self, token, item):
+        self.cache.pop(token, None)
+        self.cache[token] = item
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def get(self, token):
+        """ Message-IDs of the conversation (or None) """
+        item = self.cache.get(token)
+        if item is None:
+            item = self.db.get(token)
+            if item is None:
+                self.stats['misses'] += 1
+                return None
+        self.stats['hits'] += 1
+        self._touch(token, item)
+        return item['chain']
+
+    def add(self, message_id, root=None):
+        """ Add a message to its conversation; returns the token """
+        root = root or message_id
+        token = make_token(root)
+        chain = self.get(token)
+        if chain is None:
+            self._size += 1
+            chain = [root]
+        if message_id not in chain:
+            chain = chain + [message_id]
+        if len(chain) > self.chain_length:
+            chain = chain[:1] + chain[-(self.chain_length - 1):]
+        self._seq += 1
+        item = dict(chain=chain, seq=self._seq)
+        self.db[token] = item
+        self._touch(token, item)
+        self.trim()
+        return token
+
+    def add_msg(self, msg):
+        """ `add` for an email.Message (or a dict of its headers) """
+        message_id = msg.get('Message-ID')
+        if not message_id:
+            return None
+        return self.add(message_id, root=msg_thread_root(msg))
+
+    def trim(self):
+        """ Drop the least recently used conversations once there are
+        noticeably more than `max_size` of them """
+        if self._size <= self.max_size * 1.1:
+            return
+        items = sorted(self.db.items(), key=lambda kv: kv[1].get('seq', 0))
+        drop = items[:len(items) - self.max_size]
+        ## A single save / transaction rather than one per item.
+        with db_batch(self.db):
+            for token, _ in drop:
+                del self.db[token]
+                self.cache.pop(token, None)
+        self._size = len(items) - len(drop)
+        self.stats['evicted'] += len(drop)
+        _log.debug("Dropped %d old conversations", len(drop))
+
+    def reply_headers(self, token):
+        """ Email threading headers for replying into the conversation """
+        chain = self.get(token) if token else None
+        if not chain:
+            if token and token.startswith('<') and token.endswith('>'):
+                ## An older-style Message-ID resource
+                return {'In-Reply-To': token, 'References': token}
+            return {}
+        return {'In-Reply-To': chain[-1], 'References': ' '.join(chain)}
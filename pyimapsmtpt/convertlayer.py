@@ -1,29 +1,101 @@
 # coding: utf8
 
 import re
-from copy import deepcopy
 import logging
+import email.errors
 import email.message
 # pylint: disable=no-name-in-module
 # pylint: disable=import-error
 from email.MIMEText import MIMEText
-from email.Header import decode_header
-from email.Utils import parseaddr as email_parseaddr
+from email.Header import decode_header, make_header
+from email.Utils import parseaddr as email_parseaddr, make_msgid as email_make_msgid
 # pylint: enable=import-error
 # pylint: enable=no-name-in-module
 
-from .common import EventProcessed, get_html2text
+from .coalesce import Coalescer
+from .common import EventProcessed, MessageData, jid_data_to_string
+from .continuation import BodyLimiter, ContinuationCache, parse_command
+from .conversations import ConversationIndex
+from .dedup import DedupFilter, msg_dedup_key
+from .htmltext import HTMLToText
+from . import lazymsg
 
 
 _log = logging.getLogger(__name__)
 
 
+def decode_header_value(value):
+    """ Decode all the RFC 2047 encoded-words of a header value into a
+    unicode string """
+    if value is None:
+        return None
+    try:
+        return unicode(make_header(decode_header(value)))
+    except (LookupError, UnicodeError, email.errors.HeaderParseError):
+        ## An unknown or lying charset; decode what can be decoded.
+        pass
+    try:
+        chunks = decode_header(value)
+    except email.errors.HeaderParseError:
+        return unicode(value, 'utf-8', 'replace')
+    res = []
+    for val, charset in chunks:
+        try:
+            res.append(unicode(val, charset or 'ascii', 'replace'))
+        except LookupError:
+            res.append(unicode(val, 'utf-8', 'replace'))
+    return u' '.join(res)
+
+
+class DecodedHeaders(object):
+    """ A lazily populated view of the decoded headers of an
+    email.Message: each header is decoded (and each address header
+    parsed) at most once per message. Get it with `msg_headers(msg)`. """
+
+    def __init__(self, msg):
+        self.msg = msg
+        self.decoded = {}
+        self.addresses = {}
+
+    def __getitem__(self, name):
+        """ The decoded (unicode) header value, None if there is none """
+        name = name.lower()
+        try:
+            return self.decoded[name]
+        except KeyError:
+            res = self.decoded[name] = decode_header_value(self.msg[name])
+            return res
+
+    def address(self, name):
+        """ The email address (only) from the header, '' if there is none """
+        name = name.lower()
+        try:
+            return self.addresses[name]
+        except KeyError:
+            res = self.addresses[name] = email_parseaddr(self.msg[name])[1]
+            return res
+
+
+def msg_headers(msg):
+    """ The (per-message) DecodedHeaders of the email.Message `msg` """
+    res = getattr(msg, '_x_decoded_headers', None)
+    if res is None:
+        res = msg._x_decoded_headers = DecodedHeaders(msg)
+    return res
+
+
 def msg_get_header(msg, name):
     """ Get a processed header from an email.Message `msg` """
-    val, charset = decode_header(msg[name])[0]
-    if charset:
-        val = unicode(val, charset, 'replace')
-    return val
+    return msg_headers(msg)[name]
+
+
+_re_list_post = re.compile(r'<mailto:([^>?]+)', re.IGNORECASE)
+
+
+def list_post_address(value):
+    """ The posting address from a List-Post header (RFC 2369), if any """
+    match = _re_list_post.search(value or '')
+    return match.group(1).strip() if match else None
 
 
 def extract_headers_from_body(body, preparse_headers):
@@ -86,18 +158,69 @@ def extract_headers_from_body(body, preparse_headers):
     return body_body, headers
 
 
+def copy_msg_data(msg_data):
+    """ A copy of the `msg_data` (MessageData or dict) to modify. Shallow:
+    the values are strings / JIDs, and the references to the source
+    objects must not be copied """
+    if isinstance(msg_data, MessageData):
+        return msg_data.copy()
+    return dict(msg_data)
+
+
 class MailJabberLayer(object):
     """ Logic of converting between email messages and xmpp messages both ways """
 
-    def __init__(self, config, xmpp_sink, smtp_sink, _manager=None):
+    def __init__(self, config, xmpp_sink, smtp_sink, _manager=None, db=None,
+                 dedup_db=None, account=None):
         """ ...
 
         :param xmpp_sink: function(dict) that accepts messages to be sent over XMPP
+        :param db: a persistent dict for the conversations index.
+        :param dedup_db: a persistent dict for the duplicates filter.
+        :param account: the account name (see `make_resource`); None for
+        the single-account setup.
         """
         self.config = config
+        self.account = account
         self.xmpp_sink = xmpp_sink
         self.smtp_sink = smtp_sink
         self._manager = _manager
+        self.conversations = ConversationIndex(
+            db=db,
+            max_size=config.conversation_index_size,
+            cache_size=config.conversation_cache_size,
+            chain_length=config.conversation_chain_length)
+        self.dedup = None
+        if config.email_dedup:
+            self.dedup = DedupFilter(
+                db=dedup_db,
+                recent_db=(
+                    dedup_db.subdict('recent') if dedup_db is not None else None),
+                recent_size=config.email_dedup_recent_size,
+                bloom_size_log2=config.email_dedup_bloom_size_log2,
+                bloom_hashes=config.email_dedup_bloom_hashes)
+        self.body_limiter = None
+        if config.email_max_body_size:
+            self.body_limiter = BodyLimiter(
+                config.email_max_body_size,
+                cache=ContinuationCache(
+                    max_size=config.email_continuation_cache_size,
+                    max_item_size=config.email_continuation_max_size))
+        self.coalescer = None
+        if config.email_coalesce_threshold:
+            self.coalescer = Coalescer(
+                self.send_to_xmpp,
+                window=config.email_coalesce_window,
+                threshold=config.email_coalesce_threshold,
+                max_items=config.email_coalesce_max_items)
+
+    _html2text = None
+
+    @property
+    def html2text(self):
+        if self._html2text is None:
+            self._html2text = HTMLToText(self.config)
+        return self._html2text
 
     def xmpp_to_smtp(self, *ar, **kwa):
         try:
@@ -115,8 +238,18 @@ class MailJabberLayer(object):
         if not msg_data['body']:
             return
 
+        if self.body_limiter is not None:
+            token = parse_command(msg_data['body'])
+            if token is not None:
+                self.reply_more(token, msg_data)  ## raises EventProcessed
+
         jfrom = msg_data['frm']
         jto = msg_data['to']
+        if not jto['node']:
+            ## e.g. a reply to a digest from the transport itself
+            self.reply_with_error(
+                "No email address to send to; write to <address>@%s instead"
+                % (jto['domain'],), msg_data)  ## raises EventProcessed
 
         mto, headers = self.jto_to_mto(jto, msg_data=msg_data)
         mfrom = self.jfrom_to_mfrom(jfrom, msg_data=msg_data)
@@ -135,12 +268,18 @@ class MailJabberLayer(object):
         emsg['To'] = mto
         for k, v in headers.items():
             emsg[k] = v
+        if headers.get('References'):
+            ## Make sure the further replies are threaded after this one.
+            message_id = email_make_msgid()
+            emsg['Message-ID'] = message_id
+            self.conversations.add(
+                message_id, root=headers['References'].split()[0])
 
         return self.smtp_sink(mto, emsg, frm=mfrom, _msg_data=msg_data, _layer=self)
 
     def preprocess_xmpp_incoming(self, msg_data, copy=True, **kwa):
         if copy:
-            msg_data = deepcopy(msg_data)
+            msg_data = copy_msg_data(msg_data)
 
         try:
             res = extract_headers_from_body(
@@ -153,38 +292,107 @@ class MailJabberLayer(object):
 
         res_body, res_headers = res[0], res[1]
         msg_data['body'] = res_body
+        if isinstance(msg_data, MessageData):
+            msg_data.update_headers(res_headers)
         return msg_data, res_headers
 
     def email_to_xmpp(self, msg, **kwa):
+        data = self.email_to_xmpp_data(msg)
+        return self.email_data_to_xmpp(data, msg=msg, **kwa)
+
+    thread_header_names = ('Message-ID', 'References', 'In-Reply-To')
+    ## The emails with the same one (or, lacking it, the same sender)
+    ## are coalesced together.
+    group_header_names = ('List-Id', 'List-Post')
+
+    def email_to_xmpp_data(self, msg):
+        """ The stateless (and CPU-heavy) part of `email_to_xmpp`: parse
+        and convert the email. Returns a compact picklable dict (so that
+        this can be done in another process). """
+        if isinstance(msg, lazymsg.LazyMessage) and not self.config.email_lazy_parse:
+            msg = msg.as_string()  ## The raw message, for the full parse
         if not isinstance(msg, email.message.Message):
-            _log.warning("`msg` is not an email.message.Message: %r,  %r", type(msg), msg)
-            msg = email.message_from_string(msg)
+            msg = lazymsg.message_from_string(
+                msg, lazy=self.config.email_lazy_parse)
 
         if self.config.dump_protocol:
             _log.info('RECEIVING: %r', msg.as_string())
 
-        mfrom = email_parseaddr(msg['From'])[1]
+        headers = msg_headers(msg)
+        mfrom = headers.address('from')
         ## XXXX: re-check this
-        mto_base = msg['Envelope-To'] or msg['To']
-        mto = email_parseaddr(mto_base)[1]
-
-        ## XXXX/TODO: use `Message-id` or similar for resource (and
-        ##   parse it in incoming messages)? Might have to also send
-        ##   status updates for those.
-        jfrom = self.mfrom_to_jfrom(mfrom, msg=msg)
-        jto = self.mto_to_jto(mto, msg=msg)
+        mto = headers.address('envelope-to' if msg['Envelope-To'] else 'to')
 
-        subject = msg_get_header(msg, 'subject')
+        subject = headers['subject']
 
-        jmsg_data = dict(to=jto, frm=jfrom, subject=subject)
+        jmsg_data = dict(subject=subject)
 
-        body_dict = self.message_to_body(msg)
+        ## Selected once for both the body and the duplicates key.
+        part = self.message_part_select(msg)
+        body_dict = self.message_to_body(msg, _part=part)
         jmsg_data.update(body_dict)
 
         jmsg_data = self.postprocess_xmpp_outgoing(
             jmsg_data, msg=msg, copy=False)
 
-        self.xmpp_sink(jmsg_data, _email_msg=msg, _layer=self)
+        return dict(
+            mfrom=mfrom, mto=mto, jmsg_data=jmsg_data,
+            ## For the conversations
+            headers={name: msg[name]
+                     for name in self.thread_header_names + self.group_header_names
+                     if msg[name]},
+            dedup_key=(
+                msg_dedup_key(msg, text_part=part)
+                if self.dedup is not None else None))
+
+    def email_data_to_xmpp(self, data, msg=None, **kwa):
+        """ The stateful part of `email_to_xmpp`: check for duplicates,
+        track the conversation, send the result of `email_to_xmpp_data`.
+        Returns False for a skipped duplicate. """
+        dedup_key = data['dedup_key']
+        if dedup_key is not None and self.dedup.check(dedup_key):
+            _log.info("Skipping a duplicate email: %r (%s)",
+                      data['headers'].get('Message-ID'), dedup_key)
+            return False
+
+        jfrom = self.mfrom_to_jfrom(data['mfrom'], msg=data['headers'])
+        jto = self.mto_to_jto(data['mto'], msg=data['headers'])
+
+        jmsg_data = data['jmsg_data']
+        jmsg_data = MessageData(
+            to=jto, frm=jfrom, body=jmsg_data['body'],
+            subject=jmsg_data.get('subject'))
+
+        if self.coalescer is not None:
+            group, digest_frm = self.coalesce_group(data)
+            self.coalescer.put(
+                group, jmsg_data, digest_frm=digest_frm, _email_msg=msg, _layer=self)
+        else:
+            self.send_to_xmpp(jmsg_data, _email_msg=msg, _layer=self)
+        if dedup_key is not None:
+            self.dedup.add(dedup_key)
+        return True
+
+    def coalesce_group(self, data):
+        """ The coalescing group of an email (`email_to_xmpp_data` result)
+        and the sender JID for the group's digests: the mailing list's
+        posting address (or, lacking that, the transport itself, as a
+        reply should not go to whoever posted last), or the sender
+        without a conversation """
+        list_id = data['headers'].get('List-Id')
+        if not list_id:
+            return data['mfrom'], self.mfrom_to_jfrom(data['mfrom'])
+        list_post = list_post_address(data['headers'].get('List-Post'))
+        if list_post:
+            return list_id, self.mfrom_to_jfrom(list_post)
+        return list_id, self.config.xmpp_component_jid
+
+    def send_to_xmpp(self, jmsg_data, **kwa):
+        """ `xmpp_sink` for the converted emails: applies the body size
+        budget (see `pyimapsmtpt.continuation`) """
+        if self.body_limiter is not None and jmsg_data['body']:
+            jmsg_data['body'] = self.body_limiter.limit(jmsg_data['body'])
+        return self.xmpp_sink(jmsg_data, **kwa)
 
     def message_part_select(self, top_msg, **kwa):
         """ Get a suitable submessage from the whole email message.
@@ -238,8 +446,14 @@ class MailJabberLayer(object):
 
         return msg
 
-    def message_to_body(self, top_msg, **kwa):
-        msg = self.message_part_select(top_msg, **kwa)
+    def message_to_body(self, top_msg, _part=None, **kwa):
+        """ ...
+
+        :param _part: the already selected (`message_part_select`) part.
+        """
+        msg = _part
+        if msg is None:
+            msg = self.message_part_select(top_msg, **kwa)
         ## TODO?: annotate the message with all multiparts' content-types
         if not msg:
             _log.warning("Could not extract anything from a message: %r", top_msg.as_string())
@@ -251,9 +465,8 @@ class MailJabberLayer(object):
         # check for `msg.get_content_subtype() == 'html'` instead?
         if 'text/html' in msg.get_content_type():
             if self.config.preferred_format != 'html':
-                log("msg: doing html2text")
-                html2text = get_html2text(self.config)
-                body = html2text(body)
+                _log.debug("msg: doing html2text")
+                body = self.html2text(body)
             # TODO: else compose an XMPP-HTML message? Will require a
             # complicated preprocessor like bs4 though
 
@@ -261,24 +474,26 @@ class MailJabberLayer(object):
 
     def postprocess_xmpp_outgoing(self, jmsg_data, msg, copy=True, **kwa):
         if copy:
-            jmsg_data = deepcopy(jmsg_data)
+            jmsg_data = copy_msg_data(jmsg_data)
         prepend_headers = set(self.config.prepend_headers)
+        headers = msg_headers(msg)
         body = jmsg_data['body']
         prepend = []
         force_prepend = False
         if 'to' in prepend_headers:
             force_prepend = True
-            to_ = msg_get_header(msg, 'to')
-            envelope_to = msg_get_header(msg, 'envelope-to')
+            to_ = headers['to']
+            envelope_to = headers['envelope-to']
             ## Only prepend if it's not the current recipient, basically.
+            ## NOTE: a missing Envelope-To counts as a different one.
             if ('_always_to' not in prepend_headers
-                    and envelope_to and to_ != envelope_to):
+                    and envelope_to != u'' and to_ != envelope_to):
                 prepend.append(u'To: %s' % (to_,))
         if 'from' in prepend_headers:
-            prepend.append(u'From: %s' % (msg_get_header(msg, 'from'),))
+            prepend.append(u'From: %s' % (headers['from'],))
         if 'subject' in prepend_headers:
             subject = jmsg_data.pop('subject', None)
-            subject = subject or msg_get_header(msg, 'subject')
+            subject = subject or headers['subject']
             prepend.append(u'Subject: %s' % (subject,))
 
         if prepend or force_prepend:
@@ -290,15 +505,40 @@ class MailJabberLayer(object):
     def mfrom_to_jfrom(self, mfrom, msg=None, **kwa):
         """ Overridable method for converting email's 'From' to xmpp's 'from'
         """
-        ## The Transport way: email@transport/message-id
+        if mfrom.rsplit('@', 1)[-1] == self.config.xmpp_component_jid:
+            ## The transport's own messages (e.g. the IMAP backlog digest)
+            return self.config.xmpp_component_jid
+        ## The Transport way: email@transport/conversation-token
         res = '%s@%s' % (mfrom.replace('@', '%'), self.config.xmpp_component_jid)
+        token = None
         if msg is not None:
-            ## XXXX: in a better case, this would be a more consistent
-            ## conversation-id with a storage for conversation_id <->
-            ## last_message_id
-            res = '%s/%s' % (res, msg['Message-ID'])
+            token = self.conversations.add_msg(msg)
+        resource = self.make_resource(token)
+        if resource:
+            res = '%s/%s' % (res, resource)
         return res
 
+    def make_resource(self, token=None):
+        """ The transport JID resource: the conversation token, prefixed
+        with `<account>:` with multiple accounts (so that the replies are
+        routed to the account that the email came from) """
+        if self.account is None:
+            return token
+        return '%s:%s' % (self.account, token or '')
+
+    def owns_resource(self, resource):
+        """ Whether the transport JID `resource` was made by this layer
+        (the multiple accounts setup only) """
+        return (self.account is not None and bool(resource)
+                and resource.startswith('%s:' % (self.account,)))
+
+    def resource_token(self, resource):
+        """ The conversation token of a `make_resource` result (or of a
+        manually written resource, e.g. '<message-id>') """
+        if self.owns_resource(resource):
+            return resource.split(':', 1)[1] or None
+        return resource
+
     def jto_to_mto(self, jto, msg_data=None, **kwa):
         """ ...
 
@@ -306,13 +546,12 @@ class MailJabberLayer(object):
 
         returns: (mto, extra_email_headers)
         """
-        ## The transport way: email@transport/message-id
+        ## The transport way: email@transport/conversation-token
         mto = jto['node'].replace('%', '@')
-        ## TODO?: e-mail conversation tracking (reply-to):
-        ## support message-id in the resource
-        ## (make sure to set it in a validable way, e.g. '.../msgid-%(base64(message_id))')
         ## see also `self.mfrom_to_jfrom`
-        return mto, {}
+        headers = self.conversations.reply_headers(
+            self.resource_token(jto['resource']))
+        return mto, headers
 
     def mto_to_jto(self, mto, **kwa):
         """ Overridable method for converting email's 'To' to xmpp's 'to' """
@@ -346,10 +585,22 @@ class MailJabberLayer(object):
         ## TODO: correct XMPP error message (requires error events support
         ## from the sink)
         body = 'ERROR: %s' % (error,)
-        jmsg_data = dict(to=msg_data['frm'], frm=msg_data['to'], body=body)
+        jmsg_data = MessageData(to=msg_data['frm'], frm=msg_data['to'], body=body)
         self.xmpp_sink(jmsg_data, _layer=self)
         raise EventProcessed("replied with error")
 
+    def reply_more(self, token, msg_data):
+        """ Reply to the `!more` command with the next part of a long
+        message; only the account's own `main_jid` gets any """
+        sender = jid_data_to_string(msg_data['frm'], resource=False)
+        if sender != self.config.main_jid:
+            _log.warning("Ignoring a '!more' command from %r", sender)
+            raise EventProcessed("ignored a command from a stranger")
+        body = self.body_limiter.next_part(token)
+        jmsg_data = MessageData(to=msg_data['frm'], frm=msg_data['to'], body=body)
+        self.xmpp_sink(jmsg_data, _layer=self)
+        raise EventProcessed("replied with the continuation")
+
 
 ## TODO: The bot-version of the MailJabberLayer (probably dependent on
 ## resources handling, and with 'from' in config.prepend_headers)
@@ -0,0 +1,202 @@
+# coding: utf8
+""" Duplicate email delivery suppression.
+
+The same email can come from IMAP more than once: reconnects, a crash
+between the delivery and the `last_uid` save, UIDVALIDITY resets, or the
+mail being copied into several folders (labels). Each email gets a key
+(the Message-ID plus a hash of the body) that is remembered in:
+
+ * an exact LRU of the `recent_size` latest keys;
+ * a Bloom filter (fixed size, probabilistic) for everything older.
+
+Both are persisted, preferably in a SQLiteDB (see `tracking_db_filename`):
+the recent keys a row each (so that an addition writes a single key), the
+Bloom filter as a single item, saved every `save_interval` additions.
+"""
+
+import zlib
+import base64
+import hashlib
+import logging
+from collections import OrderedDict
+
+from .simpledb import db_batch
+
+
+_log = logging.getLogger(__name__)
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8', 'replace')
+    return value or ''
+
+
+def _first_text_part(msg):
+    for part in msg.walk():
+        if not part.is_multipart() and part.get_content_maintype() == 'text':
+            return part
+    return None
+
+
+def msg_dedup_key(msg, text_part=None):
+    """ A key for an email.Message: its Message-ID (or, lacking that, a
+    few other headers) plus the hash of the text part (`text_part`, or
+    the first one); the attachments are never looked at, and the text is
+    hashed as is (not decoded) """
+    if text_part is None:
+        text_part = _first_text_part(msg)
+    body_hash = hashlib.sha1()
+    if text_part is not None:
+        body_hash.update(_to_bytes(text_part.get_payload()))
+    message_id = msg['Message-ID']
+    if not message_id:
+        message_id = '\0'.join(
+            _to_bytes(msg[name]) for name in ('From', 'Date', 'Subject'))
+    key = hashlib.sha1(_to_bytes(message_id.strip()))
+    key.update('\0')
+    key.update(body_hash.digest())
+    return key.hexdigest()[:24]
+
+
+class BloomFilter(object):
+    """ A plain Bloom filter over `2 ** size_log2` bits with `hashes` bit
+    positions per key (taken from a sha1 of the key) """
+
+    def __init__(self, size_log2=22, hashes=7, data=None):
+        assert hashes <= 9, "sha1 has bits for at most 9 positions"
+        self.size_log2 = size_log2
+        self.hashes = hashes
+        self.mask = (1 << size_log2) - 1
+        if data is None:
+            data = bytearray(1 << max(size_log2 - 3, 0))
+        self.bits = data
+
+    def _positions(self, key):
+        digest = hashlib.sha1(key).digest()
+        for idx in range(self.hashes):
+            chunk = digest[idx * 2:idx * 2 + 4]
+            value = ((ord(chunk[0]) << 24) | (ord(chunk[1]) << 16) |
+                     (ord(chunk[2]) << 8) | ord(chunk[3]))
+            yield value & self.mask
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def dumps(self):
+        return base64.b64encode(zlib.compress(bytes(self.bits)))
+
+    @classmethod
+    def loads(cls, value, size_log2=22, hashes=7):
+        data = bytearray(zlib.decompress(base64.b64decode(value)))
+        if len(data) != 1 << max(size_log2 - 3, 0):
+            raise ValueError("Bloom filter size mismatch")
+        return cls(size_log2=size_log2, hashes=hashes, data=data)
+
+
+class DedupFilter(object):
+    """ Remembers the delivered emails' keys (see `msg_dedup_key`).
+
+    The recent keys are saved in `recent_db` (`key -> sequence number`)
+    on each `add`; the Bloom filter (in `db`) only every `save_interval`
+    additions (it is large), which is safe as long as
+    `save_interval <= recent_size`: whatever is not in the saved filter
+    yet is still in the saved recent keys.
+    """
+
+    def __init__(self, db=None, recent_db=None, recent_size=1000,
+                 bloom_size_log2=22, bloom_hashes=7, save_interval=None):
+        if db is None:
+            db = {}
+        if recent_db is None:
+            recent_db = {}
+        self.db = db
+        self.recent_db = recent_db
+        self.recent_size = recent_size
+        if save_interval is None:
+            save_interval = max(recent_size // 2, 1)
+        self.save_interval = min(save_interval, recent_size)
+        self.bloom_size_log2 = bloom_size_log2
+        self.bloom_hashes = bloom_hashes
+        self.stats = dict(
+            checked=0, added=0, duplicates=0,
+            duplicates_recent=0, duplicates_bloom=0)
+
+        self.bloom = None
+        saved = db.get('bloom')
+        if saved:
+            try:
+                self.bloom = BloomFilter.loads(
+                    saved, size_log2=bloom_size_log2, hashes=bloom_hashes)
+            except Exception as exc:
+                _log.warning("Could not load the dedup filter, starting anew: %r", exc)
+        if self.bloom is None:
+            self.bloom = BloomFilter(size_log2=bloom_size_log2, hashes=bloom_hashes)
+
+        items = sorted(recent_db.items(), key=lambda item: item[1])
+        self._seq = items[-1][1] if items else 0
+        old_recent = db.get('recent')
+        if old_recent:  ## The older whole-list format
+            items.extend(
+                (key, self._seq + idx) for idx, key in enumerate(old_recent, 1))
+            self._seq += len(old_recent)
+        self.recent = OrderedDict(items)
+        ## Also re-add the keys that might have missed the last filter save.
+        for key in self.recent:
+            self.bloom.add(key)
+        self._unsaved = 0
+        if old_recent:
+            with db_batch(recent_db):
+                recent_db.update(self.recent)
+            del db['recent']
+        self._trim_recent()
+
+    def check(self, key):
+        """ True if the key was (probably) seen already """
+        self.stats['checked'] += 1
+        if key in self.recent:
+            self.stats['duplicates'] += 1
+            self.stats['duplicates_recent'] += 1
+            return True
+        if key in self.bloom:
+            self.stats['duplicates'] += 1
+            self.stats['duplicates_bloom'] += 1
+            return True
+        return False
+
+    def add(self, key):
+        self.stats['added'] += 1
+        self.bloom.add(key)
+        self._seq += 1
+        self.recent.pop(key, None)
+        self.recent[key] = self._seq
+        with db_batch(self.recent_db):
+            self.recent_db[key] = self._seq
+            self._trim_recent()
+        self._unsaved += 1
+        if self._unsaved >= self.save_interval:
+            self.save_bloom()
+
+    def _trim_recent(self):
+        with db_batch(self.recent_db):
+            while len(self.recent) > self.recent_size:
+                key, _ = self.recent.popitem(last=False)
+                self.recent_db.pop(key, None)
+
+    def save_bloom(self):
+        self.db['bloom'] = self.bloom.dumps()
+        self._unsaved = 0
+
+    def check_msg(self, msg):
+        """ `check` for an email.Message; returns `(is_duplicate, key)` """
+        key = msg_dedup_key(msg)
+        return self.check(key), key
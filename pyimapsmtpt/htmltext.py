@@ -0,0 +1,238 @@
+# coding: utf8
+""" HTML -> text conversion for the `preferred_format = 'html2text'`.
+
+Engines (the `html2text_engine` setting):
+
+ * 'html2text': the `html2text` library (markdown-ish output; pure
+   python, can be very slow on some HTML).
+ * 'lxml': a simpler conversion over the `lxml` parser (optional
+   dependency; much faster).
+ * 'strip': just strip the tags (`strip_tags`).
+
+`HTMLToText` wraps the engine with the input / output size caps and a
+CPU time budget, falling back to `strip_tags` when the budget runs out.
+"""
+
+import re
+import time
+import logging
+import HTMLParser
+
+import gevent
+
+from .common import get_html2text
+
+
+_log = logging.getLogger(__name__)
+
+
+class ConversionTimeout(Exception):
+    """ The HTML conversion took longer than its time budget """
+
+
+class TimeBudget(object):
+    """ The CPU time of a conversion; only its own slices count, not the
+    time the other greenlets (or processes) run meanwhile """
+
+    def __init__(self, seconds):
+        self.left = seconds
+        self._start = time.clock()
+
+    def check(self):
+        now = time.clock()
+        self.left -= now - self._start
+        self._start = now
+        if self.left < 0:
+            raise ConversionTimeout()
+
+    def sleep(self):
+        """ `check`, then let the other greenlets run (off the budget) """
+        self.check()
+        gevent.sleep(0)
+        self._start = time.clock()
+
+
+def _check_budget(budget):
+    if budget is not None:
+        budget.check()
+
+
+_re_comment = re.compile(r'(?s)<!--.*?-->')
+_re_drop = re.compile(r'(?is)<(script|style|head)\b.*?</\1\s*>')
+_re_block = re.compile(r'(?i)</?(?:br|p|div|tr|li|h[1-6]|table|blockquote|pre)\b[^>]*>')
+_re_tag = re.compile(r'(?s)<[^>]*>')
+_re_spaces = re.compile(r'[ \t\r\f\v]+')
+_re_blank_lines = re.compile(r'\n\s*\n\s*\n+')
+
+_unescape = HTMLParser.HTMLParser().unescape
+
+
+def _normalize_space(text):
+    text = _re_spaces.sub(u' ', text)
+    text = u'\n'.join(line.strip() for line in text.split(u'\n'))
+    return _re_blank_lines.sub(u'\n\n', text).strip()
+
+
+def drop_invisible(html):
+    """ Remove the comments and the script / style / head elements """
+    return _re_drop.sub(u'', _re_comment.sub(u'', html))
+
+
+def strip_tags(html, budget=None):
+    """ The crude but linear-time conversion: drop the tags, keep the
+    text (and the line breaks of the block elements) """
+    text = _re_block.sub(u'\n', drop_invisible(html))
+    text = _unescape(_re_tag.sub(u'', text))
+    return _normalize_space(text)
+
+
+def html2text_engine(config):
+    """ The `html2text` library engine; feeds the parser in chunks to
+    check the budget and to let the other greenlets run """
+    converter = get_html2text(config)
+    if not hasattr(converter, 'new_parser'):  ## html2text is not available
+        return None
+    chunk_size = config.html2text_chunk_size
+
+    def convert(html, budget=None):
+        parser = converter.new_parser()
+        for pos in xrange(0, len(html), chunk_size):
+            parser.feed(html[pos:pos + chunk_size])
+            if budget is not None:
+                budget.sleep()
+            else:
+                gevent.sleep(0)
+        ## The same as the end of `HTML2Text.handle`
+        parser.feed(u'')
+        res = parser.optwrap(parser.close())
+        if getattr(parser, 'pad_tables', False):
+            res = converter.html2text_mod.pad_tables_in_text(res)
+        if converter.strip:
+            res = res.strip()
+        return res
+
+    return convert
+
+
+_lxml_block_tags = frozenset((
+    'p', 'div', 'table', 'tr', 'ul', 'ol', 'dl', 'dt', 'dd', 'blockquote',
+    'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'section', 'article',
+    'header', 'footer', 'form'))
+_lxml_skip_tags = frozenset(('script', 'style', 'head', 'title'))
+
+
+def lxml_engine(config):
+    """ A simple converter over the `lxml` parser: the text with the line
+    breaks of the block elements, list items marked, the link URLs after
+    the link texts """
+    try:
+        import lxml.etree
+        import lxml.html
+    except Exception as exc:
+        _log.warning("lxml import failure: %r", exc)
+        return None
+
+    check_every = 1000
+
+    def convert(html, budget=None):
+        if isinstance(html, unicode):
+            html = html.encode('utf-8')
+        parser = lxml.html.HTMLParser(encoding='utf-8', huge_tree=True)
+        try:
+            doc = lxml.html.document_fromstring(html, parser=parser)
+        except lxml.etree.ParserError:  ## e.g. an empty document
+            return strip_tags(html.decode('utf-8'))
+        _check_budget(budget)
+        out = []
+        skip = 0
+        for idx, (event, el) in enumerate(
+                lxml.etree.iterwalk(doc, events=('start', 'end'))):
+            if idx % check_every == 0:
+                _check_budget(budget)
+            tag = el.tag if isinstance(el.tag, basestring) else None
+            if event == 'start':
+                if tag in _lxml_skip_tags:
+                    skip += 1
+                if skip:
+                    continue
+                if tag in _lxml_block_tags:
+                    out.append(u'\n\n' if tag == 'p' else u'\n')
+                elif tag == 'br':
+                    out.append(u'\n')
+                elif tag == 'li':
+                    out.append(u'\n* ')
+                if tag is not None and el.text:
+                    out.append(el.text)
+            else:
+                if tag in _lxml_skip_tags:
+                    skip -= 1
+                if skip:
+                    continue
+                if tag == 'a':
+                    href = el.get('href')
+                    if href and not href.startswith('#') and href != el.text_content().strip():
+                        out.append(u' <%s>' % (href,))
+                elif tag in _lxml_block_tags:
+                    out.append(u'\n')
+                elif tag == 'td':
+                    out.append(u' ')
+                if el.tail:
+                    out.append(el.tail)
+        return _normalize_space(u''.join(out))
+
+    return convert
+
+
+engines = {
+    'html2text': html2text_engine,
+    'lxml': lxml_engine,
+    'strip': lambda config: strip_tags,
+}
+
+
+class HTMLToText(object):
+    """ The configured HTML -> text conversion, callable on the HTML
+    (unicode) text """
+
+    truncated_marker = u'\n[...]'
+
+    def __init__(self, config):
+        self.engine_name = config.html2text_engine
+        self.engine = engines[self.engine_name](config)
+        if self.engine is None:
+            _log.warning("HTML engine %r is not available, using 'strip'",
+                         self.engine_name)
+            self.engine_name = 'strip'
+            self.engine = strip_tags
+        self.max_input_size = config.html2text_max_input_size
+        self.max_output_size = config.html2text_max_output_size
+        self.time_budget = config.html2text_time_budget
+        self.stats = dict(
+            converted=0, fallbacks=0, input_truncated=0, output_truncated=0,
+            time_max=0.0)
+
+    def __call__(self, html):
+        start = time.time()
+        if self.max_input_size and len(html) > self.max_input_size:
+            ## Huge HTML is mostly CSS; try to keep the whole text.
+            html = drop_invisible(html)
+            if len(html) > self.max_input_size:
+                self.stats['input_truncated'] += 1
+                html = html[:self.max_input_size]
+
+        budget = TimeBudget(self.time_budget) if self.time_budget else None
+        try:
+            res = self.engine(html, budget=budget)
+        except ConversionTimeout:
+            _log.warning("HTML conversion (%s) took over %.1fs of CPU, stripping the tags instead",
+                         self.engine_name, self.time_budget)
+            self.stats['fallbacks'] += 1
+            res = strip_tags(html)
+
+        if self.max_output_size and len(res) > self.max_output_size:
+            self.stats['output_truncated'] += 1
+            res = res[:self.max_output_size] + self.truncated_marker
+
+        self.stats['converted'] += 1
+        self.stats['time_max'] = max(self.stats['time_max'], time.time() - start)
+        return res
@@ -2,15 +2,34 @@
 # coding: utf8
 
 import os
+import re
 import sys
+import time
+import datetime
 import logging
 import email
+import socket
 import imaplib
 import imapclient
+from cStringIO import StringIO
+from email.generator import Generator
+from email.feedparser import FeedParser
 from threading import Event
+from collections import OrderedDict
+# pylint: disable=no-name-in-module
+# pylint: disable=import-error
+from email.MIMEText import MIMEText
+from email.Utils import (
+    parseaddr as email_parseaddr, formataddr as email_formataddr,
+    make_msgid as email_make_msgid)
+# pylint: enable=import-error
+# pylint: enable=no-name-in-module
 
 from .common import to_bytes, config_email_utf8
+from .convertlayer import decode_header_value
 from . import simpledb
+from . import lazymsg
+from .backoff import Backoff
 
 _log = logging.getLogger(__name__)
 
@@ -65,6 +84,56 @@ def _imaplib_add_id_logging(logger, cls=imaplib.IMAP4_SSL):
     cls.readline = _readline_dbg
 
 
+# ######
+# Streaming parse of the fetched messages
+# ######
+
+class ParsedLiteral(object):
+    """ Stands for an IMAP literal (of `size` bytes) that was parsed into
+    the email.Message `message` while being read, instead of being kept
+    as a string """
+
+    def __init__(self, message, size):
+        self.message = message
+        self.size = size
+
+    def __len__(self):  ## imapclient checks the literal size
+        return self.size
+
+    def __repr__(self):
+        return '<ParsedLiteral of %d bytes>' % (self.size,)
+
+
+## The imaplib's current response line for a whole-message literal
+_re_message_literal = re.compile(r'(?:RFC822|BODY(?:\.PEEK)?\[\])\s*\{\d+\}$', re.I)
+
+
+def imaplib_stream_parse(imap, min_size=256 * 1024, chunk_size=64 * 1024):
+    """ Make the `imap` (imaplib.IMAP4 instance) feed the whole-message
+    literals of at least `min_size` bytes into an `email.feedparser`
+    `chunk_size` bytes at a time as they are read from the socket, and
+    return a `ParsedLiteral` in their place. The complete raw message
+    string is never built. """
+    read_orig = imap.read
+
+    def read(size):
+        mo = getattr(imap, 'mo', None)  ## imaplib's `Literal` match
+        if (size < min_size or mo is None or
+                not _re_message_literal.search(mo.string)):
+            return read_orig(size)
+        parser = FeedParser()
+        remaining = size
+        while remaining:
+            chunk = read_orig(min(remaining, chunk_size))
+            if not chunk:
+                raise imap.abort("EOF within a literal")
+            parser.feed(chunk)
+            remaining -= len(chunk)
+        return ParsedLiteral(parser.close(), size)
+
+    imap.read = read
+
+
 def config_to_clikwa(config):
     # client_id = 'pyit1'
     server = config.imap_server
@@ -86,15 +155,198 @@ def config_to_clikwa(config):
     return cli_kwa
 
 
+class LoginError(imaplib.IMAP4.error):
+    """ IMAP LOGIN failed (as opposed to a connection error) """
+
+
+def classify_failure(exc):
+    """ Failure class (as per `backoff.Backoff` policies) of an exception
+    from the IMAP client """
+    if isinstance(exc, LoginError):
+        return 'auth'
+    if isinstance(exc, (imaplib.IMAP4.abort, socket.error, IOError)):
+        return 'abort'
+    return 'error'
+
+
 def get_imapcli(username, password, server, port=None, cls=imapclient.IMAPClient, **kwa):
     imapcli = cls(server, port, **kwa)
 
-    lr = imapcli.login(username, password)
+    try:
+        lr = imapcli.login(username, password)
+    except imaplib.IMAP4.abort:
+        raise
+    except imaplib.IMAP4.error as exc:
+        raise LoginError(*exc.args)
     _log.debug("IMAP Login res: %r", lr)
 
     return imapcli
 
 
+def chunk_msgids(msgids, sizes=None, max_count=None, max_size=None):
+    """ Split `msgids` into lists of at most `max_count` messages with at
+    most `max_size` total size (as per `sizes`, a `{msgid: size}` dict).
+
+    A message bigger than `max_size` gets a chunk of its own.
+    """
+    sizes = sizes or {}
+    chunk = []
+    chunk_size = 0
+    for msgid in msgids:
+        size = sizes.get(msgid) or 0
+        if chunk and (
+                (max_count and len(chunk) >= max_count) or
+                (max_size and chunk_size + size > max_size)):
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append(msgid)
+        chunk_size += size
+    if chunk:
+        yield chunk
+
+
+def _bodystructure_select(bodystructure, preferred_format, section=(),
+                          _recurse_limit=5):
+    """ The BODYSTRUCTURE version of the
+    `MailJabberLayer.message_part_select` logic.
+
+    Returns `(section, content_type)` or None """
+    part_plain = part_html = None
+    for idx, part in enumerate(bodystructure[0], 1):
+        part_section = section + (idx,)
+        if part.is_multipart:
+            if _recurse_limit <= 0:
+                continue
+            res = _bodystructure_select(
+                part, preferred_format, part_section,
+                _recurse_limit=_recurse_limit - 1)
+            if res is None:
+                continue
+        else:
+            ctype = '%s/%s' % (part[0], part[1])
+            res = (part_section, ctype.lower())
+
+        if res[1] == 'message/rfc822':
+            ## Too complicated to mirror; have the whole message fetched.
+            raise ValueError("Nested message")
+        if 'text/html' in res[1]:
+            part_html = res
+        elif 'text/plain' in res[1]:
+            part_plain = res
+
+    if preferred_format == 'plaintext':
+        return part_plain or part_html
+    return part_html or part_plain
+
+
+def bodystructure_select(bodystructure, preferred_format):
+    """ Find the section (e.g. '1.2') of the part that
+    `MailJabberLayer.message_part_select` would pick from the message with
+    the `bodystructure` (imapclient's BodyData).
+
+    Returns None if the whole message should be used instead.
+    """
+    if not bodystructure.is_multipart:
+        return None
+    try:
+        res = _bodystructure_select(bodystructure, preferred_format)
+    except ValueError:
+        return None
+    if res is None:
+        return None
+    return '.'.join(str(idx) for idx in res[0])
+
+
+## Headers that are taken from the selected part in `build_partial_message`
+_part_header_names = (
+    'Content-Type', 'Content-Transfer-Encoding', 'Content-Disposition')
+
+
+def build_partial_message(header, part_header, part_body):
+    """ Make a single-part message (as a string) out of the top-level
+    message headers and a part of it (its MIME headers and its
+    still-transfer-encoded body) """
+    msg = email.message_from_string(to_bytes(header))
+    part = email.message_from_string(to_bytes(part_header) + to_bytes(part_body))
+    for name in _part_header_names:
+        del msg[name]
+        if part[name] is not None:
+            msg[name] = part[name]
+    msg.set_payload(part.get_payload())
+    fo = StringIO()
+    Generator(fo, mangle_from_=False, maxheaderlen=0).flatten(msg)
+    return fo.getvalue()
+
+
+def _modseq_value(val):
+    """ imapclient returns the MODSEQ fetch item as a tuple like `(123,)` """
+    if isinstance(val, (tuple, list)):
+        val = val[0] if val else None
+    return val or 0
+
+
+_imap_months = (
+    'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def imap_date(date):
+    """ `datetime.date` -> IMAP SEARCH date string (locale-independent) """
+    return '%02d-%s-%04d' % (date.day, _imap_months[date.month - 1], date.year)
+
+
+def _fetch_data_item(fetch_data, prefix):
+    """ Get a fetch data item by its name prefix (for the items that the
+    server might echo in a slightly different form) """
+    for key, val in fetch_data.items():
+        if key.upper().startswith(prefix):
+            return val
+    return None
+
+
+class DeliveredIndex(object):
+    """ The last `max_size` delivered messages, for recovering from an
+    UIDVALIDITY change: `message_id -> [sequence number, 'YYYY-MM-DD']`,
+    an item each in the `db` (so that a delivery costs O(1) to save) """
+
+    def __init__(self, db, max_size=500):
+        self.db = db
+        self.max_size = max_size
+        items = sorted(db.items(), key=lambda item: item[1][0])
+        self._seq = items[-1][1][0] if items else 0
+        self.order = OrderedDict((message_id, value[0]) for message_id, value in items)
+        self._trim()
+
+    def add(self, message_id, date):
+        """ Add a message (`date`: the INTERNALDATE datetime) """
+        self._seq += 1
+        self.order.pop(message_id, None)
+        self.order[message_id] = self._seq
+        with simpledb.db_batch(self.db):
+            self.db[message_id] = [self._seq, date.strftime('%Y-%m-%d')]
+            self._trim()
+
+    def _trim(self):
+        with simpledb.db_batch(self.db):
+            while len(self.order) > self.max_size:
+                message_id, _ = self.order.popitem(last=False)
+                self.db.pop(message_id, None)
+
+    def oldest_date(self):
+        """ The earliest date of the messages (a `datetime.date`), if any """
+        if not self.order:
+            return None
+        date = min(value[1] for value in self.db.values())
+        return datetime.datetime.strptime(date, '%Y-%m-%d').date()
+
+    def __contains__(self, message_id):
+        return message_id in self.order
+
+    def __len__(self):
+        return len(self.order)
+
+
 class IMAPReceiver(object):
     """ An even more generalised IMAP client, made around
     imapclient.IMAPClient, that allows receiving all new messages in an
@@ -103,8 +355,8 @@ class IMAPReceiver(object):
     Stopping: `this.stop_event.set()`, wait a while.
     """
 
-    # TODO: cleanup
-    sync_msg_limit = 50  # NOTE.
+    # NOTE: see the `imap_backlog_mode` setting.
+    sync_msg_limit = 50
     # Timeout for the IDLE command
     # 28 minutes, slightly below the RFC-recommended-maximum of 29 minutes
     idle_timeout = 28 * 60
@@ -119,13 +371,45 @@ class IMAPReceiver(object):
         :param db: a persistent dict for state storage.
         """
         self.config = config
+        self.fetch_chunk_count = config.imap_fetch_chunk_count
+        self.fetch_chunk_size = config.imap_fetch_chunk_size
+        self.fetch_mode = config.imap_fetch_mode
+        self.condstore = config.imap_condstore
+        self.stream_parse = config.imap_stream_parse
+        self.stream_min_size = config.imap_stream_min_size
+        self.stream_chunk_size = config.imap_stream_chunk_size
+        self.delivered_index_size = config.imap_delivered_index_size
+        self.sync_msg_limit = config.imap_sync_msg_limit
+        self.backlog_mode = config.imap_backlog_mode
+        self.backlog_rate = config.imap_backlog_rate
+        self.idle_mode = config.imap_idle_mode
+        self.idle_resync_delay = config.imap_idle_resync_delay
+        self.idle_event_time = None
+        self.backoff = Backoff(
+            policies=config.imap_reconnect_backoff,
+            circuit_threshold=config.imap_reconnect_circuit_threshold,
+            circuit_timeout=config.imap_reconnect_circuit_timeout)
+        self.stats = dict(
+            delivered=0, idle_events=0, idle_resyncs=0,
+            latency_sum=0.0, latency_max=0.0,
+            event_latency_sum=0.0, event_latency_max=0.0)
         if cli_kwa is None:
             cli_kwa = config_to_clikwa(config)
         self.cli_kwa = cli_kwa
 
         if db is None:
-            db = simpledb.SimpleDB(config.db_filename)
+            db = simpledb.get_db(config)
         self.db = db
+        self.delivered_index = DeliveredIndex(
+            simpledb.db_subdict(db, 'delivered'),
+            max_size=self.delivered_index_size)
+        old_index = db.get('delivered_index')
+        if old_index is not None:  ## The older whole-list format
+            with simpledb.db_batch(db):
+                for message_id, date in old_index:
+                    self.delivered_index.add(
+                        message_id, datetime.datetime.strptime(date, '%Y-%m-%d'))
+                del db['delivered_index']
 
         self.stop_event = Event()
 
@@ -156,6 +440,10 @@ class IMAPReceiver(object):
         # name is set, resulting in `SOCKET('')`
         cli._x_name = name
         cli._imap._x_name = name
+        if self.stream_parse:
+            imaplib_stream_parse(
+                cli._imap, min_size=self.stream_min_size,
+                chunk_size=self.stream_chunk_size)
 
         # NOTE: done regardless of the 'cached' param.
         setattr(self, name, cli)
@@ -173,19 +461,29 @@ class IMAPReceiver(object):
     def run_with_retry(self, **kwa):
         self.pre_run(**kwa)
         self.retry_working = True
+        try:
+            self.retry_loop()
+        finally:
+            self.log.info("Saving the state")
+            self.db.flush()
+
+    def retry_loop(self):
         while self.retry_working:
             if self.stop_event.isSet():
                 return
             try:
+                self.backoff.attempt()
                 self.run(pre_run=False)
-            except imaplib.IMAP4.abort as exc:
-                # `raise self.abort('socket error: EOF')`
-                # In practice, that exception should've'been caught in the imapclient.py
-                self.log.exception("run() error 'abort': %r", exc)
-                self.log.info("Re-`run()`ning")
             except Exception as exc:
-                self.log.exception("run() error: %r", exc)
-                self.log.info("Re-`run()`ning")
+                # NOTE: imaplib.IMAP4.abort (`raise self.abort('socket
+                # error: EOF')`) should, in practice, have been caught in
+                # the imapclient.py
+                failure_class = classify_failure(exc)
+                self.log.exception("run() error %r: %r", failure_class, exc)
+                delay = self.backoff.failure(failure_class)
+                self.log.info("Re-`run()`ning in %.1fs (circuit %s, stats %r)",
+                              delay, self.backoff.state, self.backoff.stats)
+                self.stop_event.wait(delay)
             finally:
                 self.log.info("run_with_retry iteration done")
 
@@ -199,7 +497,8 @@ class IMAPReceiver(object):
             self.pre_run(**kwa)
         # Prepare the imap clients here:
         self.get_client()
-        self.get_client(name='idle_cli')
+        if self.idle_mode == 'dual':
+            self.get_client(name='idle_cli')
 
         try:
             return self.run_loop(**kwa)
@@ -216,21 +515,67 @@ class IMAPReceiver(object):
             self.work()
 
     def work(self):
-        """ Synopsis: TODO
-        """
-        self.log.info("work()")
+        """ A single sync + IDLE iteration """
+        if self.idle_mode == 'dual':
+            return self.work_dual()
+        return self.work_single()
+
+    def work_single(self):
+        """ Sync, then IDLE on the same connection until there are events
+        (or the `idle_timeout` passes).
 
+        Any IMAP error propagates (and results in a reconnect by
+        `run_with_retry`); nothing else causes a reconnect.
+        """
+        self.log.info("work_single()")
+        cli = self.get_client(name='cli', cached=True)
+        self.check_state(cli)
+
+        delivered_before = self.stats['delivered']
+        self.sync(cli=cli)
+        if (self.idle_event_time and self.idle_resync_delay
+                and self.stats['delivered'] == delivered_before
+                and cli.has_capability('X-GM-EXT-1')):
+            # See the `imap_idle_resync_delay` setting.
+            self.log.info("Nothing found after an IDLE event; re-syncing in %rs",
+                          self.idle_resync_delay)
+            self.stats['idle_resyncs'] += 1
+            time.sleep(self.idle_resync_delay)
+            cli.noop()
+            self.sync(cli=cli)
+        self.idle_event_time = None
+
+        self.log.debug("cli idle check for %r", self.idle_timeout)
+        cli.idle()
+        try:
+            resp = cli.idle_check(timeout=self.idle_timeout)
+        except Exception:
+            exc_info = sys.exc_info()
+            try:
+                cli.idle_done()
+            except Exception as exc:
+                ## Most likely, the same broken connection.
+                self.log.warning("IDLE DONE after an IDLE error failed: %r", exc)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        _, resp_from_done = cli.idle_done()
+        self.log.debug('got cli idle resps: %r, %r', resp, resp_from_done)
+        if resp or resp_from_done:
+            self.idle_event_time = time.time()
+            self.stats['idle_events'] += 1
+
+    def check_state(self, cli):
+        """ Check the UIDVALIDITY and make sure there is some `last_uid` to
+        sync from """
         last_uid = self.db.setdefault('last_uid', None)
         last_uidvalidity = self.db.setdefault('last_uidvalidity', None)
-        cli = self.get_client(name='cli', cached=True)
 
         uidvalidity = cli._folderinfo.get('UIDVALIDITY')
-        # TODO: use something like datetime-based sync (or label-based
-        # sync) for these cases.
         if not uidvalidity:
             raise Exception("No UIDVALIDITY provided; support pending")
         if last_uidvalidity and uidvalidity != last_uidvalidity:
-            raise Exception("Uidvalidity changed; support pending")
+            self.resync_uidvalidity(cli, uidvalidity)
+            last_uid = self.db['last_uid']
+            last_uidvalidity = uidvalidity
 
         if not last_uidvalidity:
             self.log.info("Saving new uidvalidity: %r", uidvalidity)
@@ -238,10 +583,15 @@ class IMAPReceiver(object):
 
         if not last_uid:
             self.log.warning("Getting new last_uid")
-            uids = cli.search('ALL')
-            last_uid = max(uids)
+            last_uid = self.bootstrap_last_uid(cli)
             self.db['last_uid'] = last_uid
 
+    def work_dual(self):
+        """ The two-connections version of `work` """
+        self.log.info("work_dual()")
+        cli = self.get_client(name='cli', cached=True)
+        self.check_state(cli)
+
         idle_cli = self.get_client(name='idle_cli', cached=True)
         # # NOTE: trying with the same client as the sync one.
         self.log.info("work: idle_cli.idle()")
@@ -271,16 +621,320 @@ class IMAPReceiver(object):
 
         # here it should return into the loop, restart idle, sync-
 
+    def bootstrap_last_uid(self, cli):
+        """ Get the `last_uid` for starting with an empty state (i.e. skip
+        all the messages currently in the mailbox).
+
+        Uses the UIDNEXT (from the SELECT response or from STATUS) so that
+        it does not depend on the mailbox size; `SEARCH ALL` is only the
+        last resort.
+        """
+        folderinfo = getattr(cli, '_folderinfo', None) or {}
+        uidnext = folderinfo.get('UIDNEXT')
+        if not uidnext:
+            try:
+                status = cli.folder_status(self.mailbox, ['UIDNEXT'])
+            except Exception as exc:
+                self.log.warning("STATUS UIDNEXT failed: %r", exc)
+            else:
+                uidnext = status.get('UIDNEXT')
+        if uidnext:
+            return uidnext - 1
+        self.log.warning("No UIDNEXT; falling back to SEARCH ALL")
+        uids = cli.search('ALL')
+        return max(uids or [0])
+
+    def mark_all_as_seen(self):
+        """ Consider all the messages currently in the mailbox as
+        delivered (without fetching anything about them) """
+        cli = self.get_client(name='cli', cached=True)
+        last_uid = self.bootstrap_last_uid(cli)
+        self.log.info("mark_all_as_seen: last_uid = %r", last_uid)
+        self.db.pop('last_modseq', None)
+        self.db.update(
+            last_uid=last_uid,
+            last_uidvalidity=cli._folderinfo.get('UIDVALIDITY'),
+            resync_until_uid=None, resync_skip_uids=None)
+        return last_uid
+
+    def resync_uidvalidity(self, cli, uidvalidity):
+        """ Recover the `last_uid` after an UIDVALIDITY change.
+
+        Searches for the messages since the oldest date in the delivered
+        messages index, gets only their Message-IDs (in chunks), and
+        continues from the first one after the first indexed message that
+        was not delivered yet (the messages before the first indexed one
+        are the ones already dropped from the index; SINCE is by days).
+        The delivered messages after that are skipped by `sync` without
+        fetching them (see 'resync_skip_uids', 'resync_until_uid').
+        """
+        index = self.delivered_index
+        self.log.warning(
+            "UIDVALIDITY changed (%r -> %r); resyncing with %d known messages",
+            self.db.get('last_uidvalidity'), uidvalidity, len(index))
+
+        resync_until_uid = None
+        skip_uids = None
+        uids = []
+        if index:
+            search_str = 'SINCE %s' % (imap_date(index.oldest_date()),)
+            uids = sorted(cli.search(search_str))
+            self.log.info("SEARCH %r returned %d msgids", search_str, len(uids))
+        delivered = []
+        for chunk in chunk_msgids(uids, max_count=self.fetch_chunk_count or 500):
+            res = cli.fetch(chunk, ['BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]'])
+            for uid in chunk:
+                header = _fetch_data_item(res.get(uid) or {}, 'BODY[HEADER.FIELDS') or ''
+                message_id = email.message_from_string(to_bytes(header))['Message-ID']
+                if message_id in index:
+                    delivered.append(uid)
+
+        if not delivered:
+            self.log.warning("None of the delivered messages found; skipping to the new messages")
+            last_uid = self.bootstrap_last_uid(cli)
+        else:
+            delivered_set = set(delivered)
+            undelivered = [uid for uid in uids
+                           if uid > delivered[0] and uid not in delivered_set]
+            self.log.info("%d of %d messages were not delivered yet",
+                          len(undelivered), len(uids) - uids.index(delivered[0]))
+            if undelivered:
+                last_uid = undelivered[0] - 1
+                skip_uids = [uid for uid in delivered if uid > last_uid]
+                resync_until_uid = max(uids)
+            else:
+                last_uid = max(uids)
+
+        self.db.pop('last_modseq', None)  # Meaningless with the new UIDs
+        self.db.update(
+            last_uid=last_uid,
+            last_uidvalidity=uidvalidity,
+            resync_until_uid=resync_until_uid,
+            resync_skip_uids=skip_uids)
+
+    def record_latency(self, internaldate=None):
+        """ Update the delivery stats: arrival (INTERNALDATE) to delivery,
+        and IDLE event to delivery """
+        now = time.time()
+        stats = self.stats
+        stats['delivered'] += 1
+        if isinstance(internaldate, datetime.datetime):
+            # NOTE: imapclient normalises the times to the local naive ones.
+            latency = max(0.0, now - time.mktime(internaldate.timetuple()))
+            stats['latency_sum'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+            self.log.debug("Arrival-to-delivery latency: %.3fs", latency)
+        if self.idle_event_time:
+            latency = now - self.idle_event_time
+            stats['event_latency_sum'] += latency
+            stats['event_latency_max'] = max(stats['event_latency_max'], latency)
+            self.log.debug("IDLE-event-to-delivery latency: %.3fs", latency)
+
+    def record_delivered(self, delivered, last_uid):
+        """ Save the `last_uid` along with the `delivered`
+        `[(message_id, internaldate), ...]` in the (bounded) delivered
+        messages index """
+        updates = dict(last_uid=last_uid)
+        resync_until_uid = self.db.get('resync_until_uid')
+        if resync_until_uid and last_uid >= resync_until_uid:
+            updates.update(resync_until_uid=None, resync_skip_uids=None)
+        # NOTE: single write (where supported).
+        with simpledb.db_batch(self.db):
+            for message_id, internaldate in delivered:
+                if message_id:
+                    self.delivered_index.add(
+                        message_id, internaldate or datetime.datetime.now())
+            self.db.update(updates)
+
     def sync(self, limit=True, process=True, cli=None, debug=False):
         """ ...
 
-        NOTE: `limit=None, process=False` is used for mark_all_as_seen
+        NOTE: `limit=None, process=False` can be used to skip all the
+        new messages (see also `mark_all_as_seen`, which is cheaper).
         """
         self.log.info("sync()")
         cli = cli or self.get_client(name='cli', cached=True)
         # cli = self.get_client(name='cli', cached=False)
 
         last_uid = self.db['last_uid']
+
+        prefetch_items = []
+        if self.fetch_chunk_size:
+            prefetch_items.append('RFC822.SIZE')
+        if self.fetch_mode == 'partial':
+            prefetch_items.append('BODYSTRUCTURE')
+
+        msgids, prefetched, modseq = self.find_new_msgids(
+            cli, last_uid, prefetch_items=prefetch_items)
+
+        skipped = []
+        if self.db.get('resync_until_uid'):
+            ## Delivered before the UIDVALIDITY change, see `resync_uidvalidity`.
+            skip_uids = set(self.db.get('resync_skip_uids') or ())
+            skipped = [msgid for msgid in msgids if msgid in skip_uids]
+            if skipped:
+                self.log.info("Skipping %d already delivered messages", len(skipped))
+                msgids = [msgid for msgid in msgids if msgid not in skip_uids]
+
+        pace = False
+        batches = [msgids]
+        if limit is True and self.sync_msg_limit and len(msgids) > self.sync_msg_limit:
+            limit = self.sync_msg_limit
+            self.log.warning("Backlog of %d messages (mode %r)",
+                             len(msgids), self.backlog_mode)
+            if self.backlog_mode == 'drain':
+                pace = True
+                batches = [msgids[idx:idx + limit]
+                           for idx in range(0, len(msgids), limit)]
+            elif self.backlog_mode == 'digest':
+                overflow, msgids = msgids[:-limit], msgids[-limit:]
+                if process:
+                    self.send_backlog_digest(cli, overflow)
+                last_uid = max(overflow)
+                self.db['last_uid'] = last_uid
+                batches = [msgids]
+            else:
+                # When there are too much messages some will be skipped
+                batches = [msgids[-limit:]]  # NOTE
+        elif limit and limit is not True:
+            batches = [msgids[-limit:]]
+
+        dbgres = []
+        for batch in batches:
+            if self.stop_event.isSet():
+                self.log.info("Stopping in the middle of a backlog")
+                return dbgres
+            batch_prefetched = None
+            if prefetched is not None:
+                batch_prefetched = {msgid: prefetched.pop(msgid)
+                                    for msgid in batch if msgid in prefetched}
+            last_uid = self.sync_batch(
+                cli, batch, last_uid, prefetched=batch_prefetched,
+                prefetch_items=prefetch_items, process=process, pace=pace,
+                dbgres=dbgres if debug else None)
+        if skipped and max(skipped) > last_uid:
+            last_uid = max(skipped)
+            self.record_delivered([], last_uid)
+
+        # A completed sync means the connection works.
+        self.backoff.success()
+
+        # NOTE: only saved after everything is processed, as the messages
+        # with the lower modseq are not going to be returned again.
+        if modseq and modseq != self.db.get('last_modseq'):
+            self.log.debug("last_modseq = %r", modseq)
+            self.db['last_modseq'] = modseq
+        return dbgres
+
+    def sync_batch(self, cli, msgids, last_uid, prefetched=None,
+                   prefetch_items=(), process=True, pace=False, dbgres=None):
+        """ Fetch and handle the `msgids` in chunks, saving the progress
+        after each chunk. Returns the new `last_uid`.
+
+        :param pace: limit the handling rate to `backlog_rate`.
+        :param dbgres: a list to append the fetched data to.
+        """
+        if prefetch_items and msgids and prefetched is None:
+            prefetched = cli.fetch(msgids, prefetch_items)
+        sizes = None
+        if prefetched:
+            sizes = {msgid: data.get('RFC822.SIZE')
+                     for msgid, data in prefetched.items()}
+
+        next_time = time.time()
+        chunks = chunk_msgids(
+            msgids, sizes=sizes,
+            max_count=self.fetch_chunk_count,
+            max_size=self.fetch_chunk_size)
+        for chunk in chunks:
+            self.log.debug("Fetching a chunk of %d messages", len(chunk))
+            messages = self.fetch_chunk(cli, chunk, prefetched=prefetched)
+            delivered = []
+            for msgid in chunk:
+                self.log.debug("Message %r", msgid)
+                # Drop the reference from the chunk as soon as possible.
+                message = messages.pop(msgid, None)
+                if message is None:
+                    # Expunged in the meantime, most likely.
+                    self.log.warning("Message %r was not fetched", msgid)
+                    continue
+                if pace and self.backlog_rate:
+                    delay = next_time - time.time()
+                    if delay > 0 and not self.stop_event.isSet():
+                        self.stop_event.wait(delay)
+                    next_time = max(next_time, time.time()) + 1.0 / self.backlog_rate
+                try:
+                    msg_content = message['RFC822']
+                    if process:
+                        msg = self.handle_msg(
+                            msg_content, msgid=msgid, msgids=msgids, message=message)
+                        delivered.append((msg['Message-ID'], message.get('INTERNALDATE')))
+                    if dbgres is not None:
+                        dbgres.append(dict(msgid=msgid, message=message))
+                except Exception as exc:
+                    self.log.exception("Error handling msg: %r", exc)
+
+            # NOTE: a failed message does not stop the progress (same as
+            # it was before the chunking).
+            chunk_last_uid = max(chunk)
+            if chunk_last_uid > last_uid:
+                last_uid = chunk_last_uid
+                self.log.debug("last_uid = %r", last_uid)
+                self.record_delivered(delivered, last_uid)
+        return last_uid
+
+    def send_backlog_digest(self, cli, msgids):
+        """ Deliver a single message listing the (skipped) `msgids` by
+        sender. Only the From / Subject headers are fetched. """
+        by_sender = {}
+        for chunk in chunk_msgids(msgids, max_count=self.fetch_chunk_count or 500):
+            res = cli.fetch(chunk, ['BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)]'])
+            for msgid in chunk:
+                header = _fetch_data_item(res.get(msgid) or {}, 'BODY[HEADER.FIELDS') or ''
+                headers = email.message_from_string(to_bytes(header))
+                sender = email_parseaddr(headers['From'] or '')[1] or '(unknown)'
+                by_sender.setdefault(sender, []).append(
+                    decode_header_value(headers['Subject']) or u'')
+
+        lines = []
+        for sender, subjects in sorted(
+                by_sender.items(), key=lambda item: -len(item[1])):
+            lines.append(u'%s: %d' % (sender, len(subjects)))
+            lines.extend(u'  %s' % (subject,) for subject in subjects[-3:])
+        body = u'\n'.join(lines)
+        msg = MIMEText(body.encode('utf-8'), 'plain', 'utf-8')
+        msg['Subject'] = '%d older messages were not delivered' % (len(msgids),)
+        ## From the transport itself (see `MailJabberLayer.mfrom_to_jfrom`),
+        ## not a reply-able address.
+        msg['From'] = email_formataddr(
+            ('Backlog', 'backlog@%s' % (self.config.xmpp_component_jid,)))
+        msg['To'] = self.config.email_address
+        msg['Message-ID'] = email_make_msgid('backlog')
+        self.log.info("Sending a backlog digest for %d messages", len(msgids))
+        self.mail_callback(msg, msg_content=msg.as_string())
+
+    def find_new_msgids(self, cli, last_uid, prefetch_items=()):
+        """ Find the messages newer than `last_uid`.
+
+        Returns `(msgids, prefetched, modseq)`, where `prefetched` is
+        either None or `{msgid: fetch_data}` with the `prefetch_items`, and
+        `modseq` is either None or the modseq to save once the messages are
+        processed.
+        """
+        use_condstore = self.condstore and cli.has_capability('CONDSTORE')
+        last_modseq = self.db.get('last_modseq')
+        if use_condstore and last_modseq:
+            return self.find_new_msgids_condstore(
+                cli, last_uid, last_modseq, prefetch_items=prefetch_items)
+
+        modseq = None
+        if use_condstore:
+            # The HIGHESTMODSEQ from before the SEARCH is safe to use.
+            modseq = cli._folderinfo.get('HIGHESTMODSEQ')
+        msgids = self.find_new_msgids_search(cli, last_uid)
+        return msgids, None, modseq
+
+    def find_new_msgids_search(self, cli, last_uid):
         # NOTE: `+ 1` to avoid getting the message we had already
         search_str = 'UID %d:*' % (last_uid + 1,)
         self.log.debug("Search %r", search_str)
@@ -298,48 +952,100 @@ class IMAPReceiver(object):
                           len(msgids))
         #     self.log.error("msgids lower than the search requested: %r -> %r",
         #                    search_str, failmsgids)
+        return msgids
+
+    def find_new_msgids_condstore(self, cli, last_uid, last_modseq,
+                                  prefetch_items=()):
+        """ A single `UID FETCH <n>:* (MODSEQ ...) (CHANGEDSINCE <modseq>)`
+        that both finds the new messages and prefetches the
+        `prefetch_items` for them. """
+        fetch_str = '%d:*' % (last_uid + 1,)
+        modifiers = ['CHANGEDSINCE %d' % (last_modseq,)]
+        self.log.debug("Fetch %r %r", fetch_str, modifiers)
+        res = cli.fetch(
+            fetch_str, ['MODSEQ'] + list(prefetch_items), modifiers=modifiers)
+        modseq = max([last_modseq] + [
+            _modseq_value(data.get('MODSEQ')) for data in res.values()])
+        # NOTE: the same 'last message is always included' thing applies
+        # here (if it was changed since).
+        msgids = sorted(msgid for msgid in res if msgid > last_uid)
+        self.log.info("FETCH CHANGEDSINCE %r returned %d msgids: %r",
+                      last_modseq, len(msgids), msgids)
+        prefetched = None
+        if prefetch_items:
+            prefetched = {msgid: res[msgid] for msgid in msgids}
+        return msgids, prefetched, modseq
+
+    def fetch_chunk(self, cli, msgids, prefetched=None):
+        """ FETCH the messages; returns the `{msgid: fetch_data}` dict with
+        'RFC822' in each fetch_data.
+
+        In the 'partial' fetch mode, 'RFC822' is a message rebuilt from the
+        headers and the selected text part only.
+
+        :param prefetched: `{msgid: fetch_data}` with the 'BODYSTRUCTURE'
+        """
+        items = ['INTERNALDATE', 'FLAGS', 'RFC822']
+        if self.fetch_mode != 'partial' or not prefetched:
+            return cli.fetch(msgids, items)
 
-        # When there are too much messages some will be skipped if
-        # this is enabled.
-        if limit is True and self.sync_msg_limit:
-            msgids = msgids[-self.sync_msg_limit:]  # NOTE
-        elif limit:
-            msgids = msgids[-limit:]
-
-        dbgres = []
-
-        messages = cli.fetch(msgids, ['INTERNALDATE', 'FLAGS', 'RFC822'])
+        by_section = {}
         for msgid in msgids:
-            self.log.debug("Message %r", msgid)
-            try:
-                message = messages[msgid]
-                msg_content = message['RFC822']
-                if process:
-                    self.handle_msg(
-                        msg_content, msgid=msgid, msgids=msgids, message=message)
-                # NOTE: if handle_msg excepts, this will not be done, this way.
-                # resp = cli.add_flags(msgid, self.seen_flag)
-                if msgid > last_uid:
-                    last_uid = msgid
-                    self.log.debug("last_uid = %r", last_uid)
-                    self.db['last_uid'] = last_uid
-                if debug:
-                    dbgres.append(dict(msgid=msgid, message=message))
-            except Exception as exc:
-                self.log.exception("Error handling msg: %r", exc)
-        return dbgres
+            bodystructure = (prefetched.get(msgid) or {}).get('BODYSTRUCTURE')
+            section = None
+            if bodystructure is not None:
+                section = bodystructure_select(
+                    bodystructure, self.config.preferred_format)
+            by_section.setdefault(section, []).append(msgid)
+
+        messages = {}
+        for section, section_msgids in by_section.items():
+            if section is None:
+                messages.update(cli.fetch(section_msgids, items))
+                continue
+            self.log.debug("Fetching section %r of %r", section, section_msgids)
+            section_items = [
+                'INTERNALDATE', 'FLAGS', 'BODY.PEEK[HEADER]',
+                'BODY.PEEK[%s.MIME]' % (section,), 'BODY.PEEK[%s]' % (section,)]
+            res = cli.fetch(section_msgids, section_items)
+            for msgid, message in res.items():
+                message['RFC822'] = build_partial_message(
+                    message.pop('BODY[HEADER]', ''),
+                    message.pop('BODY[%s.MIME]' % (section,), ''),
+                    message.pop('BODY[%s]' % (section,), ''))
+                messages[msgid] = message
+        return messages
 
     def handle_msg(self, msg_content, **kwa):
-        """ Function to feed previously-not-seen messages into """
+        """ Function to feed previously-not-seen messages into.
+
+        The `mail_callback` returns False for a message it skipped (e.g. a
+        duplicate), which then does not count as delivered. """
         # Storytime.
         # Apparently, IMAPClient decodes the message whenever possible;
         # however, email.message_from_string puts it into StringIO which
         # expects bytes() and thus tries to encode the unicode string into
         # ascii and thus fails.
-        msg_content = to_bytes(msg_content)
-        msg = email.message_from_string(msg_content)
+        if isinstance(msg_content, ParsedLiteral):
+            ## Parsed while fetching; there is no raw string to pass on.
+            msg = msg_content.message
+            msg_content = None
+        else:
+            msg_content = to_bytes(msg_content)
+            ## Only the headers are parsed here; the body is parsed by the
+            ## conversion (possibly in a worker process, see the
+            ## `email_convert_processes` setting).
+            msg = lazymsg.LazyMessage(msg_content)
+
+        msgid = kwa.get('msgid')
+        res = self.mail_callback(msg, msg_content=msg_content, msgid=msgid)
+        if res is not False:
+            self.record_latency((kwa.get('message') or {}).get('INTERNALDATE'))
+        return msg
 
-        self.mail_callback(msg, msg_content=msg_content)
+
+def mail_callback_dbg(msg, msg_content=None, **kwa):
+    print "Message: ", repr(msg_content)[:300]
 
 
 def main(args=None):
@@ -349,9 +1055,6 @@ def main(args=None):
     from pyimapsmtpt.confloader import get_config
     config = get_config()
 
-    def mail_callback_dbg(msg, msg_content):
-        print "Message: ", repr(msg_content)[:300]
-
     worker = IMAPReceiver(config=config, mail_callback=mail_callback_dbg)
 
     if args and 'mark_all' in args:
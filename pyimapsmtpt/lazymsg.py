@@ -0,0 +1,154 @@
+# coding: utf8
+""" A lazily parsed email message.
+
+`email.message_from_string` builds the whole MIME tree up front, with a
+string copy of every part (attachments included). `LazyMessage` parses
+only the headers; the part boundaries are found (as offsets into the raw
+message) when the parts are asked for, and a part's body is only sliced
+out and decoded when its payload is asked for.
+
+It is an `email.message.Message` subclass and supports what the
+conversion uses of it: the headers, `is_multipart`, `get_payload`
+(including `decode=True`), `walk`, `get_charsets`, `as_string`.
+"""
+
+import re
+import email.message
+from email.parser import HeaderParser
+
+
+_re_blank_line = re.compile(r'\r?\n\r?\n')
+_re_newline_start = re.compile(r'\r?\n')
+
+
+def _split_headers(raw, start, end):
+    """ Returns `(headers_end, body_start)` offsets for the message in
+    `raw[start:end]` """
+    match = _re_newline_start.match(raw, start, end)
+    if match:  ## No headers at all
+        return start, match.end()
+    match = _re_blank_line.search(raw, start, end)
+    if match is None:
+        return end, end
+    ## Keep the newline of the last header line
+    return match.start() + (2 if raw[match.start()] == '\r' else 1), match.end()
+
+
+def _find_delimiters(raw, boundary, start, end):
+    """ Yields `(delimiter_start, delimiter_end, is_close)` for the
+    boundary delimiter lines in `raw[start:end]`.
+
+    The line separator before the delimiter belongs to the delimiter
+    (RFC 2046 5.1.1). `str.find` is used instead of a regex as it skips
+    over the (base64, mostly) bodies much faster.
+    """
+    delimiter = '--' + boundary
+    pos = start
+    while True:
+        idx = raw.find(delimiter, pos, end)
+        if idx < 0:
+            return
+        pos = idx + 1
+        if idx != start and raw[idx - 1] not in '\r\n':
+            continue
+        after = idx + len(delimiter)
+        is_close = raw.startswith('--', after, end)
+        if is_close:
+            after += 2
+        while after < end and raw[after] in ' \t':
+            after += 1
+        if raw.startswith('\r\n', after, end):
+            after += 2
+        elif after < end and raw[after] in '\r\n':
+            after += 1
+        elif after < end:
+            continue  ## Just a line starting with the boundary
+        if raw.startswith('\r\n', idx - 2, idx) and idx - 2 >= start:
+            idx -= 2
+        elif idx > start:
+            idx -= 1
+        yield idx, after, is_close
+        pos = after
+
+
+class LazyMessage(email.message.Message):
+    """ The message (or a MIME part) in `raw[start:end]` """
+
+    def __init__(self, raw, start=0, end=None, default_type='text/plain'):
+        email.message.Message.__init__(self)
+        if end is None:
+            end = len(raw)
+        self._raw = raw
+        self._start = start
+        self._end = end
+        self.set_default_type(default_type)
+        headers_end, self._body_start = _split_headers(raw, start, end)
+        parsed = HeaderParser().parsestr(raw[start:headers_end], headersonly=True)
+        self._headers = parsed._headers
+        self._unixfrom = parsed._unixfrom
+        self.defects = parsed.defects
+        self._parts = None
+
+    def is_multipart(self):
+        return self._get_parts() is not None
+
+    def _get_parts(self):
+        """ The submessages (found on the first call), or None for a
+        non-multipart message """
+        if self._parts is not None:
+            return self._parts
+        maintype = self.get_content_maintype()
+        if maintype == 'message' and self.get_content_subtype() == 'rfc822':
+            self._parts = [LazyMessage(self._raw, self._body_start, self._end)]
+        elif maintype == 'multipart' and self.get_boundary():
+            self._parts = self._split_parts()
+        return self._parts
+
+    def _split_parts(self):
+        raw, end = self._raw, self._end
+        default_type = (
+            'message/rfc822' if self.get_content_subtype() == 'digest'
+            else 'text/plain')
+        parts = []
+        part_start = None
+        for delimiter_start, delimiter_end, is_close in _find_delimiters(
+                raw, self.get_boundary(), self._body_start, end):
+            if part_start is not None:
+                parts.append(LazyMessage(
+                    raw, part_start, delimiter_start, default_type=default_type))
+            if is_close:
+                part_start = None
+                break
+            part_start = delimiter_end
+        if part_start is not None:  ## No closing delimiter
+            parts.append(LazyMessage(raw, part_start, end, default_type=default_type))
+        return parts
+
+    def get_payload(self, i=None, decode=False):
+        parts = self._get_parts()
+        if parts is not None:
+            if decode:
+                return None
+            return parts if i is None else parts[i]
+        ## Only the single (non-multipart) payload is ever materialized,
+        ## and only for the duration of the call.
+        self._payload = self._raw[self._body_start:self._end]
+        try:
+            return email.message.Message.get_payload(self, i, decode)
+        finally:
+            self._payload = None
+
+    def set_payload(self, payload, charset=None):
+        raise TypeError("LazyMessage is read-only")
+
+    def as_string(self, unixfrom=False):
+        return self._raw[self._start:self._end]
+
+    __str__ = as_string
+
+
+def message_from_string(raw, lazy=True):
+    """ `email.message_from_string`, or a `LazyMessage` if `lazy` """
+    if lazy:
+        return LazyMessage(raw)
+    return email.message_from_string(raw)
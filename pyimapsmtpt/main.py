@@ -25,16 +25,21 @@ import gevent
 import os
 import signal
 import sys
+import functools
 # import time
 import logging
 from threading import Event
 
-from .confloader import get_config
-from .common import configure_logging, config_email_utf8, EventProcessed
+from .confloader import get_config, get_account_configs
+from .common import (
+    configure_logging, config_email_utf8, jid_data_to_string, EventProcessed)
 from .convertlayer import MailJabberLayer
 from .smtphelper import SMTPHelper
 from .xmpptransport import Transport
 from .imapcli import IMAPReceiver
+from .pipeline import Pipeline, Stage
+from .procpool import ProcessPool, ProcessPoolError
+from .simpledb import get_db, get_tracking_db
 
 
 _log = logging.getLogger(__name__)
@@ -42,9 +47,10 @@ _log = logging.getLogger(__name__)
 
 class PyIMAPSMTPtWorker(object):
 
-    layer = transport = imapc = None
+    layer = transport = imapc = db = tracking_db = pipeline = convert_pool = None
 
     joinall_timeout = 0.1
+    pipeline_stop_timeout = 5
 
     def __init__(self, config=None):
         if config is None:
@@ -53,6 +59,14 @@ class PyIMAPSMTPtWorker(object):
         self.stop_event = Event()
         self.config = config
         self.children = {}
+        ## {account_name: ...}; `None` is the name of the only account in
+        ## the single-account setup.
+        self.layers = {}
+        self.imapcs = {}
+        self.account_configs = {}
+        self.account_names = []
+        ## The `convert_pool` workers' own layers
+        self._child_layers = {}
 
     def pre_run(self, instantiate=True):
         config_email_utf8()
@@ -81,32 +95,130 @@ class PyIMAPSMTPtWorker(object):
         self.stop_event.set()
 
     def _instantiate(self):
-        self.layer = MailJabberLayer(
-            config=self.config, xmpp_sink=self.xmpp_sink,
-            smtp_sink=self.smtp_sink, _manager=self)
+        accounts = get_account_configs(self.config)
+        self.account_configs = dict(accounts)
+        self.account_names = [name for name, _ in accounts]
+        if self.config.email_convert_processes:
+            ## Forked before any connection (or the state db) is opened,
+            ## so that the workers do not inherit them.
+            self.convert_pool = ProcessPool(
+                self._convert_in_child,
+                processes=self.config.email_convert_processes)
+            self.convert_pool.start()
+
+        ## Shared by all the accounts
+        self.db = get_db(self.config)
+        self.tracking_db = get_tracking_db(self.config, self.db)
+
+        for name, config in accounts:
+            db = account_db(self.db, name)
+            tracking_db = account_db(self.tracking_db, name)
+            self.layers[name] = MailJabberLayer(
+                config=config, xmpp_sink=self.xmpp_sink,
+                smtp_sink=self.smtp_sink, _manager=self,
+                db=tracking_db.subdict('conversations'),
+                dedup_db=tracking_db.subdict('dedup'),
+                account=name)
+            self.imapcs[name] = IMAPReceiver(
+                config=config, db=db,
+                mail_callback=functools.partial(self.email_source, _account=name))
+
+        ## The first (or the only) account is the default one.
+        self.layer = self.layers[accounts[0][0]]
+        self.imapc = self.imapcs[accounts[0][0]]
         self.smtp = SMTPHelper(
             config=self.config, _manager=self)
-        self.imapc = IMAPReceiver(
-            config=self.config, mail_callback=self.email_source)
         self.transport = Transport(
             config=self.config,
             message_callback=self.xmpp_source)
+        self.pipeline = self._mk_pipeline()
+
+    def layer_for_message(self, msg_data):
+        """ Find the account layer for an XMPP message: among the accounts
+        of the sender (by the `main_jid`), the one that made the target
+        JID (see `MailJabberLayer.make_resource`), or the first one """
+        bare_jid = jid_data_to_string(msg_data['frm'], resource=False)
+        resource = msg_data['to']['resource']
+        ## In the `imap_accounts` order
+        layers = [self.layers[name] for name in self.account_names
+                  if self.layers[name].config.main_jid == bare_jid]
+        for layer in layers:
+            if layer.owns_resource(resource):
+                return layer
+        if layers:
+            return layers[0]
+        return self.layer
 
     def xmpp_source(self, msg_data, **kwa):
         ## xmpptransport -> convertlayer
-        self.layer.xmpp_to_smtp(msg_data, **kwa)
-
-    def email_source(self, msg, **kwa):
-        _try_with_pm(lambda: self.layer.email_to_xmpp(msg, **kwa))
+        layer = self.layer_for_message(msg_data)
+        layer.xmpp_to_smtp(msg_data, **kwa)
+
+    def email_source(self, msg, _account=None, **kwa):
+        ## NOTE: returns False for a skipped message (see
+        ## `IMAPReceiver.handle_msg`); with the `pipeline`, that is only
+        ## known later.
+        if self.pipeline is not None:
+            return self.pipeline['convert'].put(msg, _account=_account, **kwa)
+        return self.email_convert(msg, _account=_account, **kwa)
+
+    def email_convert(self, msg, _account=None, msg_content=None, msgid=None, **kwa):
+        ## imapcli -> convertlayer
+        ## NOTE: `msg` has only the headers parsed (see `LazyMessage`);
+        ## with the `convert_pool`, only the raw `msg_content` is passed
+        ## to the worker, which does the whole parse.
+        layer = self.layers[_account]
+        if self.convert_pool is None or msg_content is None:
+            return _try_with_pm(lambda: layer.email_to_xmpp(msg, **kwa))
+        try:
+            data = self.convert_pool.apply(_account, msg_content, msgid)
+        except ProcessPoolError as exc:
+            _log.error("Conversion of message %r in the pool failed, retrying in-process: %s",
+                       msgid, exc)
+            data = _try_with_pm(lambda: layer.email_to_xmpp_data(msg))
+            if data is None:
+                return False
+        return _try_with_pm(lambda: layer.email_data_to_xmpp(data, msg=msg, **kwa))
+
+    def _convert_in_child(self, account, msg_content, msgid=None):
+        ## Runs in the `convert_pool` processes.
+        _log.debug("Converting message %r", msgid)
+        layer = self._child_layers.get(account)
+        if layer is None:
+            ## Without any state db: only the stateless
+            ## `email_to_xmpp_data` is used here.
+            layer = self._child_layers[account] = MailJabberLayer(
+                config=self.account_configs[account],
+                xmpp_sink=None, smtp_sink=None)
+        return layer.email_to_xmpp_data(msg_content)
 
     def xmpp_sink(self, msg_data, **kwa):
         ## [imapcli -> | xmpptransport -> ] convertlayer -> xmpptransport,
         ## from-email messages and error messages
+        if self.pipeline is not None:
+            return self.pipeline['send'].put(msg_data, **kwa)
+        return self.xmpp_send(msg_data, **kwa)
+
+    def xmpp_send(self, msg_data, **kwa):
         return self.transport.send_message_data(msg_data, **kwa)
 
+    def _mk_pipeline(self):
+        settings = self.config.email_pipeline
+        if not settings:
+            return None
+        stages = []
+        for name, func in (('convert', self.email_convert), ('send', self.xmpp_send)):
+            concurrency, queue_size = settings.get(name, (1, 10))
+            stages.append(Stage(
+                name, func, concurrency=concurrency, queue_size=queue_size))
+        return Pipeline(stages)
+
     def smtp_sink(self, to, msg, frm=None, **kwa):
         ## [xmpptransport -> ] convertlayer -> smtphelper
         fkwa = {k: v for k, v in kwa.items() if k in ('auto_headers',)}
+        layer = kwa.get('_layer')
+        if layer is not None:
+            fkwa['config'] = layer.config  ## per-account SMTP settings
         return self.smtp.send_email(
             to, msg, from_=frm,
             _copy=False, **fkwa)
@@ -122,8 +234,12 @@ class PyIMAPSMTPtWorker(object):
     def run_loop(self):
         # self.layer does not have a loop
         # self.smtp does not have a loop (but maybe should)
-        child = gevent.spawn(self.imapc.run)
-        self.children['imapc'] = child
+        # NOTE: the `convert_pool` is started by `_instantiate`.
+        if self.pipeline is not None:
+            self.pipeline.start()
+        for name, imapc in self.imapcs.items():
+            child = gevent.spawn(imapc.run_with_retry)
+            self.children['imapc' if name is None else 'imapc_%s' % (name,)] = child
         child = gevent.spawn(self.transport.run)
         self.children['transport'] = child
         ## The 'loop'
@@ -133,18 +249,39 @@ class PyIMAPSMTPtWorker(object):
         self.stop_children()
         _log.info("Waiting %rs for the children to quit", self.joinall_timeout)
         gevent.joinall(self.children.values(), timeout=self.joinall_timeout)
+        for layer in self.layers.values():
+            if layer.coalescer is not None:
+                _log.info("Sending the held messages: %r", layer.coalescer.stats)
+                layer.coalescer.flush_all()
+        if self.pipeline is not None:
+            _log.info("Waiting %rs for the pipeline to finish: %r",
+                      self.pipeline_stop_timeout, self.pipeline.stats)
+            self.pipeline.stop(timeout=self.pipeline_stop_timeout)
+        if self.convert_pool is not None:
+            _log.info("Stopping the conversion processes: %r", self.convert_pool.stats)
+            self.convert_pool.stop()
 
     def post_run(self, kill_children=True):
         if kill_children:
             self.kill_children()
+        self.flush_state()
         if self.config.pidfile:
             os.unlink(self.config.pidfile)
 
+    def flush_state(self):
+        """ Save whatever state writes are still pending (e.g. with the
+        `db_save_delay` setting) """
+        _log.info("Saving the state")
+        for imapc in self.imapcs.values():
+            imapc.db.flush()
+        if self.db is not None:
+            self.db.flush()
+
     def stop_children(self):
         _log.info("Stopping children")
-        if self.imapc is not None:
+        for imapc in self.imapcs.values():
             _log.info("Setting the imapc stop event")
-            self.imapc.stop_event.set()
+            imapc.stop_event.set()
         if self.transport is not None:
             _log.info("Setting the transport stop event")
             self.transport.online = False
@@ -165,12 +302,33 @@ def _try_with_pm(_func_to_try_with_pm, *ar, **kwa):
         import ipdb; ipdb.pm()
 
 
+def account_db(db, name):
+    """ The account's namespace in the shared `db` """
+    if name is None:
+        return db
+    return db.subdict('account_%s' % (name,))
+
+
+def mark_all_as_seen(config):
+    """ Skip all the messages currently in the mailboxes of all the
+    accounts; only the IMAP connections and the state db are used """
+    db = get_db(config)
+    try:
+        for name, account_config in get_account_configs(config):
+            imapc = IMAPReceiver(config=account_config, db=account_db(db, name))
+            imapc.mark_all_as_seen()
+    finally:
+        ## Before the worker loads the same db (e.g. with `db_save_delay`)
+        db.flush()
+        if hasattr(db, 'close'):
+            db.close()
+
+
 def main():
     if 'mark_all' in sys.argv:
         config = get_config()
         configure_logging(config)
-        imapcli = IMAPReceiver(config=config)
-        imapcli.mark_all_as_seen()
+        mark_all_as_seen(config)
     worker = PyIMAPSMTPtWorker()
     worker.run()
 
@@ -0,0 +1,109 @@
+# coding: utf8
+""" A staged producer/consumer pipeline over gevent: each stage has a
+bounded queue and a number of worker greenlets.
+
+A full queue blocks the `put` (of the previous stage or of the
+producer), which is the backpressure: a slow stage slows down its
+producers instead of everything piling up in memory.
+
+Used for the email -> xmpp direction (see `PyIMAPSMTPtWorker`):
+
+  imapcli greenlet -> ['convert' stage] -> ['send' stage]
+"""
+
+import logging
+
+import gevent
+import gevent.queue
+
+
+_log = logging.getLogger(__name__)
+
+
+## Queue item that tells a stage worker to quit
+_STOP = object()
+
+
+class Stage(object):
+    """ A single pipeline stage: `func(*ar, **kwa)` called from
+    `concurrency` greenlets for the items `put` into a queue of at most
+    `queue_size` items """
+
+    def __init__(self, name, func, concurrency=1, queue_size=10):
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.queue = gevent.queue.Queue(maxsize=queue_size)
+        self.workers = []
+        self.stats = dict(put=0, done=0, errors=0, blocked=0, dropped=0)
+        self.log = _log.getChild(name)
+
+    def put(self, *ar, **kwa):
+        """ Queue a `func(*ar, **kwa)` call; blocks while the queue is
+        full """
+        self.stats['put'] += 1
+        if self.queue.full():
+            self.stats['blocked'] += 1
+            self.log.debug("Queue is full, waiting")
+        self.queue.put((ar, kwa))
+
+    def start(self):
+        for _ in range(self.concurrency - len(self.workers)):
+            self.workers.append(gevent.spawn(self._work))
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            ar, kwa = item
+            try:
+                self.func(*ar, **kwa)
+            except Exception as exc:
+                self.stats['errors'] += 1
+                self.log.exception("Stage function error: %r", exc)
+            else:
+                self.stats['done'] += 1
+
+    def stop(self, timeout=None):
+        """ Process the already queued items and stop the workers """
+        for _ in self.workers:
+            self.queue.put(_STOP)
+        gevent.joinall(self.workers, timeout=timeout)
+        self.workers = [worker for worker in self.workers if not worker.ready()]
+        if self.workers:
+            ## NOTE: the stop items of these workers are still queued too.
+            self.stats['dropped'] += max(self.queue.qsize() - len(self.workers), 0)
+            self.log.warning(
+                "%d workers did not stop in time; %d queued items are dropped",
+                len(self.workers), self.stats['dropped'])
+
+
+class Pipeline(object):
+    """ An ordered set of named stages """
+
+    def __init__(self, stages):
+        """ ...
+
+        :param stages: list of Stage
+        """
+        self.stages = list(stages)
+        self.stages_by_name = {stage.name: stage for stage in self.stages}
+
+    def __getitem__(self, name):
+        return self.stages_by_name[name]
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self, timeout=None):
+        """ Stop the stages in order, so that each one gets to process
+        whatever the previous ones have left for it """
+        for stage in self.stages:
+            stage.stop(timeout=timeout)
+
+    @property
+    def stats(self):
+        return {stage.name: dict(stage.stats, queued=stage.queue.qsize())
+                for stage in self.stages}
@@ -0,0 +1,225 @@
+# coding: utf8
+""" A gevent-friendly pool of forked worker processes for the CPU-heavy
+work (the email parsing / conversion).
+
+`multiprocessing.Pool` does not mix with the gevent monkey-patching (its
+result-handling thread does blocking reads), so this is a minimal
+version over pipes: each worker is a forked child that runs `func` on the
+requests read from its pipe; the parent does the pipe I/O with
+`gevent.os.nb_read` / `nb_write`, so waiting for a result only blocks the
+calling greenlet.
+
+The `func` and whatever it uses are inherited by the fork (so the pool
+must be started after they are set up); the arguments and the results
+are pickled. Start it before opening any connections: the workers
+forked later (the replacements of the failed ones) close the sockets
+they inherit, but still share everything else with the parent, which
+`func` must not touch (e.g. a SQLite connection).
+"""
+
+import os
+import stat
+import signal
+import struct
+import logging
+import traceback
+import cPickle as pickle
+
+import gevent
+import gevent.os
+import gevent.queue
+
+
+_log = logging.getLogger(__name__)
+
+
+_header = struct.Struct('!I')
+
+
+class ProcessPoolError(Exception):
+    """ The worker process failed (or the function raised an exception in
+    it) """
+
+
+def _read_exact(fd, size, read):
+    chunks = []
+    while size > 0:
+        chunk = read(fd, min(size, 1024 * 1024))
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _write_all(fd, data, write):
+    while data:
+        written = write(fd, data)
+        data = data[written:]
+
+
+def _send(fd, obj, write):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    _write_all(fd, _header.pack(len(data)) + data, write)
+
+
+def _recv(fd, read):
+    size, = _header.unpack(_read_exact(fd, _header.size, read))
+    return pickle.loads(_read_exact(fd, size, read))
+
+
+def _close_inherited_sockets(keep=()):
+    """ Close the sockets (e.g. the IMAP / XMPP connections) in a forked
+    worker, so that it does not keep them open after the parent closes
+    them """
+    try:
+        fds = [int(name) for name in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(3, min(os.sysconf('SC_OPEN_MAX'), 65536))
+    for fd in fds:
+        if fd < 3 or fd in keep:
+            continue
+        try:
+            if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                os.close(fd)
+        except OSError:  ## e.g. the fd of the listdir
+            pass
+
+
+def _child_loop(func, rfd, wfd):
+    """ The worker process main loop (plain blocking I/O: nothing else
+    runs in the child) """
+    while True:
+        try:
+            ar = _recv(rfd, os.read)
+        except EOFError:  ## The parent has closed the pool
+            return
+        try:
+            res = ('ok', func(*ar))
+        except Exception as exc:
+            res = ('error', '%r\n%s' % (exc, traceback.format_exc()))
+        _send(wfd, res, os.write)
+
+
+class _Worker(object):
+
+    def __init__(self, pid, rfd, wfd):
+        self.pid = pid
+        self.rfd = rfd
+        self.wfd = wfd
+        self.jobs = 0
+
+
+class ProcessPool(object):
+    """ `processes` worker processes running `func(*ar)` for `apply(*ar)`
+    calls; the calls wait for a free worker """
+
+    def __init__(self, func, processes=2, name='convert'):
+        self.func = func
+        self.processes = processes
+        self.log = _log.getChild(name)
+        self.workers = []
+        self.idle = gevent.queue.Queue()
+        self.stats = dict(jobs=0, errors=0, restarts=0, waited=0)
+
+    def start(self):
+        while len(self.workers) < self.processes:
+            worker = self._spawn()
+            self.workers.append(worker)
+            self.idle.put(worker)
+
+    def _spawn(self):
+        req_r, req_w = os.pipe()
+        res_r, res_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:  ## The child
+            code = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                for worker in self.workers:
+                    os.close(worker.rfd)
+                    os.close(worker.wfd)
+                os.close(req_w)
+                os.close(res_r)
+                _close_inherited_sockets(keep=(req_r, res_w))
+                _child_loop(self.func, req_r, res_w)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(req_r)
+        os.close(res_w)
+        gevent.os.make_nonblocking(res_r)
+        gevent.os.make_nonblocking(req_w)
+        self.log.debug("Started worker process %d", pid)
+        return _Worker(pid, res_r, req_w)
+
+    def apply(self, *ar):
+        """ Run `func(*ar)` in a worker process; returns the result or
+        raises ProcessPoolError """
+        if not self.workers:
+            raise ProcessPoolError("The pool is not started")
+        self.stats['jobs'] += 1
+        if self.idle.empty():
+            self.stats['waited'] += 1
+        worker = self.idle.get()
+        try:
+            _send(worker.wfd, ar, gevent.os.nb_write)
+            status, res = _recv(worker.rfd, gevent.os.nb_read)
+        except (EOFError, OSError, IOError) as exc:
+            self.stats['errors'] += 1
+            self.log.warning("Worker process %d failed: %r; restarting it",
+                             worker.pid, exc)
+            self._replace(worker)
+            raise ProcessPoolError("Worker process failed", exc)
+        except BaseException:
+            ## Interrupted mid-request (e.g. killed): the pipe state is
+            ## unknown, so do not reuse this worker.
+            self._replace(worker)
+            raise
+        worker.jobs += 1
+        self.idle.put(worker)
+        if status != 'ok':
+            self.stats['errors'] += 1
+            raise ProcessPoolError(res)
+        return res
+
+    def _replace(self, worker):
+        self._close_worker(worker, timeout=0)
+        if worker not in self.workers:  ## The pool was stopped meanwhile
+            return
+        self.workers.remove(worker)
+        self.stats['restarts'] += 1
+        new_worker = self._spawn()
+        self.workers.append(new_worker)
+        self.idle.put(new_worker)
+
+    def _close_worker(self, worker, timeout=1):
+        for fd in (worker.rfd, worker.wfd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        ## No more requests: the worker exits on its own.
+        for _ in range(int(timeout * 10) + 1):
+            try:
+                pid, _ = os.waitpid(worker.pid, os.WNOHANG)
+            except OSError:  ## Already reaped
+                return
+            if pid:
+                return
+            gevent.sleep(0.1)
+        self.log.warning("Killing worker process %d", worker.pid)
+        try:
+            os.kill(worker.pid, signal.SIGKILL)
+            os.waitpid(worker.pid, 0)
+        except OSError:
+            pass
+
+    def stop(self, timeout=1):
+        workers, self.workers = self.workers, []
+        self.idle = gevent.queue.Queue()
+        for worker in workers:
+            self._close_worker(worker, timeout=timeout)
@@ -11,12 +11,15 @@ try:
 except Exception:
     import json
 
+import os
+import time
+import contextlib
 import functools
 import errno
 import logging
 
 
-from UserDict import UserDict
+from UserDict import UserDict, DictMixin
 
 
 def _dumps_to_dump(dumps_func):
@@ -41,18 +44,25 @@ def _loads_to_load(loads_func):
     return _wrapped_load
 
 
-def _save_wrapped(name):
-    """ A helper-wrapper for SimpleDB that passes the call to self.dict and
-    then calls self.save() """
+## `changed()` value for the deleted items
+DELETED = object()
+
+
+def _wrap_value(parent, key, value):
+    """ Make a dict `value` into a Subdict of the `parent` at the `key` """
+    if not isinstance(value, dict):
+        return value
+    if isinstance(value, Subdict) and value._parent is parent:
+        value._key = key
+        return value
+    return Subdict(value, parent=parent, key=key)
 
-    def _wrapped(self, *ar, **kwa):
-        method = getattr(self.data, name)
-        res = method(*ar, **kwa)
-        self.save()
-        return res
 
-    _wrapped.__name__ = name
-    return _wrapped
+def _detach(value, new_value=None):
+    """ Make a removed (or replaced) Subdict stop reporting its changes:
+    they would resurrect it (e.g. in a journal) """
+    if isinstance(value, Subdict) and value is not new_value:
+        value._parent = value._key = None
 
 
 class SimpleDB(UserDict):
@@ -62,6 +72,8 @@ class SimpleDB(UserDict):
 
     # Flag to temporarily disable saving
     _nosave = False
+    # The changes collected within a `batch()`
+    _batch_changes = None
 
     def __init__(self, filename, _ser=None, _load=True, _open_cm=None):
         UserDict.__init__(self)  # Just to honour it
@@ -89,7 +101,9 @@ class SimpleDB(UserDict):
         data = {}
         if _load:
             data = self.try_load() or data
-        self.data = data
+        # Make the nested dicts save their changes too.
+        self.data = {key: _wrap_value(self, key, value)
+                     for key, value in data.items()}
 
     def try_load(self):
         """ Attempt to self.load, return None if it raises 'file not found' """
@@ -104,18 +118,78 @@ class SimpleDB(UserDict):
         with open(self._filename, 'rb') as fo:
             return self._ser['load'](fo)
 
-    __setitem__ = _save_wrapped('__setitem__')
-    __delitem__ = _save_wrapped('__delitem__')
-    pop = _save_wrapped('pop')
-    popitem = _save_wrapped('popitem')
-    update = _save_wrapped('update')
+    def __setitem__(self, key, value):
+        wrapped = _wrap_value(self, key, value)
+        _detach(self.data.get(key), wrapped)
+        self.data[key] = wrapped
+        self.changed([((key,), value)])
+
+    def __delitem__(self, key):
+        _detach(self.data.pop(key))
+        self.changed([((key,), DELETED)])
+
+    def pop(self, key, *ar):
+        had_key = key in self.data
+        res = self.data.pop(key, *ar)
+        if had_key:
+            _detach(res)
+            self.changed([((key,), DELETED)])
+        return res
+
+    def popitem(self):
+        key, value = self.data.popitem()
+        _detach(value)
+        self.changed([((key,), DELETED)])
+        return key, value
+
+    def update(self, *ar, **kwa):
+        values = dict(*ar, **kwa)
+        for key, value in values.items():
+            wrapped = _wrap_value(self, key, value)
+            _detach(self.data.get(key), wrapped)
+            self.data[key] = wrapped
+        # NOTE: single save.
+        self.changed([((key,), value) for key, value in values.items()])
+
+    def changed(self, changes):
+        """ Report the `changes`: a list of `(path, value)`, where path is
+        a tuple of keys (more than one for the changes within the nested
+        Subdicts) and value is either the new value or `DELETED`.
+
+        Saved right away (see `save_changes`), or at the end of the
+        `batch()` """
+        if self._batch_changes is not None:
+            self._batch_changes.extend(changes)
+            return
+        self.save_changes(changes)
+
+    def save_changes(self, changes):
+        """ Save the `changes` (see `changed`).
+
+        This version always saves everything. """
+        self.save()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Save all the changes made within with a single write (at the
+        end) """
+        if self._batch_changes is not None:  ## Nested
+            yield self
+            return
+        self._batch_changes = []
+        try:
+            yield self
+        finally:
+            changes, self._batch_changes = self._batch_changes, None
+            if changes:
+                self.save_changes(changes)
 
     def setdefault(self, key, failobj=None):
         try:
             return self[key]
         except KeyError:
             self[key] = failobj
-            return failobj
+            return self[key]
 
     # Bonus functions: lazy get and setdefault
 
@@ -125,7 +199,7 @@ class SimpleDB(UserDict):
         except KeyError:
             val = failfunc()
             self[key] = val
-            return val
+            return self[key]
 
     def fget(self, key, failfunc=lambda: None):
         try:
@@ -134,15 +208,15 @@ class SimpleDB(UserDict):
             return failfunc()
 
     def subdict(self, key):
+        """ Get the Subdict at the `key`, making an empty one if necessary.
+
+        NOTE: the dict values (at any depth) are made Subdicts
+        automatically, both on load and on write.
         """
-        A complicated helper.
-        As it is not called automatically, after loading the db you *might*
-        have to call this for each key with a dict where you want to have the
-        key changes saved.
-        """
-        val = Subdict(self.get(key) or {}, parent=self)
-        self[key] = val
-        return val
+        val = self.get(key)
+        if not isinstance(val, Subdict):
+            self[key] = val or {}
+        return self[key]
 
     # Some things that should not be done
 
@@ -156,8 +230,16 @@ class SimpleDB(UserDict):
     def save(self):
         if self._nosave:
             return
+        if self._batch_changes is not None:
+            ## Nothing to report by path; save everything at the end.
+            self._batch_changes.append(((), None))
+            return
         self.sync()
 
+    def flush(self):
+        """ Save whatever is not saved yet; this version always saves right
+        away, so there's nothing to do """
+
     def sync(self):
         """ ...
 
@@ -166,50 +248,478 @@ class SimpleDB(UserDict):
             return self._ser['dump'](self.data, fo)
 
 
-def _child_wrapped(name):
-    """ A helper-wrapper for Subdict: passes the call to dict(self, ...)
-    and then calls self.save() """
+class SimpleDBJournal(SimpleDB):
+    """ A version of SimpleDB that appends each change to a journal file
+    (`<filename>.journal`, a JSON record per line) instead of rewriting the
+    whole file. The changes within the nested Subdicts are journaled by
+    their key paths, so they cost O(change) too.
 
-    def _wrapped(self, *ar, **kwa):
-        method = getattr(dict, name)
-        res = method(self, *ar, **kwa)
-        self.save()
-        return res
+    The journal is replayed over the main file on load, and compacted into
+    it (a whole-data `sync()` + journal truncation) once it grows past
+    `compact_size` bytes. A plain `save()` (e.g. from a Subdict) has no
+    information about what changed, so it compacts.
+
+    :param fsync: 'always', 'never', or the minimal interval (in seconds)
+    between fsyncs of the journal.
+    """
+
+    _compact_size = 1024 * 1024
+    _fsync = 'always'
+    _journal_fo = None
+    _last_fsync = 0
+
+    def __init__(self, filename, compact_size=None, fsync=None, **kwa):
+        if compact_size is not None:
+            self._compact_size = compact_size
+        if fsync is not None:
+            self._fsync = fsync
+        self._journal_filename = '%s.journal' % (filename,)
+        self.stats = dict(journal_writes=0, compactions=0, replayed=0)
+        self._torn = False
+        SimpleDB.__init__(self, filename, **kwa)
+        if self._torn:
+            ## Do not append anything after the bad record.
+            self.compact()
+
+    def try_load(self):
+        data = SimpleDB.try_load(self)
+        try:
+            fo = open(self._journal_filename, 'rb')
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return data
+
+        if data is None:
+            data = {}
+        with fo:
+            for line in fo:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    ## Most likely, an incomplete last write; nothing
+                    ## after it could have been written.
+                    logging.getLogger(self.__class__.__name__).warning(
+                        "Bad journal record, ignoring the rest: %r", line)
+                    self._torn = True
+                    break
+                self._apply(data, record)
+                self.stats['replayed'] += 1
+        return data
+
+    @staticmethod
+    def _apply(data, record):
+        if record[0] == 'set':
+            data[record[1]] = record[2]
+        elif record[0] == 'del':
+            data.pop(record[1], None)
+        elif record[0] in ('pset', 'pdel'):
+            path = record[1]
+            target = data
+            for key in path[:-1]:
+                if not isinstance(target.get(key), dict):
+                    target[key] = {}
+                target = target[key]
+            if record[0] == 'pset':
+                target[path[-1]] = record[2]
+            else:
+                target.pop(path[-1], None)
+        else:
+            raise ValueError("Unknown journal record", record)
+
+    def _journal(self, records):
+        if self._nosave:
+            return
+        if self._journal_fo is None:
+            self._journal_fo = open(self._journal_filename, 'ab')
+        fo = self._journal_fo
+        fo.write(''.join('%s\n' % (json.dumps(record),) for record in records))
+        fo.flush()
+        self.stats['journal_writes'] += 1
+        if self._fsync == 'always' or (
+                self._fsync != 'never' and
+                time.time() - self._last_fsync >= self._fsync):
+            os.fsync(fo.fileno())
+            self._last_fsync = time.time()
+        if fo.tell() > self._compact_size:
+            self.compact()
+
+    def save_changes(self, changes):
+        records = []
+        for path, value in changes:
+            if len(path) == 1:
+                if value is DELETED:
+                    records.append(['del', path[0]])
+                else:
+                    records.append(['set', path[0], value])
+            else:
+                if value is DELETED:
+                    records.append(['pdel', list(path)])
+                else:
+                    records.append(['pset', list(path), value])
+        self._journal(records)
+
+    def save(self):
+        if self._nosave:
+            return
+        self.compact()
+
+    def compact(self):
+        """ Write the whole data into the main file and empty the journal.
+
+        NOTE: if this is interrupted after the main file is written, the
+        journal is replayed over the new data on load, which gives the same
+        result. """
+        self.sync()
+        if self._journal_fo is not None:
+            self._journal_fo.close()
+        self._journal_fo = open(self._journal_filename, 'wb')
+        if self._fsync != 'never':
+            os.fsync(self._journal_fo.fileno())
+        self.stats['compactions'] += 1
+
+    def flush(self):
+        """ Make sure the journal is on the disk (regardless of the fsync
+        policy) """
+        if self._journal_fo is not None:
+            self._journal_fo.flush()
+            os.fsync(self._journal_fo.fileno())
+            self._last_fsync = time.time()
+
+    def close(self):
+        if self._journal_fo is not None:
+            self._journal_fo.close()
+            self._journal_fo = None
+
+
+class SQLiteTable(DictMixin):
+    """ A dict-like view of a single table of a SQLiteDB; each item is
+    stored (JSON-serialized) in its own row, so each change costs O(item)
+    rather than O(everything).
+
+    Same API as SimpleDB; `subdict(key)` returns another (separately
+    stored) table rather than a Subdict. The keys must be strings (as in
+    the JSON of SimpleDB; they are stored as TEXT and read back as
+    unicode).
+    """
+
+    def __init__(self, db, name):
+        self._db = db
+        self._name = name
+
+    def _query(self, query, *args):
+        return self._db._execute(query, (self._name,) + args)
+
+    def __getitem__(self, key):
+        row = self._query(
+            'SELECT value FROM kv WHERE tbl = ? AND key = ?', key).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, basestring):
+            raise TypeError("SQLiteTable keys must be strings", key)
+        self._query(
+            'INSERT OR REPLACE INTO kv (tbl, key, value) VALUES (?, ?, ?)',
+            key, json.dumps(value))
+        self._db._commit()
+
+    def __delitem__(self, key):
+        cur = self._query('DELETE FROM kv WHERE tbl = ? AND key = ?', key)
+        if not cur.rowcount:
+            raise KeyError(key)
+        self._db._commit()
+
+    def __contains__(self, key):
+        return self._query(
+            'SELECT 1 FROM kv WHERE tbl = ? AND key = ?', key).fetchone() is not None
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM kv WHERE tbl = ?').fetchone()[0]
+
+    def keys(self):
+        return [row[0] for row in self._query('SELECT key FROM kv WHERE tbl = ?')]
+
+    def iteritems(self):
+        for key, value in self._query('SELECT key, value FROM kv WHERE tbl = ?'):
+            yield key, json.loads(value)
 
-    _wrapped.__name__ = name
-    return _wrapped
+    def update(self, *ar, **kwa):
+        # NOTE: single transaction.
+        with self._db.batch():
+            DictMixin.update(self, *ar, **kwa)
+
+    def batch(self):
+        """ Do all the writes within in a single transaction """
+        return self._db.batch()
+
+    def clear(self):
+        self._query('DELETE FROM kv WHERE tbl = ?')
+        self._db._commit()
+
+    # Same bonus functions as in SimpleDB
+
+    def fsetdefault(self, key, failfunc=lambda: None):
+        try:
+            return self[key]
+        except KeyError:
+            val = failfunc()
+            self[key] = val
+            return val
+
+    def fget(self, key, failfunc=lambda: None):
+        try:
+            return self[key]
+        except KeyError:
+            return failfunc()
+
+    def subdict(self, key):
+        """ A separately stored table for the nested data.
+
+        A dict value already stored at `key` (e.g. in a file imported from
+        the JSON backend) is moved into the table. """
+        name = '%s/%s' % (self._name, key)
+        table = SQLiteTable(self._db, name)
+        old_value = self.get(key)
+        if isinstance(old_value, dict):
+            with self._db.batch():
+                table.update(old_value)
+                del self[key]
+        return table
+
+    @property
+    def data(self):
+        """ The whole data as a dict (for debugging) """
+        return dict(self.iteritems())
+
+    def save(self):
+        """ Everything is saved right away anyway """
+
+    flush = save
+
+
+class SQLiteDB(SQLiteTable):
+    """ A SimpleDB-compatible state store in a SQLite database in WAL mode
+    (allows concurrent readers, and writers from multiple processes).
+
+    All the tables (the top-level one and the `subdict`s) are stored in a
+    single `kv` table with the `(tbl, key)` primary key: its index makes
+    every per-table operation (an item, `len`, iteration, `clear`) a range
+    lookup, so separate SQL tables would give nothing but the schema
+    management.
+
+    Each write is committed right away unless it is inside a `batch()`:
+
+    >>> db = SQLiteDB(':memory:')
+    >>> with db.batch():
+    ...     db['a'] = 1
+    ...     db['b'] = 2
+    >>> sorted(db.items())
+    [(u'a', 1), (u'b', 2)]
+    """
+
+    def __init__(self, filename, timeout=30):
+        import sqlite3
+        self._filename = filename
+        self._conn = sqlite3.connect(filename, timeout=timeout, isolation_level=None)
+        self._batch_depth = 0
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS kv ('
+            ' tbl TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,'
+            ' PRIMARY KEY (tbl, key))')
+        self.stats = dict(commits=0, batches=0)
+        SQLiteTable.__init__(self, self, '')
+
+    def _execute(self, query, args=()):
+        return self._conn.execute(query, args)
+
+    def _commit(self):
+        """ Called after each write; outside of a `batch()` the connection
+        is in the autocommit mode, so this only does the accounting """
+        if self._batch_depth:
+            return  # at the end of the batch
+        self.stats['commits'] += 1
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Do all the writes within in a single transaction """
+        if self._batch_depth:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+            return
+
+        self._conn.execute('BEGIN IMMEDIATE')
+        self._batch_depth = 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_depth = 0
+            self._conn.execute('ROLLBACK')
+            raise
+        self._batch_depth = 0
+        self._conn.execute('COMMIT')
+        self.stats['commits'] += 1
+        self.stats['batches'] += 1
+
+    def table(self, name):
+        """ A separately stored named table """
+        return SQLiteTable(self, name)
+
+    def close(self):
+        self._conn.close()
+
+
+@contextlib.contextmanager
+def _no_batch():
+    yield
+
+
+def db_batch(db):
+    """ `db.batch()` for the dbs that support it, a no-op otherwise (e.g.
+    for a plain dict) """
+    batch = getattr(db, 'batch', None)
+    if batch is None:
+        return _no_batch()
+    return batch()
+
+
+def db_subdict(db, key):
+    """ `db.subdict(key)` for the dbs that support it, a nested dict
+    otherwise (e.g. for a plain dict) """
+    subdict = getattr(db, 'subdict', None)
+    if subdict is None:
+        return db.setdefault(key, {})
+    return subdict(key)
+
+
+def get_db(config, filename=None):
+    """ Make the state db as per the `db_*` settings """
+    filename = filename or config.db_filename
+    backend = config.db_backend
+    if backend is None:
+        backend = 'sqlite' if filename.endswith(('.sqlite', '.sqlite3')) else 'json'
+    if backend == 'sqlite':
+        return SQLiteDB(filename)
+    if backend == 'json':
+        if config.db_save_delay:
+            return SimpleDBDelayed(
+                filename, save_delay=config.db_save_delay,
+                max_dirty=config.db_save_max_dirty)
+        return SimpleDB(filename)
+    if backend == 'journal':
+        return SimpleDBJournal(
+            filename, fsync=config.db_journal_fsync,
+            compact_size=config.db_journal_compact_size)
+    raise ValueError("Unknown db_backend", backend)
+
+
+def get_tracking_db(config, db):
+    """ The store for the bulky, frequently updated email tracking data
+    (the conversations index, the duplicates filter): a SQLite database
+    (`tracking_db_filename`) separate from the state `db`, so that it
+    does not make each state save rewrite it (with the 'json' backend) or
+    grow the journal (with the 'journal' one) """
+    filename = config.tracking_db_filename
+    if not filename:
+        return db
+    if isinstance(db, SQLiteDB) and filename == db._filename:
+        return db
+    return SQLiteDB(filename)
 
 
 # This has to be a dict subclass (rather than UserDict) to be
 # JSON-serializable.  Note that using it is likely tricky.
 class Subdict(dict):
-    """ Another dict subclass that can call parent.save() on write.
+    """ Another dict subclass that reports its changes (with the path of
+    keys to them) to the parent, so that the backends that can save a
+    part of the data (e.g. SimpleDBJournal) only save what changed.
     Honours the '_nosave' attribute.
 
+    The dict values are made Subdicts too, recursively. A Subdict removed
+    from its parent (deleted or replaced) is detached: its further changes
+    are not saved anywhere.
+
     Example use:
     >>> filename = '/tmp/._simpledb_subdict_test.json'
     >>> db = SimpleDB(filename)
     >>> key = 'child'
     >>> import random
     >>> val = random.getrandbits(31)
-    >>> # Same as db.subdict(key)
-    >>> db[key] = Subdict(db.get(key) or {}, parent=db)
-    >>> db[key]['something'] = val
+    >>> db[key] = {}  # becomes a Subdict; same as db.subdict(key)
+    >>> db[key]['something'] = {'nested': val}
     >>> db2 = SimpleDB(filename)
-    >>> assert db2[key]['something'] == val
+    >>> assert db2[key]['something']['nested'] == val
+    >>> db2[key]['something']['nested'] = 1
+    >>> assert SimpleDB(filename)[key]['something']['nested'] == 1
     """
 
     _nosave = False
 
-    def __init__(self, child=None, parent=None, **kwargs):
+    def __init__(self, child=None, parent=None, key=None, **kwargs):
         self._parent = parent
+        self._key = key
         dict.__init__(self, child or {}, **kwargs)
+        for child_key, value in dict.items(self):
+            if isinstance(value, dict):
+                dict.__setitem__(self, child_key, _wrap_value(self, child_key, value))
+
+    def __setitem__(self, key, value):
+        wrapped = _wrap_value(self, key, value)
+        _detach(dict.get(self, key), wrapped)
+        dict.__setitem__(self, key, wrapped)
+        self.changed([((key,), value)])
+
+    def __delitem__(self, key):
+        _detach(dict.pop(self, key))
+        self.changed([((key,), DELETED)])
+
+    def pop(self, key, *ar):
+        had_key = key in self
+        res = dict.pop(self, key, *ar)
+        if had_key:
+            _detach(res)
+            self.changed([((key,), DELETED)])
+        return res
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        _detach(value)
+        self.changed([((key,), DELETED)])
+        return key, value
 
-    __setitem__ = _child_wrapped('__setitem__')
-    __delitem__ = _child_wrapped('__delitem__')
-    pop = _child_wrapped('pop')
-    popitem = _child_wrapped('popitem')
-    update = _child_wrapped('update')
+    def update(self, *ar, **kwa):
+        values = dict(*ar, **kwa)
+        for key, value in values.items():
+            wrapped = _wrap_value(self, key, value)
+            _detach(dict.get(self, key), wrapped)
+            dict.__setitem__(self, key, wrapped)
+        self.changed([((key,), value) for key, value in values.items()])
+
+    def setdefault(self, key, failobj=None):
+        if key in self:
+            return self[key]
+        self[key] = failobj
+        return self[key]
+
+    def changed(self, changes):
+        if self._nosave:
+            return
+        if self._parent is None:
+            return
+        if self._key is None:
+            ## Not attached by a key; can only save everything.
+            self._parent.save()
+            return
+        self._parent.changed([
+            ((self._key,) + path, value) for path, value in changes])
 
     def save(self):
         if self._nosave:
@@ -218,15 +728,46 @@ class Subdict(dict):
         if self._parent is not None:
             self._parent.save()
 
+    def flush(self):
+        if self._parent is not None:
+            self._parent.flush()
+
+    def batch(self):
+        """ The parent's `batch()` """
+        return db_batch(self._parent)
+
+    def subdict(self, key):
+        """ Get the Subdict at the `key` (see `SimpleDB.subdict`) """
+        val = self.get(key)
+        if not isinstance(val, Subdict):
+            self[key] = val or {}
+        return self[key]
+
 
 class SimpleDBDelayed(SimpleDB):
-    """ A version of SimpleDB that uses gevent to save a few seconds after the
-    first unsaved write. Requires the whole program to do wait on gevent often
-    enough. """
+    """ A version of SimpleDB that coalesces the writes: the data is saved
+    `save_delay` seconds after the first unsaved change, or right away once
+    there are `max_dirty` unsaved changes, whichever comes first.
+
+    Uses gevent for the delayed save. Requires the whole program to do
+    wait on gevent often enough, and `flush()` to be called before exiting
+    (otherwise at most `max_dirty` changes from the last `save_delay`
+    seconds are lost).
+    """
     _save_delay = 5.001
+    _max_dirty = 50
     _save_waiter = None
     _nosave_delayed = False
 
+    def __init__(self, filename, save_delay=None, max_dirty=None, **kwa):
+        if save_delay is not None:
+            self._save_delay = save_delay
+        if max_dirty is not None:
+            self._max_dirty = max_dirty
+        self._dirty = 0
+        self.stats = dict(flushes=0, writes=0, writes_saved=0)
+        SimpleDB.__init__(self, filename, **kwa)
+
     def _log(self, *ar, **kwa):
         level = kwa.pop("level", logging.INFO)
         logging.getLogger(self.__class__.__name__).log(level, *ar, **kwa)
@@ -234,21 +775,39 @@ class SimpleDBDelayed(SimpleDB):
     def save(self):
         if self._nosave:
             return  # Honour the _nosave anyway
-        if self._save_waiter is None:
+        self._dirty += 1
+        self.stats['writes'] += 1
+        if self._max_dirty and self._dirty >= self._max_dirty:
+            self._log("%d unsaved changes, saving now", self._dirty, level=2)
+            self.flush()
+        elif self._save_waiter is None:
             import gevent
-            self._log("Starting the waiter")
-            self._save_waiter = gevent.Greenlet(self.save_actual)
-            self._save_waiter.start_later(self._save_delay)
+            self._log("Starting the waiter", level=2)
+            self._save_waiter = gevent.spawn_later(self._save_delay, self.save_actual)
         else:
             self._log("Waiter was already started", level=2)
 
     def save_actual(self):
-        self._log("save_actual()")
+        self._log("save_actual()", level=2)
+        self._save_waiter = None
         if self._nosave_delayed:
             return
+        self.flush()
+
+    def flush(self):
+        """ Save the unsaved changes now (if there are any) """
+        waiter, self._save_waiter = self._save_waiter, None
+        if waiter is not None and not waiter.ready():
+            waiter.kill(block=False)
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, 0
         try:
-            self._log("sync()")
             self.sync()
-            self._log("sync() done")
-        finally:
-            self._save_waiter = None
+        except Exception:
+            self._dirty += dirty
+            raise
+        self.stats['flushes'] += 1
+        self.stats['writes_saved'] += dirty - 1
+        self._log("Saved %d changes with a single write (%d writes saved so far)",
+                  dirty, self.stats['writes_saved'])
@@ -108,8 +108,13 @@ class SMTPHelper(object):
         self.config = config
         self._manager = _manager
 
-    def send_email(self, to, message, from_=None, **kwa):
-        return send_email(self.config, to, message, from_=from_, **kwa)
+    def send_email(self, to, message, from_=None, config=None, **kwa):
+        """ ...
+
+        :param config: the (per-account) config to use instead of
+        `self.config`
+        """
+        return send_email(config or self.config, to, message, from_=from_, **kwa)
 
 
 def main():
@@ -17,23 +17,22 @@ from xmpp.browser import (
     Presence,
 )
 
-from .common import jid_to_data
+from .common import jid_to_data, MessageData
 
 
 _log = logging.getLogger(__name__)
 
 
 def event_to_data(event, add_event=True):
-    """ XMPP event to abstractised data """
-    res = dict(
-        _event=event,
-        _type=event.getType(),
+    """ XMPP event to abstractised data (MessageData) """
+    return MessageData(
+        type=event.getType(),
         frm=jid_to_data(event.getFrom()),
         to=jid_to_data(event.getTo()),
         body=event.getBody(),
         subject=event.getSubject(),
+        refs=dict(_event=event) if add_event else None,
     )
-    return res
 
 #######
 ## The Transport
@@ -130,6 +129,8 @@ class Transport(object):
 
     def send_message_data(self, msg_data, **kwa):
         ## TODO: support error events
+        if isinstance(msg_data, MessageData):
+            msg_data = msg_data.as_kwargs()
         msg = Message(**msg_data)
         self.send_message(msg)
 
@@ -244,8 +245,8 @@ class Transport(object):
         if not event_data:
             return
 
-        msg_kwa = dict(event_data, _event=event, _connection=con, _transport=self)
-        self.message_callback(msg_kwa)
+        event_data.refs = dict(_event=event, _connection=con, _transport=self)
+        self.message_callback(event_data)
 
 
 def main():
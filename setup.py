@@ -50,6 +50,9 @@ setup_kwargs = dict(
         'xmpppy',
         'atomicfile',
     ],
+    extras_require={
+        'lxml': ['lxml'],  # html2text_engine = 'lxml'
+    },
     dependency_links=[
         'git+https://github.com/normanr/xmpppy.git@cae7df03e53b471e03fab7aa2f9e8efc5747d689#egg=xmpppy',
     ],
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# coding: utf8
+
+from pyimapsmtpt.backoff import Backoff
+
+
+def _mk_backoff(**kwa):
+    ## No randomness: the jitter always gives the maximum
+    return Backoff(random_func=lambda: 1.0, **kwa)
+
+
+def test_exponential():
+    backoff = _mk_backoff(policies={'abort': (1, 10)})
+    delays = [backoff.failure('abort') for _ in range(6)]
+    assert delays == [1, 2, 4, 8, 10, 10]
+    backoff.success()
+    assert backoff.failure('abort') == 1
+
+
+def test_per_class():
+    backoff = _mk_backoff(policies={'abort': (1, 10), 'auth': (100, 1000)})
+    assert backoff.failure('abort') == 1
+    assert backoff.failure('abort') == 2
+    ## A different class starts over
+    assert backoff.failure('auth') == 100
+    assert backoff.failure('unknown') == backoff.policies['error'][0]
+    assert backoff.stats['failures_abort'] == 2
+
+
+def test_jitter():
+    backoff = Backoff(policies={'abort': (10, 10)}, random_func=lambda: 0.0)
+    assert backoff.failure('abort') == 5
+
+
+def test_circuit():
+    backoff = _mk_backoff(circuit_threshold=3, circuit_timeout=1000)
+    backoff.failure()
+    backoff.failure()
+    assert backoff.state == 'closed'
+    assert backoff.failure() == 1000
+    assert backoff.state == 'open'
+    backoff.attempt()
+    assert backoff.state == 'half-open'
+    assert backoff.failure() == 1000
+    assert backoff.stats['circuit_opens'] == 2
+    backoff.attempt()
+    backoff.success()
+    assert backoff.state == 'closed'
+    assert backoff.failure() < 1000
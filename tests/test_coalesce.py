@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import gevent
+
+from pyimapsmtpt.common import MessageData
+from pyimapsmtpt.coalesce import Coalescer
+
+
+def _mk(**kwa):
+    sent = []
+
+    def sink(msg_data, **kwa):
+        sent.append((msg_data, kwa))
+
+    return Coalescer(sink, **kwa), sent
+
+
+def _msg(idx, frm='ci%example.org@mail.example.com/tok'):
+    return MessageData(to='me@example.com', frm=frm, body=u'build %d' % (idx,))
+
+
+def test_quiet_immediate():
+    coalescer, sent = _mk(window=10, threshold=3)
+    for idx in range(3):
+        coalescer.put('ci@example.org', _msg(idx), _layer='x')
+        assert len(sent) == idx + 1
+    ## Other groups are independent
+    coalescer.put('other@example.org', _msg(10))
+    assert len(sent) == 4
+    assert coalescer.stats['immediate'] == 4
+
+
+def test_burst_digest():
+    coalescer, sent = _mk(window=0.05, threshold=2)
+    for idx in range(10):
+        coalescer.put('ci@example.org', _msg(idx), _layer='x', _email_msg=idx)
+    assert len(sent) == 2
+    gevent.sleep(0.1)
+    assert len(sent) == 3
+    digest, kwa = sent[-1]
+    assert kwa == {'_layer': 'x'}
+    assert digest['subject'].startswith(u'8 messages')
+    assert u'build 2' in digest['body'] and u'build 9' in digest['body']
+    ## The sender, but not in any of the conversations
+    assert digest['frm'] == u'ci%example.org@mail.example.com'
+    assert coalescer.stats['digests'] == 1
+    ## Quiet again after the window
+    gevent.sleep(0.1)
+    coalescer.put('ci@example.org', _msg(20))
+    assert len(sent) == 4 and sent[-1][0]['body'] == u'build 20'
+
+
+def test_max_items_and_flush_all():
+    coalescer, sent = _mk(window=10, threshold=1, max_items=3)
+    for idx in range(6):
+        coalescer.put('ci@example.org', _msg(idx))
+    ## 1 right away, a digest of 3, 2 held
+    assert len(sent) == 2
+    coalescer.flush_all()
+    assert len(sent) == 3
+    assert sent[-1][0]['subject'].startswith(u'2 messages')
+    coalescer.flush_all()
+    assert len(sent) == 3
+
+
+def test_digest_frm():
+    coalescer, sent = _mk(window=10, threshold=0)
+    for idx in range(3):
+        coalescer.put(
+            'list.example.org', _msg(idx, frm='poster%d%%example.org@mail.example.com/t' % (idx,)),
+            digest_frm='list%example.org@mail.example.com')
+    coalescer.flush_all()
+    assert sent[0][0]['frm'] == 'list%example.org@mail.example.com'
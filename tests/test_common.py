@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import html2text
+
+import pyimapsmtpt.config_defaults as config_defaults
+from pyimapsmtpt.common import get_html2text
+from pyimapsmtpt.confloader import Config
+
+
+_docs = [
+    u'<p>First <a href="http://example.com/1">link</a></p><ul><li>item</li></ul>',
+    u'<p>Second <a href="http://example.com/2">link</a> <b>bold</b></p>',
+    u'<table><tr><td>unclosed <blockquote>quote',
+    u'<p>Third <abbr title="x">X</abbr> <a href="http://example.com/3">link</a></p>',
+]
+
+
+def _fresh(config, doc):
+    obj = html2text.HTML2Text(bodywidth=config.html2text_bodywidth)
+    obj.links_each_paragraph = config.html2text_links_each_paragraph
+    return obj.handle(doc).strip()
+
+
+def test_html2text_reuse():
+    config = Config([config_defaults])
+    func = get_html2text(config)
+    assert get_html2text(Config([config_defaults])) is func
+    for doc in _docs + _docs:
+        assert func(doc) == _fresh(config, doc)
+
+
+def test_html2text_config_key():
+    class _Override(object):
+        html2text_bodywidth = 10
+    config = Config([config_defaults, _Override])
+    func = get_html2text(config)
+    assert func is not get_html2text(Config([config_defaults]))
+    assert func(_docs[1]) == _fresh(config, _docs[1])
+
+
+def test_jid():
+    from pyimapsmtpt.common import JID, jid_string_to_data, jid_data_to_string
+    jid = jid_string_to_data('user@example.com/res')
+    assert jid is jid_string_to_data('user@example.com/res')
+    assert jid['node'] == 'user' and jid.resource == 'res'
+    assert jid == dict(node='user', domain='example.com', resource='res')
+    assert jid_data_to_string(jid, resource=False) == 'user@example.com'
+    assert str(jid_string_to_data('example.com')) == 'example.com'
+    import cPickle as pickle
+    assert pickle.loads(pickle.dumps(jid, 2)) is jid
+    assert JID.get('user', 'example.com', None) is jid_string_to_data('user@example.com')
+
+
+def test_message_data():
+    from pyimapsmtpt.common import MessageData, jid_string_to_data
+    msg = MessageData(
+        to=jid_string_to_data('t@example.com'),
+        frm=jid_string_to_data('f@example.com/r'), body=u'body',
+        headers={'Subject': 'x'}, refs=dict(_event=object()))
+    msg2 = msg.copy()
+    assert msg2.refs is msg.refs and msg2.headers is msg.headers
+    msg2.set_header('To', 'y')
+    msg2['body'] = u'other'
+    assert msg.headers == {'Subject': 'x'}
+    assert msg2.headers == {'Subject': 'x', 'To': 'y'}
+    assert msg['body'] == u'body'
+    assert msg.get('subject', 'none') == 'none'
+    assert msg.as_kwargs() == dict(
+        to='t@example.com', frm='f@example.com/r', body=u'body')
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import pytest
+
+import pyimapsmtpt.config_defaults as config_defaults
+from pyimapsmtpt.confloader import Config, get_account_configs
+
+
+class _UserConfig(object):
+    main_jid = 'me@example.com'
+    imap_username = 'me@example.com'
+
+
+def _mk_config(**kwa):
+    user_config = _UserConfig()
+    user_config.__dict__.update(kwa)
+    return Config([config_defaults, user_config])
+
+
+def test_single_account():
+    config = _mk_config()
+    assert get_account_configs(config) == [(None, config)]
+
+
+def test_accounts():
+    config = _mk_config(imap_accounts=[
+        dict(name='work', imap_username='work@example.com'),
+        dict(name='home', main_jid='home@example.com'),
+    ])
+    res = dict(get_account_configs(config))
+    assert res['work'].imap_username == 'work@example.com'
+    assert res['work'].main_jid == 'me@example.com'
+    assert res['home'].imap_username == 'me@example.com'
+    assert res['home'].main_jid == 'home@example.com'
+    ## Defaults are still there
+    assert res['home'].imap_ssl is True
+
+
+def test_accounts_unique_names():
+    config = _mk_config(imap_accounts=[dict(name='a'), dict(name='a')])
+    with pytest.raises(Exception):
+        get_account_configs(config)
+
+
+def test_accounts_over_env(monkeypatch):
+    config = _mk_config(imap_accounts=[
+        dict(name='work', imap_username='work@example.com'),
+        dict(name='home'),
+    ])
+    config._use_env = True
+    monkeypatch.setenv('PIST_imap_username', 'env@example.com')
+    res = dict(get_account_configs(config))
+    assert res['work'].imap_username == 'work@example.com'
+    assert res['home'].imap_username == 'env@example.com'
+
+
+def test_accounts_bad_names():
+    config = _mk_config(imap_accounts=[dict(name='a:b')])
+    with pytest.raises(Exception):
+        get_account_configs(config)
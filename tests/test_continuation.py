@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# coding: utf8
+
+from pyimapsmtpt.continuation import (
+    BodyLimiter, ContinuationCache, parse_command, split_body)
+
+
+def test_split_body():
+    body = u'\n'.join(u'Строка номер %d' % (idx,) for idx in range(1000))
+    head, rest = split_body(body, 1000)
+    assert head + rest == body
+    assert len(head.encode('utf-8')) <= 1000
+    assert head.endswith(u'\n')
+    assert split_body(u'short', 1000) == (u'short', u'')
+
+
+def test_parse_command():
+    assert parse_command(u'!more abc234') == u'abc234'
+    assert parse_command(u' !more \n') == ''
+    assert parse_command(u'!More ABC234') == u'abc234'
+    assert parse_command(u'!more, please') is None
+    assert parse_command(u'hello') is None
+
+
+def test_limit_and_more():
+    limiter = BodyLimiter(1024)
+    body = u' '.join(u'word%d' % (idx,) for idx in range(2000))
+    parts = [limiter.limit(body)]
+    while u'!more ' in parts[-1]:
+        token = parse_command(parts[-1].rsplit(u'"', 2)[1])
+        parts.append(limiter.next_part(token))
+    assert len(parts) > 5
+    assert all(len(part.encode('utf-8')) <= 1024 for part in parts)
+    assert u'word1999' in parts[-1]
+    assert len(limiter.cache) == 0
+    assert limiter.next_part(token).startswith(u'ERROR')
+
+
+def test_cache_bounded():
+    cache = ContinuationCache(max_size=2000, max_item_size=10000)
+    tokens = [cache.add(unicode(idx) * 5000 + u'x'.join(
+        unicode(num) for num in range(idx * 1000, idx * 1000 + 300)))
+        for idx in range(20)]
+    assert cache.size <= 2000
+    assert cache.stats['evicted'] > 0
+    assert cache.pop(tokens[0])[1] is None
+    assert cache.pop(tokens[-1])[1].startswith(u'19')
+    ## The latest remaining one
+    assert cache.pop('')[0] == tokens[-2]
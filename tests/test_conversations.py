@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import email
+
+from pyimapsmtpt.conversations import ConversationIndex, msg_thread_root
+
+
+def test_thread_root():
+    msg = email.message_from_string(
+        'Message-ID: <c@x>\nIn-Reply-To: <b@x>\nReferences: <a@x>\n <b@x>\n\n')
+    assert msg_thread_root(msg) == '<a@x>'
+    msg = email.message_from_string('Message-ID: <c@x>\n\n')
+    assert msg_thread_root(msg) == '<c@x>'
+
+
+def test_index():
+    db = {}
+    index = ConversationIndex(db=db, chain_length=3)
+    token = index.add('<a@x>')
+    assert index.add('<b@x>', root='<a@x>') == token
+    assert index.add('<c@x>', root='<a@x>') == token
+    assert index.add('<d@x>', root='<a@x>') == token
+    ## Root and the latest ones
+    assert index.get(token) == ['<a@x>', '<c@x>', '<d@x>']
+    assert index.reply_headers(token) == {
+        'In-Reply-To': '<d@x>', 'References': '<a@x> <c@x> <d@x>'}
+    assert index.reply_headers('') == {}
+
+    ## Persisted
+    index2 = ConversationIndex(db=db)
+    assert index2.get(token) == ['<a@x>', '<c@x>', '<d@x>']
+
+
+def test_index_bounds():
+    db = {}
+    index = ConversationIndex(db=db, max_size=10, cache_size=3)
+    tokens = [index.add('<%d@x>' % (idx,)) for idx in range(30)]
+    assert len(db) <= 11
+    assert len(index.cache) == 3
+    index.get(tokens[-5])  ## not in the cache, but on disk
+    assert index.get(tokens[0]) is None
+    assert index.stats['evicted'] >= 19
+
+
+def test_index_trim_single_save(tmpdir):
+    from pyimapsmtpt.simpledb import SimpleDB
+
+    class _DB(SimpleDB):
+        syncs = 0
+
+        def sync(self):
+            self.syncs += 1
+            return SimpleDB.sync(self)
+
+    db = _DB(str(tmpdir.join('db.json')))
+    index = ConversationIndex(db=db.subdict('conversations'), max_size=100)
+    for idx in range(110):
+        index.add('<%d@x>' % (idx,))
+    syncs = db.syncs
+    index.add('<trim@x>')  ## 111 > 100 * 1.1
+    assert index.stats['evicted'] == 11
+    ## The add itself, and the trimming
+    assert db.syncs - syncs == 2
+    assert len(SimpleDB(str(tmpdir.join('db.json')))['conversations']) == 100
+
+
+def test_index_sqlite():
+    from pyimapsmtpt.simpledb import SQLiteDB
+    db = SQLiteDB(':memory:')
+    index = ConversationIndex(db=db.subdict('conversations'), max_size=10)
+    tokens = [index.add('<%d@x>' % (idx,)) for idx in range(12)]
+    assert db.stats['batches'] == 1
+    assert len(db.subdict('conversations')) == 10
+    assert ConversationIndex(db=db.subdict('conversations')).get(
+        tokens[-1]) == ['<11@x>']
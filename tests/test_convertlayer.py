@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import pyimapsmtpt.config_defaults as config_defaults
+from pyimapsmtpt.common import jid_string_to_data
+from pyimapsmtpt.confloader import Config
+from pyimapsmtpt.convertlayer import MailJabberLayer
+from pyimapsmtpt.lazymsg import LazyMessage
+
+
+class _UserConfig(object):
+    main_jid = 'me@example.com'
+    xmpp_component_jid = 'mail.example.com'
+
+
+def _mk_layer(account=None, **kwa):
+    sent = dict(xmpp=[], smtp=[])
+
+    def xmpp_sink(msg_data, **kwa):
+        sent['xmpp'].append(msg_data)
+
+    def smtp_sink(to, msg, frm=None, **kwa):
+        sent['smtp'].append(msg)
+
+    user_config = _UserConfig()
+    user_config.__dict__.update(kwa)
+    layer = MailJabberLayer(
+        config=Config([config_defaults, user_config]),
+        xmpp_sink=xmpp_sink, smtp_sink=smtp_sink, account=account)
+    return layer, sent
+
+
+_email = """From: Someone <someone@example.org>
+To: me@example.com
+Subject: Hello
+Message-ID: <first@example.org>
+Content-Type: text/plain; charset="utf-8"
+
+Hello there
+"""
+
+
+def test_threading_roundtrip():
+    layer, sent = _mk_layer()
+    layer.email_to_xmpp(_email)
+    jmsg = sent['xmpp'][0]
+    assert jmsg['frm'].startswith('someone%example.org@mail.example.com/')
+    assert '<' not in jmsg['frm']
+
+    layer.xmpp_to_smtp(dict(
+        frm=jid_string_to_data('me@example.com/phone'),
+        to=jid_string_to_data(jmsg['frm']),
+        body=u'Hi!', subject=None))
+    emsg = sent['smtp'][0]
+    assert emsg['To'] == 'someone@example.org'
+    assert emsg['In-Reply-To'] == '<first@example.org>'
+    assert emsg['References'] == '<first@example.org>'
+
+    ## The next reply follows the previous one
+    layer.xmpp_to_smtp(dict(
+        frm=jid_string_to_data('me@example.com/phone'),
+        to=jid_string_to_data(jmsg['frm']),
+        body=u'Hi again!', subject=None))
+    emsg2 = sent['smtp'][1]
+    assert emsg2['In-Reply-To'] == emsg['Message-ID']
+    assert emsg2['References'].split() == ['<first@example.org>', emsg['Message-ID']]
+
+
+def test_account_resource():
+    work, _ = _mk_layer(account='work')
+    home, sent = _mk_layer(account='home')
+    home.email_to_xmpp(_email)
+    jto = jid_string_to_data(sent['xmpp'][0]['frm'])
+    assert jto['resource'].startswith('home:')
+    assert home.owns_resource(jto['resource'])
+    assert not work.owns_resource(jto['resource'])
+
+    home.xmpp_to_smtp(dict(
+        frm=jid_string_to_data('me@example.com/phone'),
+        to=jto, body=u'Hi!', subject=None))
+    assert sent['smtp'][0]['In-Reply-To'] == '<first@example.org>'
+
+    ## Without a conversation
+    assert home.mfrom_to_jfrom('list@example.org') == (
+        'list%example.org@mail.example.com/home:')
+    assert home.resource_token('home:') is None
+    assert home.resource_token('<manual@example.org>') == '<manual@example.org>'
+
+
+def test_duplicates_skipped():
+    layer, sent = _mk_layer(email_dedup=True)
+    assert layer.email_to_xmpp(_email) is True
+    assert layer.email_to_xmpp(_email) is False
+    assert len(sent['xmpp']) == 1
+    assert layer.dedup.stats['duplicates'] == 1
+    layer.email_to_xmpp(_email.replace('Hello there', 'Hello again'))
+    assert len(sent['xmpp']) == 2
+
+
+def test_split_conversion():
+    import cPickle as pickle
+    layer, sent = _mk_layer()
+    data = layer.email_to_xmpp_data(_email)
+    data = pickle.loads(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+    layer.email_data_to_xmpp(data)
+    layer.email_to_xmpp(_email.replace('first@', 'second@'))
+    assert sent['xmpp'][0]['body'] == sent['xmpp'][1]['body']
+    assert sent['xmpp'][0]['frm'] != sent['xmpp'][1]['frm']
+
+
+_multipart_email = """From: Someone <someone@example.org>
+To: me@example.com
+Subject: Hello
+Message-ID: <lazy@example.org>
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="outer"
+
+This is a multi-part message.
+--outer
+Content-Type: multipart/alternative; boundary="inner"
+
+--inner
+Content-Type: text/plain; charset="utf-8"
+Content-Transfer-Encoding: base64
+
+0J/RgNC40LLQtdGCLCBwbGFpbg==
+--inner
+Content-Type: text/html; charset="utf-8"
+Content-Transfer-Encoding: base64
+
+PHA+0J/RgNC40LLQtdGCLCBodG1sPC9wPg==
+--inner--
+--outer
+Content-Type: application/octet-stream
+Content-Transfer-Encoding: base64
+
+""" + ("AAECAAECAAECAAECAAECAAECAAECAAECAAECAAECAAECAAECAAECAAECAAECAAEC\n" * 1000) + """
+--outer
+Content-Type: message/rfc822
+
+Subject: Inner
+Content-Type: text/plain; charset="us-ascii"
+
+The forwarded one
+--outer--
+"""
+
+
+def test_lazy_parse_same_result():
+    raw = _multipart_email
+    for preferred_format in ('plaintext', 'html2text'):
+        results = []
+        for lazy in (True, False):
+            layer, _ = _mk_layer(
+                email_lazy_parse=lazy, preferred_format=preferred_format)
+            results.append(layer.email_to_xmpp_data(raw))
+            ## Headers-only parsed, as `imapcli` passes it
+            results.append(layer.email_to_xmpp_data(LazyMessage(raw)))
+        assert all(result == results[0] for result in results)
+
+
+def test_encoded_headers():
+    import pyimapsmtpt.convertlayer as convertlayer
+    raw = _email.replace(
+        'Subject: Hello',
+        'Subject: =?utf-8?b?0J/RgNC40LLQtdGC?= and\n'
+        ' =?koi8-r?b?8MXU0Q==?=').replace(
+            'From: Someone', 'From: =?utf-8?q?Caf=C3=A9?=')
+    calls = []
+    orig_decode_header = convertlayer.decode_header
+
+    def decode_header(value):
+        calls.append(value)
+        return orig_decode_header(value)
+
+    convertlayer.decode_header = decode_header
+    try:
+        layer, sent = _mk_layer(
+            prepend_headers=('to', 'from', 'subject', '_always_to'))
+        layer.email_to_xmpp(raw)
+    finally:
+        convertlayer.decode_header = orig_decode_header
+    body = sent['xmpp'][0]['body']
+    assert u'Subject: Привет and Петя' in body
+    assert u'From: Café <someone@example.org>' in body
+    ## Once per (present) header per message
+    assert len(calls) == len(set(calls))
+
+
+def test_coalesce_by_list_id():
+    layer, sent = _mk_layer(email_coalesce_threshold=1, email_dedup=True)
+    for idx in range(3):
+        layer.email_to_xmpp(
+            _email.replace('first@', 'msg%d@' % (idx,)).replace(
+                'Hello there', 'Hello %d' % (idx,)).replace(
+                    'From: Someone <someone@',
+                    'List-Id: <list.example.org>\nFrom: Someone <someone%d@' % (idx,)))
+    assert len(sent['xmpp']) == 1
+    layer.coalescer.flush_all()
+    assert len(sent['xmpp']) == 2
+    assert u'Hello 2' in sent['xmpp'][1]['body']
+    assert layer.dedup.stats['added'] == 3
+    ## Not from whoever posted last: a reply would go to them only
+    assert sent['xmpp'][1]['frm'] == 'mail.example.com'
+    layer.xmpp_to_smtp(dict(
+        frm=jid_string_to_data('me@example.com/phone'),
+        to=jid_string_to_data(sent['xmpp'][1]['frm']), body=u'Thanks'))
+    assert not sent['smtp']
+    assert sent['xmpp'][-1]['body'].startswith('ERROR: ')
+
+
+def test_coalesce_list_post():
+    layer, sent = _mk_layer(email_coalesce_threshold=1)
+    for idx in range(3):
+        layer.email_to_xmpp(
+            _email.replace('first@', 'msg%d@' % (idx,)).replace(
+                'From: Someone <someone@',
+                'List-Id: <list.example.org>\n'
+                'List-Post: <mailto:list@example.org>\n'
+                'From: Someone <someone%d@' % (idx,)))
+    layer.coalescer.flush_all()
+    assert sent['xmpp'][1]['frm'] == 'list%example.org@mail.example.com'
+
+
+def test_long_body_continuation():
+    layer, sent = _mk_layer(email_max_body_size=1024)
+    long_text = u'\n'.join(u'line %d' % (idx,) for idx in range(1000))
+    layer.email_to_xmpp(_email.replace('Hello there', long_text.encode('utf-8')))
+    msg_data = sent['xmpp'][0]
+    assert len(msg_data['body'].encode('utf-8')) <= 1024
+    token = msg_data['body'].rsplit(u'"!more ', 1)[1].split(u'"')[0]
+    layer.xmpp_to_smtp(dict(
+        frm=jid_string_to_data('me@example.com/phone'), to=msg_data['frm'],
+        body=u'!more %s' % (token,)))
+    assert not sent['smtp']
+    reply = sent['xmpp'][1]
+    assert reply['to'] == jid_string_to_data('me@example.com/phone')
+    assert reply['body'].startswith(u'line ')
+
+
+def test_more_only_for_main_jid():
+    layer, sent = _mk_layer(email_max_body_size=1024)
+    long_text = u'\n'.join(u'line %d' % (idx,) for idx in range(1000))
+    layer.email_to_xmpp(_email.replace('Hello there', long_text.encode('utf-8')))
+    transport_jid = sent['xmpp'][0]['frm']
+    for body in (u'!more', u'!more %s' % (
+            layer.body_limiter.cache.items.keys()[0],)):
+        layer.xmpp_to_smtp(dict(
+            frm=jid_string_to_data('stranger@example.net/x'),
+            to=transport_jid, body=body))
+    assert len(sent['xmpp']) == 1
+    assert not sent['smtp']
+    assert len(layer.body_limiter.cache) == 1
+
+
+def test_transport_own_messages():
+    layer, sent = _mk_layer()
+    layer.email_to_xmpp(_email.replace(
+        'Someone <someone@example.org>', 'Backlog <backlog@mail.example.com>'))
+    assert unicode(sent['xmpp'][0]['frm']) == u'mail.example.com'
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import email
+
+from pyimapsmtpt.dedup import BloomFilter, DedupFilter, msg_dedup_key
+
+
+def _mk_msg(message_id='<a@x>', body='Hello'):
+    return email.message_from_string(
+        'Message-ID: %s\nSubject: test\n\n%s\n' % (message_id, body))
+
+
+def test_key():
+    assert msg_dedup_key(_mk_msg()) == msg_dedup_key(_mk_msg())
+    assert msg_dedup_key(_mk_msg()) != msg_dedup_key(_mk_msg(body='Bye'))
+    assert msg_dedup_key(_mk_msg()) != msg_dedup_key(_mk_msg('<b@x>'))
+
+
+def test_bloom():
+    bloom = BloomFilter(size_log2=16, hashes=5)
+    for idx in range(1000):
+        bloom.add('key%d' % (idx,))
+    assert all('key%d' % (idx,) in bloom for idx in range(1000))
+    false_positives = sum('other%d' % (idx,) in bloom for idx in range(1000))
+    assert false_positives < 10
+    bloom2 = BloomFilter.loads(bloom.dumps(), size_log2=16, hashes=5)
+    assert bloom2.bits == bloom.bits
+
+
+def test_filter():
+    db, recent_db = {}, {}
+    dedup = DedupFilter(
+        db=db, recent_db=recent_db, recent_size=4, bloom_size_log2=16)
+    keys = ['key%d' % (idx,) for idx in range(11)]
+    for key in keys:
+        assert not dedup.check(key)
+        dedup.add(key)
+    assert dedup.check(keys[-1])  ## recent
+    assert dedup.check(keys[0])  ## bloom
+    assert dedup.stats['duplicates'] == 2
+    assert dedup.stats['duplicates_recent'] == 1
+    assert dedup.stats['duplicates_bloom'] == 1
+
+    ## Persisted, including the keys added after the last bloom save.
+    dedup2 = DedupFilter(
+        db=db, recent_db=recent_db, recent_size=4, bloom_size_log2=16)
+    assert all(dedup2.check(key) for key in keys)
+    assert not dedup2.check('key11')
+
+
+def test_filter_sqlite():
+    from pyimapsmtpt.simpledb import SQLiteDB
+    db = SQLiteDB(':memory:')
+    dedup_db = db.subdict('dedup')
+    recent_db = dedup_db.subdict('recent')
+    dedup = DedupFilter(
+        db=dedup_db, recent_db=recent_db, recent_size=4, bloom_size_log2=16)
+    for idx in range(10):
+        dedup.add('key%d' % (idx,))
+    ## A row per recent key
+    assert sorted(recent_db.keys()) == ['key6', 'key7', 'key8', 'key9']
+    assert 'recent' not in dedup_db
+
+    dedup2 = DedupFilter(
+        db=dedup_db, recent_db=recent_db, recent_size=4, bloom_size_log2=16)
+    assert list(dedup2.recent) == ['key6', 'key7', 'key8', 'key9']
+    assert all(dedup2.check('key%d' % (idx,)) for idx in range(10))
+
+
+def test_filter_old_format():
+    db = {'recent': ['key1', 'key2']}
+    recent_db = {}
+    dedup = DedupFilter(db=db, recent_db=recent_db, bloom_size_log2=16)
+    assert dedup.check('key2')
+    assert 'recent' not in db
+    assert sorted(recent_db) == ['key1', 'key2']
+
+
+def test_key_text_part_only(monkeypatch):
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from pyimapsmtpt.lazymsg import LazyMessage
+
+    msg = MIMEMultipart('mixed')
+    msg['Message-ID'] = '<a@x>'
+    msg.attach(MIMEText('Hello'))
+    msg.attach(MIMEApplication('\0' * 100000))
+    raw = msg.as_string()
+
+    payloads = []
+    orig_get_payload = LazyMessage.get_payload
+
+    def get_payload(self, *ar, **kwa):
+        payloads.append(self.get_content_type())
+        return orig_get_payload(self, *ar, **kwa)
+
+    monkeypatch.setattr(LazyMessage, 'get_payload', get_payload)
+    key = msg_dedup_key(LazyMessage(raw))
+    assert 'application/octet-stream' not in payloads
+    assert key == msg_dedup_key(email.message_from_string(raw))
+    assert key != msg_dedup_key(LazyMessage(raw.replace('\nHello', '\nHellp')))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import time
+
+import gevent
+import pytest
+
+import pyimapsmtpt.config_defaults as config_defaults
+from pyimapsmtpt.common import get_html2text
+from pyimapsmtpt.confloader import Config
+from pyimapsmtpt.htmltext import (
+    HTMLToText, TimeBudget, ConversionTimeout, strip_tags)
+
+
+_doc = u''.join(
+    [u'<html><head><style>p { color: red; }</style></head><body>'] +
+    [u'<p>Paragraph %d with <a href="http://example.com/%d">a link</a>'
+     u' &amp; an entity</p><ul><li>one</li><li>two</li></ul>' % (idx, idx)
+     for idx in range(100)] +
+    [u'</body></html>'])
+
+
+def _mk_config(**kwa):
+    class _Override(object):
+        pass
+    for key, value in kwa.items():
+        setattr(_Override, key, value)
+    return Config([config_defaults, _Override])
+
+
+def test_strip_tags():
+    res = strip_tags(u'<style>x{}</style><p>a &amp;  b</p><br/>c<!-- d -->')
+    assert res == u'a & b\n\nc'
+
+
+def test_html2text_engine_same_output():
+    config = _mk_config(html2text_chunk_size=100)
+    assert HTMLToText(config)(_doc) == get_html2text(config)(_doc)
+
+
+def test_lxml_engine():
+    pytest.importorskip('lxml')
+    res = HTMLToText(_mk_config(html2text_engine='lxml'))(_doc)
+    assert u'Paragraph 5 with a link <http://example.com/5> & an entity' in res
+    assert u'* one' in res
+    assert u'color' not in res
+    assert HTMLToText(_mk_config(html2text_engine='lxml'))(u' ') == u''
+
+
+def test_caps():
+    conv = HTMLToText(_mk_config(
+        html2text_max_input_size=1000, html2text_max_output_size=200))
+    res = conv(_doc)
+    assert len(res) == 200 + len(conv.truncated_marker)
+    assert u'Paragraph 0' in res
+    assert conv.stats['input_truncated'] == 1
+    assert conv.stats['output_truncated'] == 1
+
+
+def test_time_budget():
+    conv = HTMLToText(_mk_config(
+        html2text_time_budget=1e-9, html2text_chunk_size=100))
+    res = conv(_doc)
+    assert conv.stats['fallbacks'] == 1
+    assert res == strip_tags(_doc)
+
+
+def test_time_budget_own_slices():
+    budget = TimeBudget(0.05)
+
+    def busy():
+        end = time.clock() + 0.1
+        while time.clock() < end:
+            pass
+
+    greenlet = gevent.spawn(busy)
+    budget.sleep()  ## The other greenlet runs meanwhile
+    greenlet.join()
+    budget.check()
+    assert budget.left > 0
+
+    end = time.clock() + 0.1
+    while time.clock() < end:
+        pass
+    with pytest.raises(ConversionTimeout):
+        budget.check()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import email
+import socket
+import imaplib
+from cStringIO import StringIO
+from imapclient.response_parser import parse_fetch_response
+from imapclient.response_types import BodyData
+import pytest
+
+import pyimapsmtpt.config_defaults as config_defaults
+from pyimapsmtpt.imapcli import (
+    IMAPReceiver, ParsedLiteral, build_partial_message, bodystructure_select,
+    chunk_msgids, imaplib_stream_parse, mail_callback_dbg)
+
+
+def test_chunk_by_count():
+    res = list(chunk_msgids([1, 2, 3, 4, 5], max_count=2))
+    assert res == [[1, 2], [3, 4], [5]]
+
+
+def test_chunk_by_size():
+    sizes = {1: 10, 2: 10, 3: 100, 4: 5, 5: 5}
+    res = list(chunk_msgids([1, 2, 3, 4, 5], sizes=sizes, max_size=30))
+    ## An oversized message gets a chunk of its own
+    assert res == [[1, 2], [3], [4, 5]]
+
+
+def test_chunk_unlimited():
+    assert list(chunk_msgids([1, 2, 3])) == [[1, 2, 3]]
+    assert list(chunk_msgids([])) == []
+
+
+## multipart/mixed(multipart/alternative(text/plain, text/html), application/pdf)
+_bodystructure = BodyData.create((
+    (
+        ('text', 'plain', ('charset', 'utf-8'), None, None, '7bit', 10, 1),
+        ('text', 'html', ('charset', 'utf-8'), None, None, '7bit', 20, 1),
+        'alternative',
+    ),
+    ('application', 'pdf', ('name', 'x.pdf'), None, None, 'base64', 9000),
+    'mixed',
+))
+
+
+def test_bodystructure_select():
+    assert bodystructure_select(_bodystructure, 'plaintext') == '1.1'
+    assert bodystructure_select(_bodystructure, 'html2text') == '1.2'
+
+
+def test_bodystructure_select_singlepart():
+    bodystructure = BodyData.create(
+        ('text', 'plain', ('charset', 'utf-8'), None, None, '7bit', 10, 1))
+    assert bodystructure_select(bodystructure, 'plaintext') is None
+
+
+def test_build_partial_message():
+    header = (
+        'Subject: test\r\n'
+        'Content-Type: multipart/mixed; boundary="xx"\r\n'
+        '\r\n')
+    part_header = (
+        'Content-Type: text/plain; charset="utf-8"\r\n'
+        'Content-Transfer-Encoding: base64\r\n'
+        '\r\n')
+    part_body = 'dGVzdCBib2R5\r\n'
+    msg = email.message_from_string(
+        build_partial_message(header, part_header, part_body))
+    assert msg['Subject'] == 'test'
+    assert msg.get_content_type() == 'text/plain'
+    assert msg.get_payload(decode=True) == 'test body'
+
+
+class _Config(object):
+    imap_fetch_chunk_count = 2
+    imap_fetch_chunk_size = 0
+    imap_condstore = True
+    email_address = 'me@example.com'
+    xmpp_component_jid = 'mail.example.com'
+
+    def __getattr__(self, name):
+        return getattr(config_defaults, name)
+
+
+class _FakeCli(object):
+    """ A minimal imapclient.IMAPClient replacement with a CONDSTORE
+    server behind it """
+
+    def __init__(self, messages, capabilities=('CONDSTORE',)):
+        ## {uid: (modseq, content)}
+        self.messages = messages
+        self.capabilities = capabilities
+        self.commands = []
+        self.idle_events = []
+        self._folderinfo = {'HIGHESTMODSEQ': max(
+            modseq for modseq, _ in messages.values())}
+
+    def idle(self):
+        self.commands.append(('idle',))
+
+    def idle_check(self, timeout=None):
+        return self.idle_events.pop(0) if self.idle_events else []
+
+    def idle_done(self):
+        return 'OK', []
+
+    def noop(self):
+        self.commands.append(('noop',))
+
+    def has_capability(self, capability):
+        return capability in self.capabilities
+
+    def search(self, criteria):
+        self.commands.append(('search', criteria))
+        return sorted(self.messages)
+
+    def fetch(self, msgids, items, modifiers=None):
+        self.commands.append(('fetch', msgids, tuple(items), modifiers))
+        if isinstance(msgids, str):
+            first = int(msgids.split(':')[0])
+            msgids = [uid for uid in self.messages if uid >= first]
+        changedsince = 0
+        if modifiers:
+            changedsince = int(modifiers[0].split()[1])
+        res = {}
+        for msgid in msgids:
+            modseq, content = self.messages[msgid]
+            if modseq <= changedsince:
+                continue
+            res[msgid] = {'MODSEQ': (modseq,), 'RFC822': content}
+            for item in items:
+                if 'HEADER.FIELDS' in item:
+                    res[msgid] = {item.replace('.PEEK', ''): _header_fields(
+                        content, item.split('(', 1)[1].rstrip(')]').split())}
+        return res
+
+
+def _header_fields(content, names):
+    lines = [
+        line for line in content.split('\n\n', 1)[0].split('\n')
+        if line.split(':', 1)[0].upper() in names]
+    return '\n'.join(lines) + '\n\n'
+
+
+def _mk_message(uid):
+    return (
+        'From: sender%d@example.com\nSubject: %d\n'
+        'Message-ID: <%d@example.com>\n\nbody') % (uid % 2, uid, uid)
+
+
+def _mk_receiver(db):
+    received = []
+    receiver = IMAPReceiver(
+        _Config(), cli_kwa={}, db=db,
+        mail_callback=lambda msg, **kwa: received.append(msg['Subject']))
+    return receiver, received
+
+
+def test_sync_condstore():
+    messages = {
+        uid: (uid * 10, _mk_message(uid))
+        for uid in range(1, 6)}
+    cli = _FakeCli(messages)
+    db = {'last_uid': 2}
+    receiver, received = _mk_receiver(db)
+
+    ## First sync: no modseq yet, SEARCH is used
+    receiver.sync(cli=cli)
+    assert received == ['3', '4', '5']
+    assert db['last_uid'] == 5
+    assert db['last_modseq'] == 50
+    assert cli.commands[0][0] == 'search'
+
+    messages[6] = (60, _mk_message(6))
+    del cli.commands[:]
+    receiver.sync(cli=cli)
+    assert received == ['3', '4', '5', '6']
+    assert db['last_modseq'] == 60
+    assert all(command[0] == 'fetch' for command in cli.commands)
+    assert cli.commands[0][3] == ['CHANGEDSINCE 50']
+
+
+def test_uidvalidity_resync():
+    ## Messages 1..3 were delivered, 4 was not; the server renumbered
+    ## everything to 101..104.
+    db = {'last_uid': 3, 'last_uidvalidity': 1}
+    receiver, received = _mk_receiver(db)
+    receiver.record_delivered([
+        ('<%d@example.com>' % (uid,), None) for uid in (1, 2, 3)], 3)
+
+    messages = {
+        100 + uid: (uid, _mk_message(uid))
+        for uid in range(1, 5)}
+    cli = _FakeCli(messages, capabilities=())
+    receiver.resync_uidvalidity(cli, 2)
+    assert db['last_uidvalidity'] == 2
+    assert db['last_uid'] == 103
+    ## The Message-IDs are fetched in chunks
+    header_fetches = [command[1] for command in cli.commands
+                      if command[0] == 'fetch' and 'HEADER' in command[2][0]]
+    assert header_fetches == [[101, 102], [103, 104]]
+
+    messages[102] = (2, _mk_message(22))  ## not delivered, but before 104
+    receiver.resync_uidvalidity(cli, 3)
+    assert db['last_uid'] == 101
+    del cli.commands[:]
+    receiver.sync(cli=cli)
+    ## 103 is skipped as already delivered, without fetching it
+    assert received == ['22', '4']
+    assert db['last_uid'] == 104
+    assert not db['resync_until_uid']
+    assert not db['resync_skip_uids']
+    fetched = [msgid for command in cli.commands if command[0] == 'fetch'
+               for msgid in command[1]]
+    assert 103 not in fetched
+
+    ## A message before the first indexed one was dropped from the
+    ## (bounded) index rather than not delivered
+    messages[101] = (1, _mk_message(11))
+    receiver.resync_uidvalidity(cli, 4)
+    assert db['last_uid'] == 104
+    assert not db['resync_until_uid']
+
+
+def test_delivered_index(tmpdir):
+    from pyimapsmtpt.simpledb import SimpleDBJournal
+    filename = str(tmpdir.join('db.json'))
+    db = SimpleDBJournal(filename)
+    ## The older format
+    db['delivered_index'] = [['<1@example.com>', '2020-01-02']]
+    receiver, _ = _mk_receiver(db)
+    receiver.delivered_index.max_size = 2
+    db.compact()
+    receiver.record_delivered([
+        ('<%d@example.com>' % (uid,), None) for uid in (2, 3)], 3)
+    db.close()
+
+    with open(filename + '.journal', 'rb') as fo:
+        journal = fo.read()
+    ## Only the new (and the dropped) items are written
+    assert journal.count('@example.com') == 3
+    db = SimpleDBJournal(filename)
+    assert 'delivered_index' not in db
+    index = _mk_receiver(db)[0].delivered_index
+    assert '<1@example.com>' not in index
+    assert '<3@example.com>' in index
+    assert len(index) == 2
+
+
+def test_bootstrap_uidnext():
+    receiver, _ = _mk_receiver({})
+    cli = _FakeCli({1: (1, _mk_message(1))})
+    cli._folderinfo['UIDNEXT'] = 400001
+    assert receiver.bootstrap_last_uid(cli) == 400000
+    assert cli.commands == []
+
+
+def test_work_single():
+    messages = {1: (10, _mk_message(1))}
+    cli = _FakeCli(messages, capabilities=('X-GM-EXT-1',))
+    cli._folderinfo['UIDVALIDITY'] = 1
+    db = {'last_uid': 1, 'last_uidvalidity': 1}
+    receiver, received = _mk_receiver(db)
+    receiver.idle_mode = 'single'
+    receiver.idle_resync_delay = 0.001
+    receiver.cli = cli
+
+    cli.idle_events.append([(2, 'EXISTS')])
+    receiver.work()
+    assert receiver.stats['idle_events'] == 1
+
+    messages[2] = (20, _mk_message(2))
+    receiver.work()
+    assert received == ['2']
+    assert receiver.stats['delivered'] == 1
+    assert receiver.stats['idle_resyncs'] == 0
+
+    ## An event with nothing found => one re-sync after a NOOP
+    cli.idle_events.append([(3, 'EXISTS')])
+    receiver.work()
+    receiver.work()
+    assert receiver.stats['idle_resyncs'] == 1
+    assert ('noop',) in cli.commands
+
+    ## Not a GMail server => no re-sync
+    cli.capabilities = ()
+    cli.idle_events.append([(3, 'EXISTS')])
+    receiver.work()
+    receiver.work()
+    assert receiver.stats['idle_resyncs'] == 1
+
+
+
+def test_work_single_idle_error():
+    class _IdleError(Exception):
+        pass
+
+    cli = _FakeCli({1: (10, _mk_message(1))}, capabilities=())
+    cli._folderinfo['UIDVALIDITY'] = 1
+
+    def idle_check(timeout=None):
+        raise _IdleError()
+
+    def idle_done():
+        raise socket.error("connection reset")
+
+    cli.idle_check = idle_check
+    cli.idle_done = idle_done
+    receiver, _ = _mk_receiver({'last_uid': 1, 'last_uidvalidity': 1})
+    receiver.cli = cli
+    with pytest.raises(_IdleError):
+        receiver.work_single()
+
+
+def test_skipped_not_delivered():
+    messages = {uid: (uid, _mk_message(uid)) for uid in range(1, 4)}
+    cli = _FakeCli(messages, capabilities=())
+    db = {'last_uid': 0}
+    receiver, received = _mk_receiver(db)
+    ## e.g. a duplicate
+    receiver.mail_callback = lambda msg, **kwa: msg['Subject'] != '2'
+    receiver.sync(cli=cli)
+    assert receiver.stats['delivered'] == 2
+    assert db['last_uid'] == 3
+
+
+def test_backlog_drain():
+    messages = {uid: (uid, _mk_message(uid)) for uid in range(1, 8)}
+    cli = _FakeCli(messages, capabilities=())
+    db = {'last_uid': 0}
+    receiver, received = _mk_receiver(db)
+    receiver.sync_msg_limit = 3
+    receiver.backlog_mode = 'drain'
+    receiver.backlog_rate = 1000
+    receiver.sync(cli=cli)
+    assert received == [str(uid) for uid in range(1, 8)]
+    assert db['last_uid'] == 7
+
+
+def test_backlog_digest():
+    messages = {uid: (uid, _mk_message(uid)) for uid in range(1, 8)}
+    cli = _FakeCli(messages, capabilities=())
+    db = {'last_uid': 0}
+    receiver, received = _mk_receiver(db)
+    messages[2] = (2, _mk_message(2).replace(
+        'Subject: 2', 'Subject: =?utf-8?b?0J/RgNC40LLQtdGC?='))
+    digests = []
+    receiver.mail_callback = lambda msg, **kwa: (
+        received.append(msg['Subject']),
+        digests.append(msg) if 'older' in msg['Subject'] else None)
+    receiver.sync_msg_limit = 3
+    receiver.backlog_mode = 'digest'
+    receiver.sync(cli=cli)
+    assert received == [
+        '4 older messages were not delivered', '5', '6', '7']
+    assert db['last_uid'] == 7
+    body = digests[0].get_payload(decode=True).decode('utf-8')
+    assert u'sender0@example.com: 2' in body
+    assert u'  \u041f\u0440\u0438\u0432\u0435\u0442' in body
+    assert 'Message-ID' not in body
+    assert digests[0]['From'] == 'Backlog <backlog@mail.example.com>'
+
+
+class _IMAP4(imaplib.IMAP4):
+    """ An unconnected imaplib.IMAP4 reading `response` """
+
+    def __init__(self, response):
+        self.debug = 0
+        self._cmd_log_len = 10
+        self._cmd_log_idx = 0
+        self._cmd_log = {}
+        self.file = StringIO(response)
+        self.untagged_responses = {}
+        self.tagged_commands = {}
+        self.tagpre = 'TEST'
+        self.tagre = imaplib.re.compile(
+            r'(?P<tag>TEST\d+) (?P<type>[A-Z]+) (?P<data>.*)')
+
+
+def test_stream_parse():
+    big = _mk_message(1) + ' with a long body' * 1000
+    small = _mk_message(2)
+    response = (
+        '* 1 FETCH (UID 11 RFC822 {%d}\r\n%s)\r\n'
+        '* 2 FETCH (UID 12 RFC822 {%d}\r\n%s)\r\n'
+        '* 3 FETCH (UID 13 BODY[HEADER] {%d}\r\n%s)\r\n') % (
+            len(big), big, len(small), small, len(big), big)
+    imap = _IMAP4(response)
+    imaplib_stream_parse(imap, min_size=1000, chunk_size=100)
+    for _ in range(3):
+        imap._get_response()
+    res = parse_fetch_response(imap.untagged_responses['FETCH'])
+
+    parsed = res[11]['RFC822']
+    assert isinstance(parsed, ParsedLiteral)
+    assert parsed.message.as_string() == big
+    assert res[12]['RFC822'] == small  ## too small to bother
+    assert res[13]['BODY[HEADER]'] == big  ## not a whole message
+
+    receiver, received = _mk_receiver({})
+    msg = receiver.handle_msg(parsed, msgid=11)
+    assert msg is parsed.message
+    assert received == ['1']
+
+
+def test_handle_msg_headers_only():
+    from pyimapsmtpt.lazymsg import LazyMessage
+    calls = []
+    receiver = IMAPReceiver(
+        _Config(), cli_kwa={}, db={},
+        mail_callback=lambda msg, **kwa: calls.append((msg, kwa)))
+    raw = _mk_message(1)
+    msg = receiver.handle_msg(raw, msgid=7)
+    ## The body is left for the conversion (e.g. in a worker process)
+    assert isinstance(msg, LazyMessage) and msg._parts is None
+    assert calls == [(msg, {'msg_content': raw, 'msgid': 7})]
+
+
+def test_mail_callback_dbg(capsys):
+    cli = _FakeCli({1: (1, _mk_message(1))}, capabilities=())
+    receiver = IMAPReceiver(
+        _Config(), cli_kwa={}, db={'last_uid': 0},
+        mail_callback=mail_callback_dbg)
+    receiver.handle_msg(_mk_message(1), msgid=1)
+    receiver.sync(cli=cli)
+    assert receiver.stats['delivered'] == 2
+    assert capsys.readouterr()[0].count('Message: ') == 2
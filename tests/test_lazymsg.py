@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import email
+from email.mime.application import MIMEApplication
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+from pyimapsmtpt.dedup import msg_dedup_key
+from pyimapsmtpt.lazymsg import LazyMessage
+
+
+def _mk_email():
+    inner = MIMEText('The forwarded one')
+    inner['Subject'] = 'Inner'
+    alternative = MIMEMultipart('alternative')
+    alternative.attach(MIMEText(u'Привет, plain'.encode('utf-8'), 'plain', 'utf-8'))
+    alternative.attach(MIMEText(u'<p>Привет, html</p>'.encode('utf-8'), 'html', 'utf-8'))
+    msg = MIMEMultipart('mixed')
+    msg['From'] = 'Someone <someone@example.org>'
+    msg['To'] = 'me@example.com'
+    msg['Subject'] = 'Hello'
+    msg['Message-ID'] = '<lazy@example.org>'
+    msg.preamble = 'This is a multi-part message.'
+    msg.attach(alternative)
+    msg.attach(MIMEApplication('\0\1\2' * 100000))
+    msg.attach(MIMEMessage(inner))
+    return msg.as_string()
+
+
+def _walk(msg):
+    res = []
+    for part in msg.walk():
+        item = [part.get_content_type(), part.items(), part.is_multipart()]
+        if not part.is_multipart():
+            item += [part.get_payload(), part.get_payload(decode=True)]
+        res.append(item)
+    return res
+
+
+@pytest.mark.parametrize('linesep', ['\n', '\r\n'])
+def test_same_as_full_parse(linesep):
+    raw = _mk_email().replace('\n', linesep)
+    full = email.message_from_string(raw)
+    lazy = LazyMessage(raw)
+    assert lazy.items() == full.items()
+    assert _walk(lazy) == _walk(full)
+    assert lazy.get_charsets() == full.get_charsets()
+    assert msg_dedup_key(lazy) == msg_dedup_key(full)
+    assert lazy.as_string() == raw
+
+
+def test_not_multipart():
+    raw = 'Subject: x\nContent-Transfer-Encoding: base64\n\naGVsbG8=\n'
+    lazy = LazyMessage(raw)
+    assert not lazy.is_multipart()
+    assert lazy.get_payload(decode=True) == 'hello'
+    assert LazyMessage('\nno headers').get_payload() == 'no headers'
+    assert LazyMessage('Subject: only headers\n')['Subject'] == 'only headers'
+
+
+def test_unclosed_multipart():
+    raw = ('Content-Type: multipart/mixed; boundary="b"\n\n'
+           'preamble\n--b\n\nfirst\n--b\nContent-Type: text/html\n\n<p>second</p>\n')
+    parts = LazyMessage(raw).get_payload()
+    assert [part.get_payload() for part in parts] == ['first', '<p>second</p>\n']
+    assert parts[1].get_content_type() == 'text/html'
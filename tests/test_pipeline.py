@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import gevent
+
+from pyimapsmtpt.pipeline import Pipeline, Stage
+
+
+def test_pipeline():
+    results = []
+
+    def convert(val):
+        pipeline['send'].put(val * 2)
+
+    def send(val):
+        gevent.sleep(0.001)  ## slow
+        results.append(val)
+
+    pipeline = Pipeline([
+        Stage('convert', convert, concurrency=2, queue_size=2),
+        Stage('send', send, queue_size=2),
+    ])
+    pipeline.start()
+    for val in range(10):
+        pipeline['convert'].put(val)
+    pipeline.stop(timeout=5)
+    assert sorted(results) == [val * 2 for val in range(10)]
+    ## The producer had to wait
+    assert pipeline.stats['convert']['blocked'] > 0
+    assert pipeline.stats['send']['done'] == 10
+
+
+def test_stage_errors():
+    def func(val):
+        raise ValueError(val)
+
+    stage = Stage('failing', func)
+    stage.start()
+    stage.put(1)
+    stage.stop(timeout=5)
+    assert stage.stats['errors'] == 1
+
+
+def test_stage_stop_timeout():
+    stage = Stage('slow', lambda val: gevent.sleep(1), queue_size=5)
+    stage.start()
+    for val in range(4):
+        stage.put(val)
+    stage.stop(timeout=0.01)
+    ## One is being processed
+    assert stage.stats['dropped'] == 3
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import os
+import time
+
+import gevent
+import pytest
+
+from pyimapsmtpt.procpool import ProcessPool, ProcessPoolError
+
+
+def _func(action, value):
+    if action == 'double':
+        return value * 2
+    if action == 'sleep':
+        time.sleep(value)  ## blocking, as a CPU-heavy job would be
+        return os.getpid()
+    if action == 'raise':
+        raise ValueError(value)
+    if action == 'crash':
+        os._exit(3)
+
+
+@pytest.fixture
+def pool():
+    pool = ProcessPool(_func, processes=2)
+    pool.start()
+    yield pool
+    pool.stop()
+
+
+def test_apply(pool):
+    assert pool.apply('double', 21) == 42
+    assert pool.apply('double', u'x' * 100000) == u'x' * 200000
+
+
+def test_errors(pool):
+    with pytest.raises(ProcessPoolError):
+        pool.apply('raise', 'oops')
+    assert pool.apply('double', 1) == 2
+
+    with pytest.raises(ProcessPoolError):
+        pool.apply('crash', None)
+    assert pool.stats['restarts'] == 1
+    assert len(pool.workers) == 2
+    assert pool.apply('double', 2) == 4
+
+
+def test_parallel(pool):
+    ticks = []
+
+    def ticker():
+        while True:
+            ticks.append(1)
+            gevent.sleep(0.01)
+
+    ticker_greenlet = gevent.spawn(ticker)
+    start = time.time()
+    jobs = [gevent.spawn(pool.apply, 'sleep', 0.3) for _ in range(2)]
+    gevent.joinall(jobs, raise_error=True)
+    elapsed = time.time() - start
+    ticker_greenlet.kill()
+
+    assert len(set(job.value for job in jobs)) == 2
+    assert elapsed < 0.55
+    ## The hub was not blocked meanwhile
+    assert len(ticks) > 10
+
+
+def _fd_is_open(fd):
+    try:
+        os.fstat(fd)
+    except OSError:
+        return False
+    return True
+
+
+def test_inherited_sockets_closed():
+    import socket
+    sock_a, sock_b = socket.socketpair()
+    with open(__file__) as fo:
+        pool = ProcessPool(_fd_is_open, processes=1)
+        pool.start()
+        try:
+            assert pool.apply(fo.fileno()) is True
+            assert pool.apply(sock_a.fileno()) is False
+        finally:
+            pool.stop()
+            sock_a.close()
+            sock_b.close()
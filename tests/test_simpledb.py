@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# coding: utf8
+
+import os
+
+import pytest
+
+from pyimapsmtpt.simpledb import (
+    SimpleDB, SimpleDBDelayed, SimpleDBJournal, SQLiteDB)
+
+
+def test_journal(tmpdir):
+    filename = str(tmpdir.join('db.json'))
+    db = SimpleDBJournal(filename)
+    db['a'] = 1
+    db['b'] = {'c': 2}
+    db.update(a=3, d=4)
+    del db['d']
+    db.setdefault('e', 5)
+    assert not os.path.exists(filename)  ## Nothing rewritten yet
+    db.close()
+
+    db2 = SimpleDBJournal(filename)
+    assert db2.data == {'a': 3, 'b': {'c': 2}, 'e': 5}
+    assert db2.stats['replayed'] == 6
+
+
+def test_journal_compaction(tmpdir):
+    filename = str(tmpdir.join('db.json'))
+    db = SimpleDBJournal(filename, compact_size=200, fsync='never')
+    for idx in range(50):
+        db['last_uid'] = idx
+    assert db.stats['compactions'] > 0
+    assert os.path.getsize(filename + '.journal') <= 200
+    db.close()
+
+    assert SimpleDBJournal(filename).data == {'last_uid': 49}
+    ## The main file alone is a valid SimpleDB file
+    assert SimpleDB(filename).data['last_uid'] <= 49
+
+
+def test_journal_torn_write(tmpdir):
+    filename = str(tmpdir.join('db.json'))
+    db = SimpleDBJournal(filename)
+    db['a'] = 1
+    db.close()
+    with open(filename + '.journal', 'ab') as fo:
+        fo.write('["set", "a", ')
+    db = SimpleDBJournal(filename)
+    assert db.data == {'a': 1}
+    db['b'] = 2
+    db.close()
+    assert SimpleDBJournal(filename).data == {'a': 1, 'b': 2}
+
+
+def test_sqlite(tmpdir):
+    filename = str(tmpdir.join('db.sqlite'))
+    db = SQLiteDB(filename)
+    assert db.setdefault('last_uid', None) is None
+    db['last_uid'] = 5
+    assert db.fsetdefault('x', lambda: [1, 2]) == [1, 2]
+    with db.batch():
+        db.update(a=1, b={'c': 2})
+        db.pop('x')
+    assert db.stats['batches'] == 1
+
+    sub = db.subdict('account_a')
+    sub['last_uid'] = 3
+    sub.update(last_uidvalidity=7)
+    db.close()
+
+    db2 = SQLiteDB(filename)
+    assert db2.data == {'last_uid': 5, 'a': 1, 'b': {'c': 2}}
+    assert db2.subdict('account_a').data == {'last_uid': 3, 'last_uidvalidity': 7}
+    assert 'account_a' not in db2
+    with pytest.raises(TypeError):
+        db2[5] = 'x'
+    assert 5 not in db2
+
+
+def test_sqlite_subdict_import(tmpdir):
+    db = SQLiteDB(str(tmpdir.join('db.sqlite')))
+    db['account_a'] = {'last_uid': 3}
+    sub = db.subdict('account_a')
+    assert sub['last_uid'] == 3
+    assert 'account_a' not in db
+
+
+def test_delayed(tmpdir):
+    import gevent
+    filename = str(tmpdir.join('db.json'))
+    db = SimpleDBDelayed(filename, save_delay=0.01, max_dirty=3)
+    db['a'] = 1
+    db['a'] = 2
+    assert not os.path.exists(filename)
+    db['a'] = 3  ## max_dirty
+    assert SimpleDB(filename).data == {'a': 3}
+    assert db.stats['writes_saved'] == 2
+
+    db['a'] = 4
+    gevent.sleep(0.05)  ## save_delay
+    assert SimpleDB(filename).data == {'a': 4}
+
+    db['a'] = 5
+    db.flush()  ## e.g. on shutdown
+    assert SimpleDB(filename).data == {'a': 5}
+    assert db.stats['flushes'] == 3
+    assert db.stats['writes'] == 5
+
+
+def test_subdict_autowrap(tmpdir):
+    filename = str(tmpdir.join('db.json'))
+    db = SimpleDB(filename)
+    db['accounts'] = {'a': {'last_uid': 1}}
+    db.setdefault('convs', {})['x'] = 1
+
+    db2 = SimpleDB(filename)
+    assert db2['convs'] == {'x': 1}
+    ## No `subdict()` calls necessary after load
+    db2['accounts']['a']['last_uid'] = 2
+    assert SimpleDB(filename)['accounts']['a']['last_uid'] == 2
+
+
+def test_journal_subdict_paths(tmpdir):
+    filename = str(tmpdir.join('db.json'))
+    db = SimpleDBJournal(filename)
+    db['accounts'] = {'a': {'last_uid': 1}, 'b': {'last_uid': 5}}
+    db.compact()
+    db['accounts']['a']['last_uid'] = 2
+    db['accounts']['b'].update(last_uid=6, seen=[1])
+    del db['accounts']['b']['seen']
+    db['accounts']['c'] = {}
+    db.close()
+
+    with open(filename + '.journal', 'rb') as fo:
+        journal = fo.read()
+    ## Only the changed items are written
+    assert journal.count('last_uid') == 2
+    assert SimpleDBJournal(filename).data == {'accounts': {
+        'a': {'last_uid': 2}, 'b': {'last_uid': 6}, 'c': {}}}
+
+
+
+def test_journal_detached_subdict(tmpdir):
+    filename = str(tmpdir.join('db.json'))
+    db = SimpleDBJournal(filename)
+    db['accounts'] = {'a': {'last_uid': 1}, 'b': {'last_uid': 5}}
+    db['old'] = {'x': 1}
+    account_a = db['accounts']['a']
+    account_b = db['accounts']['b']
+    old = db['old']
+    del db['old']
+    db['accounts']['a'] = {'last_uid': 10}
+    db['accounts'].pop('b')
+    ## Stale references
+    old['x'] = 2
+    account_a['last_uid'] = 3
+    account_b['last_uid'] = 6
+    db.close()
+
+    assert SimpleDBJournal(filename).data == {'accounts': {
+        'a': {'last_uid': 10}}}
+
+
+def test_batch(tmpdir):
+    filename = str(tmpdir.join('db.json'))
+    db = SimpleDBJournal(filename)
+    sub = db.subdict('sub')
+    with sub.batch():
+        for idx in range(10):
+            sub[str(idx)] = idx
+        del sub['3']
+    ## A single journal write
+    assert db.stats['journal_writes'] == 2
+    db.close()
+    assert len(SimpleDBJournal(filename)['sub']) == 9
+
+    db = SimpleDB(str(tmpdir.join('db2.json')))
+    with db.batch():
+        db['a'] = 1
+        db.subdict('b')['c'] = 2
+        assert not os.path.exists(str(tmpdir.join('db2.json')))
+    assert SimpleDB(str(tmpdir.join('db2.json'))).data == {'a': 1, 'b': {'c': 2}}